@@ -1,4 +1,5 @@
 # File: config/settings.py
+import json
 import os
 from dotenv import load_dotenv
 
@@ -17,10 +18,111 @@ DONATION_URL = os.getenv("DONATION_URL")
 # --- Gemini API Settings ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 DEFAULT_MODEL_ID = os.getenv("DEFAULT_MODEL_ID", "gemini-1.5-flash-latest")
+# Общая HTTP-сессия к Gemini API: максимум соединений всего и к одному хосту, сколько секунд держать
+# простаивающее соединение открытым (keep-alive), время жизни кэша DNS (сек) и общий тайм-аут запроса (сек)
+GEMINI_HTTP_LIMIT = int(os.getenv("GEMINI_HTTP_LIMIT", "100"))
+GEMINI_HTTP_LIMIT_PER_HOST = int(os.getenv("GEMINI_HTTP_LIMIT_PER_HOST", "32"))
+GEMINI_HTTP_KEEPALIVE_SECONDS = float(os.getenv("GEMINI_HTTP_KEEPALIVE_SECONDS", "60"))
+GEMINI_HTTP_DNS_TTL_SECONDS = int(os.getenv("GEMINI_HTTP_DNS_TTL_SECONDS", "300"))
+GEMINI_HTTP_TIMEOUT_SECONDS = float(os.getenv("GEMINI_HTTP_TIMEOUT_SECONDS", "60"))
+# Повторные попытки запросов к Gemini API: сколько раз повторять при превышении квот (429), ошибках
+# сервера (5xx), тайм-аутах, сетевых и прочих ошибках; базовая и максимальная задержка экспоненциального
+# роста со случайным джиттером (сек) и общий срок на запрос со всеми повторами (сек)
+GEMINI_RETRY_RATE_LIMIT = int(os.getenv("GEMINI_RETRY_RATE_LIMIT", "3"))
+GEMINI_RETRY_SERVER = int(os.getenv("GEMINI_RETRY_SERVER", "2"))
+GEMINI_RETRY_TIMEOUT = int(os.getenv("GEMINI_RETRY_TIMEOUT", "1"))
+GEMINI_RETRY_NETWORK = int(os.getenv("GEMINI_RETRY_NETWORK", "2"))
+GEMINI_RETRY_UNEXPECTED = int(os.getenv("GEMINI_RETRY_UNEXPECTED", "1"))
+GEMINI_RETRY_BASE_DELAY_SECONDS = float(os.getenv("GEMINI_RETRY_BASE_DELAY_SECONDS", "1.0"))
+GEMINI_RETRY_MAX_DELAY_SECONDS = float(os.getenv("GEMINI_RETRY_MAX_DELAY_SECONDS", "20"))
+GEMINI_RETRY_DEADLINE_SECONDS = float(os.getenv("GEMINI_RETRY_DEADLINE_SECONDS", "90"))
+# Выключатель запросов по паре (ключ, модель): сколько ошибок квоты или перегрузки подряд размыкают цепь,
+# на сколько секунд (при неверном ключе или отказе в доступе — GEMINI_CIRCUIT_KEY_OPEN_SECONDS) и
+# максимальный срок размыкания после неудачных пробных запросов
+GEMINI_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("GEMINI_CIRCUIT_FAILURE_THRESHOLD", "3"))
+GEMINI_CIRCUIT_OPEN_SECONDS = float(os.getenv("GEMINI_CIRCUIT_OPEN_SECONDS", "30"))
+GEMINI_CIRCUIT_KEY_OPEN_SECONDS = float(os.getenv("GEMINI_CIRCUIT_KEY_OPEN_SECONDS", "300"))
+GEMINI_CIRCUIT_MAX_OPEN_SECONDS = float(os.getenv("GEMINI_CIRCUIT_MAX_OPEN_SECONDS", "600"))
+# Сколько секунд запрос сверх клиентского лимита (GEMINI_RATE_LIMITS) ждет в очереди, прежде чем будет отклонен
+GEMINI_RATE_WAIT_SECONDS = float(os.getenv("GEMINI_RATE_WAIT_SECONDS", "10"))
+# Потоковая генерация (streamGenerateContent): ответ показывается по мере поступления текста.
+# Сообщение с ответом редактируется не чаще раза в STREAM_EDIT_INTERVAL_SECONDS сек; при достижении
+# STREAM_MESSAGE_LIMIT символов (после экранирования MarkdownV2) продолжение уходит в новое сообщение
+# (лимит Telegram — 4096)
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "true").lower() == "true"
+STREAM_EDIT_INTERVAL_SECONDS = float(os.getenv("STREAM_EDIT_INTERVAL_SECONDS", "1.0"))
+STREAM_MESSAGE_LIMIT = int(os.getenv("STREAM_MESSAGE_LIMIT", "4000"))
 
 # --- Database Settings ---
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Хранилище данных: sqlite — рабочий режим; memory — все данные в памяти процесса и теряются при перезапуске
+# (для нагрузочных тестов и бенчмарков обработчиков без дискового ввода-вывода)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
 DATABASE_NAME = os.path.join(BASE_DIR, 'database', 'bot_database.db')
+# Пул соединений: число потоков-читателей (поток-писатель всегда один)
+DB_POOL_READERS = int(os.getenv("DB_POOL_READERS", "4"))
+# Групповая фиксация записи: максимум операций в одной транзакции и время ожидания пачки (мс)
+DB_WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "64"))
+DB_WRITE_LINGER_MS = float(os.getenv("DB_WRITE_LINGER_MS", "2"))
+# Кэш профилей пользователей: максимум записей и время жизни записи (сек)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))
+# Потоковое чтение больших выборок (рассылка, экспорт): строк в странице и страниц, читаемых заранее
+DB_STREAM_PAGE_SIZE = int(os.getenv("DB_STREAM_PAGE_SIZE", "500"))
+DB_STREAM_PREFETCH = int(os.getenv("DB_STREAM_PREFETCH", "2"))
+# Шардирование по пользователям: число файлов БД, по которым распределяются пользователи (у каждого свой писатель).
+# Изменение для существующей базы требует python -m database.maintenance reshard
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+# Профиль PRAGMA соединений: synchronous (NORMAL в режиме WAL не нарушает целостность, при сбое ОС теряются лишь
+# последние транзакции), кэш страниц (МБ на соединение и файл), отображение файла в память (МБ, 0 — выключено), temp_store
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE_MB = int(os.getenv("DB_CACHE_SIZE_MB", "16"))
+DB_MMAP_SIZE_MB = int(os.getenv("DB_MMAP_SIZE_MB", "256"))
+DB_TEMP_STORE = os.getenv("DB_TEMP_STORE", "MEMORY")
+# Контрольные точки WAL: порог автоматической контрольной точки (страниц, 0 — только фоновая задача),
+# период фоновой контрольной точки (сек, 0 — выключена), сколько секунд без записей считается простоем
+# (тогда выполняется TRUNCATE вместо PASSIVE) и период PRAGMA optimize (сек, 0 — выключено)
+DB_WAL_AUTOCHECKPOINT = int(os.getenv("DB_WAL_AUTOCHECKPOINT", "0"))
+DB_CHECKPOINT_INTERVAL_SECONDS = int(os.getenv("DB_CHECKPOINT_INTERVAL_SECONDS", "10"))
+DB_CHECKPOINT_IDLE_SECONDS = int(os.getenv("DB_CHECKPOINT_IDLE_SECONDS", "5"))
+DB_OPTIMIZE_INTERVAL_SECONDS = int(os.getenv("DB_OPTIMIZE_INTERVAL_SECONDS", "3600"))
+# Журнал медленных запросов: порог (мс, 0 — выключен), после которого запрос один раз пишется в лог с планом
+# EXPLAIN QUERY PLAN, и максимум различных запросов в статистике времени (раздел 'База данных' админ-панели)
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "100"))
+DB_QUERY_STATS_MAX = int(os.getenv("DB_QUERY_STATS_MAX", "500"))
+# Полнотекстовый поиск по истории (/search): результатов на одной странице
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "5"))
+# Холодный архив истории: файл архива, возраст сообщений для переноса (дни, 0 — архиватор выключен),
+# сколько последних сообщений каждого диалога всегда остается в основной базе, размер пачки (сообщений
+# и просматриваемых за одну транзакцию диалогов) и период запуска (сек)
+ARCHIVE_DATABASE_NAME = os.path.join(BASE_DIR, 'database', 'bot_archive.db')
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_KEEP_LAST = int(os.getenv("ARCHIVE_KEEP_LAST", "50"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+# Тексты сообщений от этого размера (байт UTF-8) хранятся в message_blobs: один раз на одинаковое содержимое, сжатыми
+MESSAGE_BLOB_MIN_BYTES = int(os.getenv("MESSAGE_BLOB_MIN_BYTES", "256"))
+# Политика хранения истории: максимальный возраст сообщений (дни) и максимум сообщений в диалоге (0 — без ограничения),
+# сообщений, удаляемых за одну транзакцию, и период запуска (сек)
+RETENTION_MAX_AGE_DAYS = int(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+RETENTION_MAX_MESSAGES_PER_DIALOG = int(os.getenv("RETENTION_MAX_MESSAGES_PER_DIALOG", "0"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+# Фоновое удаление истории удаленных диалогов: сообщений за одну транзакцию и период проверки (сек;
+# после удаления диалога задача запускается сразу)
+DIALOG_REAPER_BATCH_SIZE = int(os.getenv("DIALOG_REAPER_BATCH_SIZE", "500"))
+DIALOG_REAPER_INTERVAL_SECONDS = int(os.getenv("DIALOG_REAPER_INTERVAL_SECONDS", "300"))
+# Сколько свободных страниц возвращать файлу БД за одну транзакцию (PRAGMA incremental_vacuum)
+VACUUM_PAGES_PER_STEP = int(os.getenv("VACUUM_PAGES_PER_STEP", "500"))
+# Резервные копии БД (SQLite backup API): каталог снимков, сколько последних хранить, страниц за шаг копирования,
+# пауза между шагами (мс), сколько раз пошаговое копирование может начаться заново из-за записи в базу
+# (дальше схема копируется одним шагом) и период автоматического копирования (часы, 0 — только вручную из админ-панели)
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(BASE_DIR, 'backups'))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "1024"))
+BACKUP_STEP_SLEEP_MS = int(os.getenv("BACKUP_STEP_SLEEP_MS", "50"))
+BACKUP_MAX_RESTARTS = int(os.getenv("BACKUP_MAX_RESTARTS", "20"))
+BACKUP_INTERVAL_HOURS = int(os.getenv("BACKUP_INTERVAL_HOURS", "0"))
 
 # --- Gemini Model Configuration ---
 GENERATION_CONFIG = {
@@ -85,6 +187,22 @@ MODELS_METADATA = {
     "learnlm-2.0-flash-experimental": {"supports_search": False, "supports_system_instruction": False},
 }
 
+# Клиентские лимиты на пару (API-ключ, модель) по семействам моделей (префикс имени; выбирается самый
+# длинный совпавший, иначе "default"): запросов в минуту, токенов в минуту, одновременных запросов.
+# 0 — без ограничения. Квоты rpm/tpm зависят от уровня аккаунта, поэтому по умолчанию не ограничены
+# (их соблюдает Google, отвечая 429), а ограничено только число одновременных запросов.
+# Переопределяются JSON-объектом в переменной окружения GEMINI_RATE_LIMITS, который накладывается
+# поверх значений по умолчанию по семействам, например для бесплатного уровня:
+# {"default": {"rpm": 15, "tpm": 1000000}, "gemini-2.5-pro": {"rpm": 5, "tpm": 250000}}
+# Источник: https://ai.google.dev/gemini-api/docs/rate-limits
+GEMINI_RATE_LIMITS = {
+    "default": {"rpm": 0, "tpm": 0, "concurrency": 4},
+    "gemini-2.5-pro": {"rpm": 0, "tpm": 0, "concurrency": 2},
+    "gemini-1.5-pro": {"rpm": 0, "tpm": 0, "concurrency": 2},
+}
+for _family, _limits in json.loads(os.getenv("GEMINI_RATE_LIMITS") or "{}").items():
+    GEMINI_RATE_LIMITS[_family] = {**GEMINI_RATE_LIMITS.get(_family, GEMINI_RATE_LIMITS["default"]), **_limits}
+
 
 SAFETY_SETTINGS = [
     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
@@ -211,6 +329,8 @@ CALLBACK_DIALOG_RENAME_PREFIX = 'dialog_rename:'
 CALLBACK_DIALOG_DELETE_PREFIX = 'dialog_delete:'
 CALLBACK_DIALOG_CONFIRM_DELETE_PREFIX = 'dialog_confirm_delete:'
 CALLBACK_DIALOG_CREATE = 'dialog_create'
+# Search
+CALLBACK_SEARCH_PAGE_PREFIX = 'search_page:'
 
 # --- НОВЫЕ ПРЕФИКСЫ ДЛЯ АДМИН-ПАНЕЛИ ---
 CALLBACK_ADMIN_MAIN_MENU = 'admin_main_menu'
@@ -232,6 +352,10 @@ CALLBACK_ADMIN_RESET_API_KEY_PREFIX = 'admin_reset_api_key:'
 CALLBACK_ADMIN_STATS_MENU = 'admin_stats_menu'
 # Export
 CALLBACK_ADMIN_EXPORT_USERS = 'admin_export_users'
+# Database
+CALLBACK_ADMIN_DATABASE_MENU = 'admin_database_menu'
+CALLBACK_ADMIN_BACKUP_NOW = 'admin_backup_now'
+CALLBACK_ADMIN_QUERY_STATS = 'admin_query_stats'
 
 
 # --- User States ---
@@ -0,0 +1,295 @@
+# File: database/archive.py
+"""
+Холодный архив истории сообщений.
+
+Сообщения старше заданного возраста (кроме последних в каждом диалоге, которые
+нужны для контекста модели) переносятся из `conversations` в отдельный файл БД.
+Он подключается ко всем соединениям как схема `archive` (ATTACH), поэтому архив
+читается и пишется теми же соединениями пула, что и основная база.
+
+В архиве сообщения хранятся сжатыми блоками: один блок — часть истории одного
+диалога за один день (UTC). Повторный проход архиватора по тому же дню
+добавляет новый блок с очередным `seq`.
+
+Архив тоже доступен поиску: триггеры `conversation_blocks` ведут таблицу
+`archived_messages` (где лежит каждое сообщение и кому оно принадлежит) и
+индекс FTS5 `archived_messages_fts` без хранения текста (content=''), чтобы
+не дублировать сжатые данные. Триггеры распаковывают блоки SQL-функцией
+`decode_archive_block(codec, data)` — ее регистрирует `register_functions`
+на каждом соединении. Фрагменты с подсветкой для найденных архивных
+сообщений строятся по распакованному тексту (см. `search_sync`).
+
+В режиме WAL транзакция над несколькими файлами фиксируется атомарно только
+для каждого файла в отдельности: после сбоя сообщение может оказаться и в
+архиве, и в `conversations`. Читатели истории убирают такие дубликаты по
+`conversation_id`.
+"""
+import datetime
+import itertools
+import json
+import sqlite3
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from logger_config import get_logger
+
+archive_logger = get_logger('database', user_id='System')
+
+SCHEMA = 'archive'
+CODEC_ZLIB = 'zlib'
+
+# Поля сообщения, сохраняемые в блоке
+_MESSAGE_FIELDS = ('conversation_id', 'user_id', 'role', 'message_text',
+                   'prompt_tokens', 'completion_tokens', 'total_tokens', 'model', 'ts')
+
+
+# Токенизатор поиска — тот же, что у conversations_fts
+_FTS_TOKENIZE = 'unicode61 remove_diacritics 2'
+
+# Сообщения блока (new/old) как строки json_each: value — объект сообщения
+_BLOCK_MESSAGES = "json_each(decode_archive_block({row}.codec, {row}.data))"
+
+
+def register_functions(conn: sqlite3.Connection):
+    """Регистрирует на соединении SQL-функцию `decode_archive_block`, нужную триггерам индекса архива."""
+    conn.create_function('decode_archive_block', 2,
+                         lambda codec, data: json.dumps(decode_block(codec, data), ensure_ascii=False),
+                         deterministic=True)
+
+
+def attach(conn: sqlite3.Connection, path: str):
+    """Подключает файл архива к соединению как схему `archive`."""
+    conn.execute(f"ATTACH DATABASE ? AS {SCHEMA}", (path,))
+    # Новый файл архива сразу создается в режиме auto_vacuum=INCREMENTAL (до первой таблицы и перехода в WAL)
+    conn.execute(f"PRAGMA {SCHEMA}.auto_vacuum = INCREMENTAL")
+
+
+def ensure_schema(conn: sqlite3.Connection):
+    """Создает таблицу блоков архива, если ее еще нет (архив подключен через `attach`; см. миграцию 9)."""
+    conn.execute(f"PRAGMA {SCHEMA}.journal_mode=WAL")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SCHEMA}.conversation_blocks (
+            block_id INTEGER PRIMARY KEY,
+            dialog_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            first_ts INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            UNIQUE (dialog_id, day, seq)
+        )""")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {SCHEMA}.idx_blocks_user ON conversation_blocks (user_id)")
+    _ensure_search_index(conn)
+
+
+def _ensure_search_index(conn: sqlite3.Connection):
+    """Создает поисковый индекс архива и его триггеры; при создании индексирует уже существующие блоки."""
+    if conn.execute(f"SELECT 1 FROM {SCHEMA}.sqlite_master WHERE name = 'archived_messages'").fetchone():
+        return
+    new_messages, old_messages = _BLOCK_MESSAGES.format(row='new'), _BLOCK_MESSAGES.format(row='old')
+    # Сообщение, попавшее в архив повторно (после сбоя между файлами), индексируется один раз — по первому блоку
+    index_new = f"""
+        INSERT INTO archived_messages_fts (rowid, message_text)
+        SELECT json_extract(value, '$.conversation_id'), json_extract(value, '$.message_text') FROM {new_messages}
+        WHERE json_extract(value, '$.conversation_id') NOT IN (SELECT conversation_id FROM archived_messages);
+        INSERT OR IGNORE INTO archived_messages (conversation_id, block_id, user_id, dialog_id, role, ts)
+        SELECT json_extract(value, '$.conversation_id'), new.block_id, new.user_id, new.dialog_id,
+               json_extract(value, '$.role'), json_extract(value, '$.ts') FROM {new_messages};
+    """
+    # Индексу без хранения текста для удаления нужен тот же текст, что был проиндексирован
+    unindex_old = f"""
+        INSERT INTO archived_messages_fts (archived_messages_fts, rowid, message_text)
+        SELECT 'delete', json_extract(value, '$.conversation_id'), json_extract(value, '$.message_text') FROM {old_messages}
+        WHERE json_extract(value, '$.conversation_id') IN (SELECT conversation_id FROM archived_messages WHERE block_id = old.block_id);
+        DELETE FROM archived_messages WHERE block_id = old.block_id;
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(f"""
+            CREATE TABLE {SCHEMA}.archived_messages (
+                conversation_id INTEGER PRIMARY KEY,
+                block_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                dialog_id INTEGER NOT NULL,
+                role TEXT,
+                ts INTEGER
+            )""")
+        conn.execute(f"CREATE INDEX {SCHEMA}.idx_archived_messages_block ON archived_messages (block_id)")
+        conn.execute(f"CREATE INDEX {SCHEMA}.idx_archived_messages_user ON archived_messages (user_id)")
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE {SCHEMA}.archived_messages_fts USING fts5(
+                message_text, content='', tokenize='{_FTS_TOKENIZE}'
+            )""")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {SCHEMA}.conversation_blocks_ai AFTER INSERT ON conversation_blocks BEGIN {index_new} END")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {SCHEMA}.conversation_blocks_ad AFTER DELETE ON conversation_blocks BEGIN {unindex_old} END")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {SCHEMA}.conversation_blocks_au AFTER UPDATE OF data ON conversation_blocks "
+                     f"BEGIN {unindex_old} {index_new} END")
+        # Уже заархивированные блоки индексируются повторной записью тех же данных через триггер обновления
+        indexed = conn.execute(f"UPDATE {SCHEMA}.conversation_blocks SET data = data").rowcount
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+    if indexed:
+        archive_logger.info(f"Поисковый индекс архива построен: блоков {indexed}.")
+
+
+def encode_block(messages: List[Dict[str, Any]]) -> bytes:
+    """Сериализует сообщения блока в JSON и сжимает zlib."""
+    payload = json.dumps([{name: message[name] for name in _MESSAGE_FIELDS} for message in messages],
+                         ensure_ascii=False, separators=(',', ':'))
+    return zlib.compress(payload.encode('utf-8'), 6)
+
+
+def decode_block(codec: str, data: bytes) -> List[Dict[str, Any]]:
+    """Распаковывает блок архива в список сообщений."""
+    if codec != CODEC_ZLIB:
+        raise ValueError(f"Неизвестный кодек блока архива: {codec}")
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def utc_day(ts: int) -> str:
+    """Возвращает день (UTC, 'YYYY-MM-DD') для времени в секундах Unix."""
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime('%Y-%m-%d')
+
+
+def archive_batch_sync(conn: sqlite3.Connection, cutoff_ts: int, keep_last: int, batch_size: int,
+                       from_dialog_id: int = 0) -> Tuple[int, Optional[int]]:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Переносит в архив до `batch_size` сообщений старше `cutoff_ts`,
+    не трогая последние `keep_last` сообщений каждого диалога. Выполняется писателем пула
+    внутри его транзакции. Счетчики сообщений в users/dialogs не меняются: они учитывают оба уровня.
+
+    Диалоги обходятся по возрастанию ID, начиная с `from_dialog_id`, и не больше `batch_size` за вызов;
+    для каждого — два чтения по индексу (dialog_id, ts), так что время вызова не зависит от размера
+    conversations. Полный проход — вызовы с возвращаемым курсором, пока он не станет None.
+
+    Returns:
+        (количество перенесенных сообщений, ID диалога, с которого продолжить, или None — проход завершен).
+    """
+    dialog_ids = [row[0] for row in conn.execute(
+        "SELECT dialog_id FROM dialogs WHERE dialog_id >= ? AND deleted_at IS NULL ORDER BY dialog_id LIMIT ?",
+        (from_dialog_id, batch_size + 1))]
+    next_dialog_id = dialog_ids[batch_size] if len(dialog_ids) > batch_size else None
+    rows: List[sqlite3.Row] = []
+    for dialog_id in dialog_ids[:batch_size]:
+        # Самое старое из сохраняемых сообщений; переносятся только более старые (по ts, затем по ID)
+        kept = conn.execute("""
+            SELECT ts, conversation_id FROM conversations WHERE dialog_id = ?
+            ORDER BY ts DESC, conversation_id DESC LIMIT 1 OFFSET ?
+        """, (dialog_id, max(1, keep_last) - 1)).fetchone()
+        if kept is None or kept['ts'] is None:
+            continue
+        rows += conn.execute("""
+            SELECT conversation_id, user_id, dialog_id, role, message_text,
+                   prompt_tokens, completion_tokens, total_tokens, model, ts
+            FROM conversations_text
+            WHERE dialog_id = ? AND ts < ? AND (ts, conversation_id) < (?, ?)
+            ORDER BY ts, conversation_id
+            LIMIT ?
+        """, (dialog_id, cutoff_ts, kept['ts'], kept['conversation_id'], batch_size - len(rows))).fetchall()
+        if len(rows) >= batch_size:
+            # В диалоге могли остаться старые сообщения: следующий вызов начнет с него же
+            next_dialog_id = dialog_id
+            break
+    if not rows:
+        return 0, next_dialog_id
+
+    for (dialog_id, day), group in itertools.groupby(rows, key=lambda row: (row['dialog_id'], utc_day(row['ts']))):
+        messages = list(group)
+        conn.execute(f"""
+            INSERT INTO {SCHEMA}.conversation_blocks
+                (dialog_id, day, seq, user_id, first_ts, last_ts, message_count, codec, data)
+            SELECT ?, ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ?, ?, ?
+            FROM {SCHEMA}.conversation_blocks WHERE dialog_id = ? AND day = ?
+        """, (dialog_id, day, messages[0]['user_id'], messages[0]['ts'], messages[-1]['ts'], len(messages),
+              CODEC_ZLIB, encode_block(messages), dialog_id, day))
+    conn.execute("DELETE FROM conversations WHERE conversation_id IN (SELECT value FROM json_each(?))",
+                 (json.dumps([row['conversation_id'] for row in rows]),))
+    return len(rows), next_dialog_id
+
+
+def read_day_sync(conn: sqlite3.Connection, dialog_id: int, day: str) -> List[Dict[str, Any]]:
+    """(СИНХРОННАЯ ФУНКЦИЯ) Возвращает архивные сообщения диалога за день (UTC, 'YYYY-MM-DD')."""
+    messages: List[Dict[str, Any]] = []
+    for row in conn.execute(f"""
+        SELECT codec, data FROM {SCHEMA}.conversation_blocks WHERE dialog_id = ? AND day = ? ORDER BY seq
+    """, (dialog_id, day)):
+        messages.extend(decode_block(row['codec'], row['data']))
+    return messages
+
+
+def read_block_sync(conn: sqlite3.Connection, block_id: int) -> List[Dict[str, Any]]:
+    """(СИНХРОННАЯ ФУНКЦИЯ) Возвращает сообщения одного блока в порядке их отправки."""
+    row = conn.execute(f"SELECT codec, data FROM {SCHEMA}.conversation_blocks WHERE block_id = ?",
+                       (block_id,)).fetchone()
+    return decode_block(row['codec'], row['data']) if row else []
+
+
+def rewrite_block_sync(conn: sqlite3.Connection, block_id: int, messages: List[Dict[str, Any]]):
+    """(СИНХРОННАЯ ФУНКЦИЯ) Заменяет содержимое блока оставшимися сообщениями (пустой блок удаляется)."""
+    if not messages:
+        conn.execute(f"DELETE FROM {SCHEMA}.conversation_blocks WHERE block_id = ?", (block_id,))
+        return
+    conn.execute(f"""
+        UPDATE {SCHEMA}.conversation_blocks
+        SET first_ts = ?, last_ts = ?, message_count = ?, codec = ?, data = ?
+        WHERE block_id = ?
+    """, (messages[0]['ts'], messages[-1]['ts'], len(messages), CODEC_ZLIB, encode_block(messages), block_id))
+
+
+def iterate_messages_sync(conn: sqlite3.Connection) -> Iterator[Dict[str, Any]]:
+    """(СИНХРОННАЯ ФУНКЦИЯ) Перебирает все архивные сообщения, распаковывая блоки по одному."""
+    for row in conn.execute(f"SELECT dialog_id, codec, data FROM {SCHEMA}.conversation_blocks"):
+        for message in decode_block(row['codec'], row['data']):
+            message['dialog_id'] = row['dialog_id']
+            yield message
+
+
+def search_sync(conn: sqlite3.Connection, fts_query: str, user_id: int, dialog_id: Optional[int], limit: int,
+                highlight: tuple) -> List[Dict[str, Any]]:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Ищет архивные сообщения пользователя по запросу FTS5 (в порядке релевантности).
+    Результаты — как у поиска по основной базе, плюс rank. Индекс не хранит текст, поэтому фрагмент с
+    подсветкой строится по распакованным блокам во временном индексе в памяти с тем же токенизатором.
+
+    Args:
+        highlight: Маркеры начала и конца совпадения во фрагменте.
+    """
+    dialog_filter = " AND m.dialog_id = ?" if dialog_id is not None else ""
+    params: tuple = (fts_query, user_id) + ((dialog_id,) if dialog_id is not None else ()) + (limit,)
+    rows = conn.execute(f"""
+        SELECT m.conversation_id, m.dialog_id, d.name AS dialog_name, m.role, m.ts, m.block_id, rank
+        FROM {SCHEMA}.archived_messages_fts
+        JOIN {SCHEMA}.archived_messages m ON m.conversation_id = archived_messages_fts.rowid
+        JOIN dialogs d ON d.dialog_id = m.dialog_id
+        WHERE archived_messages_fts MATCH ? AND m.user_id = ? AND d.deleted_at IS NULL{dialog_filter}
+        ORDER BY rank
+        LIMIT ?
+    """, params).fetchall()
+    if not rows:
+        return []
+
+    wanted = {row['conversation_id'] for row in rows}
+    texts = {}
+    for block_id in {row['block_id'] for row in rows}:
+        for message in read_block_sync(conn, block_id):
+            if message['conversation_id'] in wanted:
+                texts[message['conversation_id']] = message['message_text'] or ''
+    memory = sqlite3.connect(':memory:')
+    try:
+        memory.execute(f"CREATE VIRTUAL TABLE found USING fts5(message_text, tokenize='{_FTS_TOKENIZE}')")
+        memory.executemany("INSERT INTO found (rowid, message_text) VALUES (?, ?)", texts.items())
+        snippets = dict(memory.execute("SELECT rowid, snippet(found, 0, ?, ?, '…', 12) FROM found WHERE found MATCH ?",
+                                       (highlight[0], highlight[1], fts_query)).fetchall())
+    finally:
+        memory.close()
+    results = []
+    for row in rows:
+        result = {key: row[key] for key in ('conversation_id', 'dialog_id', 'dialog_name', 'role', 'ts', 'rank')}
+        result['snippet'] = snippets.get(row['conversation_id'], '')
+        results.append(result)
+    return results
@@ -0,0 +1,123 @@
+# File: database/backup.py
+"""
+Резервное копирование работающей базы через SQLite backup API.
+
+Копия снимается с отдельного соединения по `pages` страниц за шаг с паузой
+между шагами (через колбэк progress: аргумент sleep у Connection.backup
+действует только при SQLITE_BUSY/LOCKED), так что копирование не забирает
+диск и блокировку чтения у бота надолго. Запись в базу через другое
+соединение перезапускает пошаговое копирование с начала; если перезапусков
+больше `max_restarts`, схема докопируется одним шагом — в режиме WAL он
+держит только блокировку чтения и писателей не останавливает. Основная база и
+архив (всех шардов) копируются в общий каталог снимка `<BACKUP_DIR>/<YYYYmmdd-HHMMSS>/`.
+Снимок сначала собирается во временном каталоге и получает окончательное
+имя только после успешной проверки `PRAGMA integrity_check`; хранятся
+`keep` последних снимков.
+"""
+import datetime
+import os
+import re
+import shutil
+import sqlite3
+import time
+from typing import Any, Dict, List, Sequence, Tuple
+
+from logger_config import get_logger
+
+backup_logger = get_logger('database', user_id='System')
+
+# Имя снимка: время UTC и, если за ту же секунду снимков было несколько, порядковый номер
+_SNAPSHOT_NAME = re.compile(r'^\d{8}-\d{6}(-\d+)?$')
+
+
+class BackupError(Exception):
+    """Снимок не создан или не прошел проверку целостности."""
+
+
+class _TooManyRestarts(Exception):
+    """Пошаговое копирование слишком часто начиналось заново из-за записи в источник."""
+
+
+def _copy_schema(source: sqlite3.Connection, schema: str, path: str, pages: int, sleep: float, max_restarts: int):
+    """Копирует схему `schema` соединения-источника в файл `path` и проверяет копию."""
+    state = {'remaining': None, 'restarts': 0}
+
+    def progress(status: int, remaining: int, total: int):
+        # После перезапуска копирование идет с первой страницы: осталось не меньше, чем до шага
+        if state['remaining'] is not None and remaining >= state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > max_restarts:
+                raise _TooManyRestarts()
+        state['remaining'] = remaining
+        if remaining and sleep > 0:
+            time.sleep(sleep)
+
+    dest = sqlite3.connect(path)
+    try:
+        try:
+            source.backup(dest, pages=pages, name=schema, progress=progress)
+        except _TooManyRestarts:
+            backup_logger.warning(f"Копирование '{schema}' перезапускалось из-за записи {state['restarts']} раз: "
+                                  f"докопируем одним шагом.")
+            source.backup(dest, pages=-1, name=schema)
+        # Снимок должен быть одним самодостаточным файлом, без -wal/-shm
+        dest.execute("PRAGMA journal_mode=DELETE")
+        result = dest.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        dest.close()
+    if result != 'ok':
+        raise BackupError(f"Копия '{schema}' не прошла integrity_check: {result}")
+
+
+def rotate(backup_dir: str, keep: int) -> List[str]:
+    """Удаляет старые снимки, оставляя `keep` последних. Возвращает имена удаленных."""
+    snapshots = sorted(name for name in os.listdir(backup_dir)
+                       if _SNAPSHOT_NAME.match(name) and os.path.isdir(os.path.join(backup_dir, name)))
+    removed = snapshots[:-keep] if keep > 0 else []
+    for name in removed:
+        shutil.rmtree(os.path.join(backup_dir, name), ignore_errors=True)
+    return removed
+
+
+def run_backup_sync(sources: Sequence[Tuple[sqlite3.Connection, Dict[str, str]]], backup_dir: str, keep: int,
+                    pages: int, sleep: float, max_restarts: int) -> Dict[str, Any]:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Создает проверенный снимок и удаляет устаревшие.
+
+    Args:
+        sources: Пары (соединение-источник, схема -> имя файла копии в каталоге снимка).
+        backup_dir: Каталог для снимков.
+        keep: Сколько последних снимков хранить.
+        pages: Страниц за один шаг копирования.
+        sleep: Пауза между шагами, сек.
+        max_restarts: Сколько перезапусков пошагового копирования схемы допустимо до копирования одним шагом.
+
+    Returns:
+        Словарь с путем снимка, суммарным размером файлов (байт) и длительностью (сек).
+    """
+    started = time.perf_counter()
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d-%H%M%S')
+    os.makedirs(backup_dir, exist_ok=True)
+    name, attempt = stamp, 0
+    while os.path.exists(os.path.join(backup_dir, name)):
+        attempt += 1
+        name = f"{stamp}-{attempt}"
+    partial_dir = os.path.join(backup_dir, f".{name}.partial")
+    final_dir = os.path.join(backup_dir, name)
+    os.makedirs(partial_dir)
+    try:
+        size = 0
+        for source, files in sources:
+            for schema, file_name in files.items():
+                path = os.path.join(partial_dir, file_name)
+                _copy_schema(source, schema, path, pages, sleep, max_restarts)
+                size += os.path.getsize(path)
+        os.rename(partial_dir, final_dir)
+    except Exception:
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        raise
+    removed = rotate(backup_dir, keep)
+    duration = round(time.perf_counter() - started, 2)
+    backup_logger.info(f"Резервная копия создана: {final_dir} ({size} байт, {duration} с). "
+                       f"Удалено старых снимков: {len(removed)}.")
+    return {'path': final_dir, 'size': size, 'duration_s': duration}
@@ -0,0 +1,323 @@
+# File: database/connection_pool.py
+"""
+Пул долгоживущих соединений SQLite.
+
+Каждое соединение принадлежит своему выделенному потоку: N потоков-читателей
+разбирают общую очередь запросов на чтение, а единственный поток-писатель
+выполняет все операции записи. Соединения открываются один раз при старте
+пула и переиспользуются, поэтому PRAGMA и прогрев кэша страниц не повторяются
+на каждый запрос.
+
+Писатель применяет групповую фиксацию (group commit): забирает из очереди
+пачку операций (не больше `write_batch_max`, дожидаясь новых не дольше
+`write_linger_ms`), выполняет каждую в своей точке сохранения (SAVEPOINT)
+и фиксирует всю пачку одним COMMIT. Ошибка одной операции откатывает только ее.
+
+Служебные операции, которые нельзя выполнять внутри транзакции (контрольная
+точка WAL, PRAGMA optimize), ставятся в ту же очередь писателя с
+`transaction=False` и выполняются им между пачками.
+"""
+import asyncio
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from logger_config import get_logger
+
+pool_logger = get_logger('database', user_id='System')
+
+# Маркер остановки рабочего потока
+_STOP = object()
+
+
+class _Job:
+    """Задание для рабочего потока: функция от соединения и future для результата."""
+    __slots__ = ('fn', 'loop', 'future', 'enqueued_at', 'transaction')
+
+    def __init__(self, fn: Callable[[sqlite3.Connection], Any], loop: asyncio.AbstractEventLoop,
+                 future: asyncio.Future, transaction: bool = True):
+        self.fn = fn
+        self.loop = loop
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+        self.transaction = transaction
+
+
+def _resolve_future(future: asyncio.Future, result: Any = None, error: Optional[BaseException] = None):
+    """Устанавливает результат future в потоке event loop (если он еще ждет)."""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def _deliver(job: _Job, result: Any = None, error: Optional[BaseException] = None):
+    """
+    Передает результат задания в его event loop. Если loop уже закрыт (остановка бота, CLI после
+    asyncio.run), результат некому получить: он отбрасывается, а поток пула продолжает работу.
+    """
+    try:
+        job.loop.call_soon_threadsafe(_resolve_future, job.future, result, error)
+    except RuntimeError:
+        pool_logger.debug("Event loop задания закрыт: результат операции с БД отброшен.", extra={'user_id': 'System'})
+
+
+class ConnectionPool:
+    """
+    Пул из N соединений-читателей и одного соединения-писателя.
+
+    Args:
+        connect: Фабрика соединений. Вызывается внутри потока, который будет владеть соединением.
+        readers: Количество потоков-читателей.
+        write_batch_max: Максимальное число операций записи в одной транзакции.
+        write_linger_ms: Сколько писатель ждет новые операции, прежде чем зафиксировать пачку.
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection], readers: int = 4,
+                 write_batch_max: int = 64, write_linger_ms: float = 2.0):
+        self._connect = connect
+        self._readers = max(1, readers)
+        self._write_batch_max = max(1, write_batch_max)
+        self._write_linger = max(0.0, write_linger_ms) / 1000
+        self._read_queue: queue.Queue = queue.Queue()
+        self._write_queue: queue.Queue = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._started = False
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {
+            role: {'checkouts': 0, 'busy': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for role in ('reader', 'writer')
+        }
+        self._batch_stats: Dict[str, float] = {'batches': 0, 'failed': 0, 'commit_total': 0.0}
+        # Когда писатель последний раз зафиксировал пачку (для определения простоя)
+        self._last_write_at = time.perf_counter()
+
+    # --- Жизненный цикл ---
+
+    def start(self):
+        """Запускает рабочие потоки и ждет, пока каждый откроет свое соединение."""
+        if self._started:
+            return
+        workers = [(self._reader_loop, f"db-reader-{i}") for i in range(self._readers)]
+        workers.append((self._writer_loop, "db-writer"))
+
+        startup_errors: List[BaseException] = []
+        ready_events = []
+        for loop_fn, name in workers:
+            ready = threading.Event()
+            thread = threading.Thread(
+                target=self._worker, args=(loop_fn, ready, startup_errors), name=name, daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+            ready_events.append(ready)
+        for ready in ready_events:
+            ready.wait()
+
+        self._started = True
+        if startup_errors:
+            self.close()
+            raise startup_errors[0]
+        pool_logger.info(f"Пул соединений запущен: читателей {self._readers}, писателей 1.")
+
+    def close(self):
+        """Останавливает рабочие потоки и закрывает их соединения."""
+        if not self._started:
+            return
+        for _ in range(self._readers):
+            self._read_queue.put(_STOP)
+        self._write_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+        self._started = False
+        pool_logger.info(f"Пул соединений остановлен. Статистика: {self.stats()}")
+
+    # --- Выполнение заданий ---
+
+    def submit(self, fn: Callable[[sqlite3.Connection], Any], write: bool = False,
+               transaction: bool = True) -> asyncio.Future:
+        """
+        Ставит `fn(conn)` в очередь и сразу возвращает future с ее результатом.
+
+        Операция записи выполняется внутри транзакции писателя, поэтому `fn` не должна
+        сама открывать или фиксировать транзакцию. Ее future завершается только после
+        COMMIT пачки, в которую попала операция.
+
+        Args:
+            fn: Синхронная функция, получающая соединение.
+            write: True — выполнить на соединении-писателе, иначе на любом из читателей.
+            transaction: Только для записи: False — выполнить вне транзакции, отдельно от пачек
+                (для служебных операций вроде контрольной точки WAL).
+        """
+        if not self._started:
+            raise RuntimeError("Пул соединений не запущен.")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        (self._write_queue if write else self._read_queue).put(_Job(fn, loop, future, transaction))
+        return future
+
+    async def run(self, fn: Callable[[sqlite3.Connection], Any], write: bool = False,
+                  transaction: bool = True) -> Any:
+        """Выполняет `fn(conn)` в потоке, владеющем соединением, и возвращает результат (см. `submit`)."""
+        return await self.submit(fn, write=write, transaction=transaction)
+
+    def writer_idle_seconds(self) -> float:
+        """Сколько секунд писатель не фиксировал пачек (0, если он занят или в очереди есть записи)."""
+        with self._stats_lock:
+            if self._stats['writer']['busy'] or not self._write_queue.empty():
+                return 0.0
+            return time.perf_counter() - self._last_write_at
+
+    def _worker(self, loop_fn: Callable[[sqlite3.Connection], None], ready: threading.Event,
+                startup_errors: List[BaseException]):
+        """Рабочий поток: открывает свое соединение и передает его циклу обработки заданий."""
+        try:
+            conn = self._connect()
+        except BaseException as e:
+            startup_errors.append(e)
+            ready.set()
+            return
+        ready.set()
+        try:
+            loop_fn(conn)
+        finally:
+            conn.close()
+
+    def _reader_loop(self, conn: sqlite3.Connection):
+        """Цикл читателя: выполняет задания по одному."""
+        while True:
+            job = self._read_queue.get()
+            if job is _STOP:
+                break
+            self._checkout('reader', [job])
+            result, error = None, None
+            try:
+                result = job.fn(conn)
+            except BaseException as e:
+                error = e
+            self._release('reader')
+            _deliver(job, result, error)
+
+    def _writer_loop(self, conn: sqlite3.Connection):
+        """Цикл писателя: собирает операции в пачки и фиксирует каждую пачку одной транзакцией."""
+        stopping = False
+        # Служебное задание, встреченное при сборе пачки: выполняется сразу после нее
+        pending: Optional[_Job] = None
+        while not stopping:
+            job = pending if pending is not None else self._write_queue.get()
+            pending = None
+            if job is _STOP:
+                break
+            if not job.transaction:
+                self._run_outside_transaction(conn, job)
+                continue
+            batch = [job]
+            deadline = time.perf_counter() + self._write_linger
+            while len(batch) < self._write_batch_max:
+                timeout = deadline - time.perf_counter()
+                try:
+                    if timeout > 0:
+                        next_job = self._write_queue.get(timeout=timeout)
+                    else:
+                        next_job = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if next_job is _STOP:
+                    stopping = True
+                    break
+                if not next_job.transaction:
+                    pending = next_job
+                    break
+                batch.append(next_job)
+            self._run_write_batch(conn, batch)
+
+    def _run_outside_transaction(self, conn: sqlite3.Connection, job: _Job):
+        """Выполняет служебное задание писателя вне транзакции (в метриках записи не учитывается)."""
+        result, error = None, None
+        try:
+            result = job.fn(conn)
+        except BaseException as e:
+            error = e
+        _deliver(job, result, error)
+
+    def _run_write_batch(self, conn: sqlite3.Connection, batch: List[_Job]):
+        """Выполняет пачку операций записи в одной транзакции и разрешает их future после COMMIT."""
+        self._checkout('writer', batch)
+        started = time.perf_counter()
+        outcomes = []
+        failed = False
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for job in batch:
+                conn.execute('SAVEPOINT write_job')
+                try:
+                    result = job.fn(conn)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write_job')
+                    conn.execute('RELEASE write_job')
+                    outcomes.append((job, None, e))
+                else:
+                    conn.execute('RELEASE write_job')
+                    outcomes.append((job, result, None))
+            conn.execute('COMMIT')
+        except Exception as e:
+            # Пачка не зафиксирована: ни одна из ее операций не применена
+            failed = True
+            pool_logger.exception(f"Ошибка фиксации пачки из {len(batch)} операций записи: {e}")
+            if conn.in_transaction:
+                try:
+                    conn.execute('ROLLBACK')
+                except sqlite3.Error as rb_err:
+                    pool_logger.error(f"Ошибка при откате пачки записи: {rb_err}")
+            outcomes = [(job, None, e) for job in batch]
+        with self._stats_lock:
+            self._batch_stats['batches'] += 1
+            self._batch_stats['failed'] += int(failed)
+            self._batch_stats['commit_total'] += time.perf_counter() - started
+            self._last_write_at = time.perf_counter()
+        self._release('writer')
+        for job, result, error in outcomes:
+            _deliver(job, result, error)
+
+    def _checkout(self, role: str, jobs: List[_Job]):
+        now = time.perf_counter()
+        role_stats = self._stats[role]
+        with self._stats_lock:
+            role_stats['busy'] += 1
+            for job in jobs:
+                wait = now - job.enqueued_at
+                role_stats['checkouts'] += 1
+                role_stats['wait_total'] += wait
+                role_stats['wait_max'] = max(role_stats['wait_max'], wait)
+
+    def _release(self, role: str):
+        with self._stats_lock:
+            self._stats[role]['busy'] -= 1
+
+    # --- Метрики ---
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает снимок метрик пула: размер, число выдач соединений, время ожидания и пачки записи."""
+        with self._stats_lock:
+            snapshot = {role: dict(values) for role, values in self._stats.items()}
+            batches = dict(self._batch_stats)
+        result: Dict[str, Any] = {'readers': self._readers, 'writers': 1}
+        queues = {'reader': self._read_queue, 'writer': self._write_queue}
+        for role, values in snapshot.items():
+            checkouts = int(values['checkouts'])
+            result[f'{role}_checkouts'] = checkouts
+            result[f'{role}_busy'] = int(values['busy'])
+            result[f'{role}_queued'] = queues[role].qsize()
+            result[f'{role}_wait_avg_ms'] = round(values['wait_total'] / checkouts * 1000, 2) if checkouts else 0.0
+            result[f'{role}_wait_max_ms'] = round(values['wait_max'] * 1000, 2)
+        batch_count = int(batches['batches'])
+        result['write_batches'] = batch_count
+        result['write_batches_failed'] = int(batches['failed'])
+        result['write_batch_avg'] = round(result['writer_checkouts'] / batch_count, 2) if batch_count else 0.0
+        result['write_commit_avg_ms'] = round(batches['commit_total'] / batch_count * 1000, 2) if batch_count else 0.0
+        return result
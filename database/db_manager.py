@@ -1,45 +1,192 @@
 # File: database/db_manager.py
 import sqlite3
 import asyncio
+import contextlib
 import datetime
-from typing import List, Tuple, Optional, Dict, Any
+import functools
+import heapq
+import json
+import os
+import re
+import time
+from typing import List, Tuple, Optional, Dict, Any, Callable, AsyncIterator
+from cachetools import LRUCache
 
 from logger_config import get_logger
-from config.settings import DATABASE_NAME, DEFAULT_MODEL_ID
+from config.settings import (
+    DATABASE_NAME, DEFAULT_MODEL_ID, DB_POOL_READERS, DB_WRITE_BATCH_MAX, DB_WRITE_LINGER_MS,
+    USER_CACHE_SIZE, USER_CACHE_TTL, DB_STREAM_PAGE_SIZE, DB_STREAM_PREFETCH,
+    ARCHIVE_DATABASE_NAME, ARCHIVE_AFTER_DAYS, ARCHIVE_KEEP_LAST, ARCHIVE_BATCH_SIZE, ARCHIVE_INTERVAL_SECONDS,
+    MESSAGE_BLOB_MIN_BYTES, RETENTION_MAX_AGE_DAYS, RETENTION_MAX_MESSAGES_PER_DIALOG, RETENTION_BATCH_SIZE,
+    RETENTION_INTERVAL_SECONDS, VACUUM_PAGES_PER_STEP, BACKUP_DIR, BACKUP_KEEP, BACKUP_PAGES_PER_STEP,
+    BACKUP_STEP_SLEEP_MS, BACKUP_MAX_RESTARTS, BACKUP_INTERVAL_HOURS, DB_SYNCHRONOUS, DB_CACHE_SIZE_MB, DB_MMAP_SIZE_MB, DB_TEMP_STORE,
+    DB_WAL_AUTOCHECKPOINT, DB_CHECKPOINT_INTERVAL_SECONDS, DB_CHECKPOINT_IDLE_SECONDS, DB_OPTIMIZE_INTERVAL_SECONDS,
+    DB_SHARDS, DB_SLOW_QUERY_MS, DB_QUERY_STATS_MAX, DIALOG_REAPER_BATCH_SIZE, DIALOG_REAPER_INTERVAL_SECONDS
+)
 from utils import crypto_helpers
 from handlers import telegram_helpers as tg_helpers
+from .connection_pool import ConnectionPool
+from .user_cache import UserProfile, UserProfileCache
+from .unit_of_work import UnitOfWork, UnitAborted
+from . import migrations
+from . import archive
+from . import message_blobs
+from . import retention
+from . import backup
+from . import pragmas
+from . import sharding
+from . import query_stats
+from . import dialog_reaper
 
 db_logger = get_logger('database', user_id='System')
-db_lock = asyncio.Lock()  # Используем asyncio.Lock
-
-def _get_db_connection() -> sqlite3.Connection:
-    """Устанавливает соединение с базой данных SQLite."""
+# Пулы соединений по номерам шардов (при DB_SHARDS = 1 — единственный пул шарда 0)
+_pools: Dict[int, ConnectionPool] = {}
+# Время выполнения SQL-запросов всех соединений (см. query_stats)
+_query_stats = query_stats.QueryStats(slow_ms=DB_SLOW_QUERY_MS, max_statements=DB_QUERY_STATS_MAX)
+_user_cache = UserProfileCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# Последние увиденные (username, first_name, last_name) пользователя: совпадение означает, что писать нечего
+_identity_fingerprints: LRUCache = LRUCache(maxsize=USER_CACHE_SIZE)
+# Фоновые задачи обслуживания БД (запускаются в setup_database, отменяются в close_database)
+_background_tasks: List[asyncio.Task] = []
+_archive_stats: Dict[str, Any] = {'runs': 0, 'moved_total': 0, 'last_moved': 0, 'last_run_at': None}
+_retention_stats: Dict[str, Any] = {'runs': 0, 'removed_total': 0, 'reclaimed_total': 0,
+                                    'last_removed': 0, 'last_reclaimed': 0, 'last_run_at': None}
+_checkpoint_stats: Dict[str, Any] = {'passive': 0, 'truncate': 0, 'busy': 0, 'last_mode': None,
+                                     'last_wal_pages': 0, 'last_run_at': None, 'optimize_runs': 0}
+_reaper_stats: Dict[str, Any] = {'removed_total': 0, 'dialogs_total': 0, 'pending_dialogs': 0,
+                                 'pending_messages': 0, 'last_run_at': None}
+# Будит фоновое удаление истории сразу после удаления диалога (создается при запуске задачи)
+_reaper_wakeup: Optional[asyncio.Event] = None
+# Не больше одного резервного копирования одновременно (кнопка админ-панели и фоновая задача)
+_backup_lock = asyncio.Lock()
+
+def shard_ids() -> range:
+    """Номера всех шардов хранилища."""
+    return range(max(1, DB_SHARDS))
+
+
+def _user_shard(user_id: int) -> int:
+    """Шард, в котором хранятся данные пользователя."""
+    return sharding.shard_for_user(user_id, DB_SHARDS)
+
+
+def _shard_files(shard: int) -> Tuple[str, str]:
+    """Пути к файлам основной базы и архива шарда."""
+    return sharding.shard_path(DATABASE_NAME, shard), sharding.shard_path(ARCHIVE_DATABASE_NAME, shard)
+
+
+def _get_db_connection(shard: int = 0) -> sqlite3.Connection:
+    """Устанавливает соединение с базой данных SQLite (шарда `shard`)."""
+    return _open_connection(*_shard_files(shard))
+
+
+def _open_connection(database_path: str, archive_path: str) -> sqlite3.Connection:
+    """Открывает соединение с файлом БД, подключает архив, применяет профиль PRAGMA и включает замер запросов."""
     try:
-        conn = sqlite3.connect(DATABASE_NAME, check_same_thread=False, timeout=10.0,
-                               detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        conn = sqlite3.connect(database_path, check_same_thread=False, timeout=10.0,
+                               detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                               factory=query_stats.TimedConnection)
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA foreign_keys = ON;")
+        # Для новой базы режим auto_vacuum действует, только если задан до перехода в WAL
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
         conn.execute("PRAGMA journal_mode=WAL;")
+        message_blobs.register_functions(conn)
+        archive.register_functions(conn)
+        archive.attach(conn, archive_path)
+        pragmas.apply_profile(conn, ('main', archive.SCHEMA), synchronous=DB_SYNCHRONOUS,
+                              cache_size_mb=DB_CACHE_SIZE_MB, mmap_size_mb=DB_MMAP_SIZE_MB,
+                              temp_store=DB_TEMP_STORE, wal_autocheckpoint=DB_WAL_AUTOCHECKPOINT)
+        conn.query_stats = _query_stats
         return conn
     except sqlite3.Error as e:
-        db_logger.exception(f"Ошибка подключения к базе данных {DATABASE_NAME}: {e}")
+        db_logger.exception(f"Ошибка подключения к базе данных {database_path}: {e}")
         raise
 
 
-def _execute_sync(query: str, params: tuple = (), fetch_one: bool = False, fetch_all: bool = False,
-                  is_write_operation: bool = False) -> Optional[Any]:
+def _get_pooled_connection(shard: int = 0) -> sqlite3.Connection:
+    """
+    Открывает соединение для пула. Транзакциями управляет сам пул (BEGIN/SAVEPOINT/COMMIT
+    у писателя), поэтому соединение работает в режиме autocommit.
+    """
+    conn = _get_db_connection(shard)
+    conn.isolation_level = None
+    return conn
+
+
+def _get_pool(shard: int = 0) -> ConnectionPool:
+    """Возвращает пул соединений шарда, запуская его при первом обращении."""
+    pool = _pools.get(shard)
+    if pool is None:
+        pool = ConnectionPool(functools.partial(_get_pooled_connection, shard), readers=DB_POOL_READERS,
+                              write_batch_max=DB_WRITE_BATCH_MAX, write_linger_ms=DB_WRITE_LINGER_MS)
+        pool.start()
+        _pools[shard] = pool
+    return pool
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """
+    Возвращает метрики пулов соединений, сведенные по всем шардам: счетчики суммируются,
+    максимумы берутся наибольшие, средние пересчитываются (пустой словарь, если пулы еще не запущены).
+    """
+    snapshots = [pool.stats() for pool in _pools.values()]
+    if not snapshots:
+        return {}
+    if len(snapshots) == 1:
+        return snapshots[0]
+    result: Dict[str, Any] = {}
+    for key in snapshots[0]:
+        if key.endswith('_max_ms'):
+            result[key] = max(snapshot[key] for snapshot in snapshots)
+        elif not key.endswith(('_avg_ms', '_avg')):
+            result[key] = sum(snapshot[key] for snapshot in snapshots)
+
+    def weighted(key: str, weight: str) -> float:
+        total = sum(snapshot[weight] for snapshot in snapshots)
+        return round(sum(snapshot[key] * snapshot[weight] for snapshot in snapshots) / total, 2) if total else 0.0
+
+    for role in ('reader', 'writer'):
+        result[f'{role}_wait_avg_ms'] = weighted(f'{role}_wait_avg_ms', f'{role}_checkouts')
+    result['write_commit_avg_ms'] = weighted('write_commit_avg_ms', 'write_batches')
+    batches = result['write_batches']
+    result['write_batch_avg'] = round(result['writer_checkouts'] / batches, 2) if batches else 0.0
+    return result
+
+
+def get_query_stats(limit: int = 10) -> Dict[str, Any]:
+    """Возвращает сводку времени SQL-запросов и `limit` запросов с наибольшим суммарным временем."""
+    return {'slow_ms': _query_stats.slow_ms, 'summary': _query_stats.summary(), 'top': _query_stats.top(limit)}
+
+
+def get_user_cache_stats() -> Dict[str, Any]:
+    """Возвращает размер кэша профилей и счетчики попаданий/промахов."""
+    return _user_cache.stats()
+
+
+async def close_database():
+    """Останавливает фоновые задачи и пул соединений. Вызывается при graceful shutdown."""
+    tasks = list(_background_tasks)
+    _background_tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    pools = list(_pools.values())
+    _pools.clear()
+    for pool in pools:
+        await asyncio.to_thread(pool.close)
+
+
+def _execute_sync(conn: sqlite3.Connection, query: str, params: tuple = (), fetch_one: bool = False,
+                  fetch_all: bool = False, is_write_operation: bool = False) -> Optional[Any]:
     """
-    (СИНХРОННАЯ ВНУТРЕННЯЯ ФУНКЦИЯ) Выполняет SQL-запрос.
-    Эта функция предназначена для запуска в отдельном потоке.
+    (СИНХРОННАЯ ВНУТРЕННЯЯ ФУНКЦИЯ) Выполняет SQL-запрос на переданном соединении.
+    Эта функция выполняется только в потоке, владеющем соединением (см. ConnectionPool).
+    Операции записи выполняются внутри транзакции пачки писателя, поэтому здесь
+    транзакция не открывается и не фиксируется.
     """
-    conn = None
     result = None
     try:
-        conn = _get_db_connection()
-        if is_write_operation:
-            conn.isolation_level = 'EXCLUSIVE'
-            conn.execute('BEGIN EXCLUSIVE')
-
         cursor = conn.cursor()
         cursor.execute(query, params)
 
@@ -56,37 +203,27 @@ def _execute_sync(query: str, params: tuple = (), fetch_one: bool = False, fetch
                 result = cursor.lastrowid
             elif query.strip().upper().startswith(("UPDATE", "DELETE")):
                 result = cursor.rowcount
-            conn.commit()
 
     except sqlite3.Error as e:
         db_logger.exception(f"Ошибка выполнения SQL: {query} | Params: {params} | Error: {e}")
-        if conn and is_write_operation:
-            try:
-                conn.rollback()
-            except sqlite3.Error as rb_err:
-                db_logger.error(f"Ошибка при откате транзакции: {rb_err}")
         if fetch_all: return []
         # Пробрасываем ошибку дальше, чтобы ее можно было обработать
         raise e
-    finally:
-        if conn:
-            conn.close()
     return result
 
 
 async def _execute_query(query: str, params: tuple = (), fetch_one: bool = False, fetch_all: bool = False,
-                         is_write_operation: bool = False) -> Optional[Any]:
-    """(АСИНХРОННАЯ ОБЕРТКА) Выполняет SQL-запрос в отдельном потоке, чтобы не блокировать event loop."""
+                         is_write_operation: bool = False, shard: int = 0) -> Optional[Any]:
+    """
+    (АСИНХРОННАЯ ОБЕРТКА) Выполняет SQL-запрос в потоке пула соединений шарда, чтобы не блокировать event loop.
+    Записи идут через единственного писателя пула шарда, поэтому отдельная блокировка не нужна.
+    """
+    job = functools.partial(
+        _execute_sync, query=query, params=params, fetch_one=fetch_one,
+        fetch_all=fetch_all, is_write_operation=is_write_operation
+    )
     try:
-        if is_write_operation:
-            async with db_lock:
-                return await asyncio.to_thread(
-                    _execute_sync, query, params, fetch_one, fetch_all, is_write_operation
-                )
-        else:
-            return await asyncio.to_thread(
-                _execute_sync, query, params, fetch_one, fetch_all, is_write_operation
-            )
+        return await _get_pool(shard).run(job, write=is_write_operation)
     except Exception as e:
         # Логируем ошибку, которая была проброшена из _execute_sync
         db_logger.error(f"Перехвачена ошибка из _execute_sync в _execute_query: {e}")
@@ -95,341 +232,1199 @@ async def _execute_query(query: str, params: tuple = (), fetch_one: bool = False
         return None
 
 
-def setup_database_sync():
-    """Синхронная функция для инициализации и миграции структуры базы данных."""
-    conn = _get_db_connection()
-    cursor = conn.cursor()
+async def _run_in_pool(fn: Callable[[sqlite3.Connection], Any], write: bool = False, default: Any = None,
+                      shard: int = 0) -> Any:
+    """
+    (АСИНХРОННАЯ ОБЕРТКА) Выполняет `fn(conn)` — несколько запросов одним заданием — в потоке пула шарда.
+    Записи выполняются в транзакции писателя. При ошибке логирует ее и возвращает `default`.
+    """
     try:
-        # --- Таблица app_settings ---
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS app_settings (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL
-            )
+        return await _get_pool(shard).run(fn, write=write)
+    except Exception as e:
+        db_logger.exception(f"Ошибка выполнения задания в пуле соединений: {e}")
+        return default
+
+
+def rebuild_usage_daily_sync(conn: sqlite3.Connection) -> int:
+    """
+    Пересчитывает таблицу usage_daily из ответов бота в conversations и в архиве
+    одной транзакцией. Сообщения без известной модели учитываются под моделью ''.
+
+    Returns:
+        Количество строк в пересчитанной таблице.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM usage_daily")
+        cursor = conn.execute("""
+            INSERT INTO usage_daily (user_id, day, model, prompt, completion, total, requests)
+            SELECT user_id, strftime('%Y-%m-%d', ts, 'unixepoch'), COALESCE(model, ''),
+                   SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens), COUNT(*)
+            FROM conversations
+            WHERE role = 'bot' AND ts IS NOT NULL
+            GROUP BY 1, 2, 3
         """)
-        db_logger.info("Таблица 'app_settings' проверена/создана.")
-
-        # --- Таблица users ---
-        cursor.execute("PRAGMA table_info(users)")
-        user_columns = {col['name'] for col in cursor.fetchall()}
-        if not user_columns:
-            db_logger.info("Таблица 'users' не найдена, создаем...")
-            cursor.execute("""
-            CREATE TABLE users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                bot_style TEXT DEFAULT 'default' NOT NULL,
-                first_interaction_date TEXT,
-                api_key TEXT DEFAULT NULL,
-                language_code TEXT DEFAULT 'ru' NOT NULL,
-                gemini_model TEXT DEFAULT NULL,
-                active_persona TEXT DEFAULT 'default' NOT NULL,
-                active_dialog_id INTEGER REFERENCES dialogs(dialog_id) ON DELETE SET NULL,
-                is_blocked INTEGER NOT NULL DEFAULT 0
-            )""")
-        else:
-            # Обновлено: добавляем новые поля для миграции
-            required_user_columns = {
-                'active_dialog_id', 'active_persona', 'is_blocked',
-                'username', 'first_name', 'last_name'
-            }
-            missing_user_columns = required_user_columns - user_columns
-            for col in missing_user_columns:
-                db_logger.info(f"Добавляем отсутствующий столбец '{col}' в 'users'...")
-                if col == 'active_persona':
-                    cursor.execute(f"ALTER TABLE users ADD COLUMN {col} TEXT DEFAULT 'default' NOT NULL")
-                elif col == 'is_blocked':
-                    cursor.execute(f"ALTER TABLE users ADD COLUMN {col} INTEGER NOT NULL DEFAULT 0")
-                elif col in ['username', 'first_name', 'last_name']:
-                    cursor.execute(f"ALTER TABLE users ADD COLUMN {col} TEXT") # Могут быть NULL
-                else: # active_dialog_id
-                    cursor.execute(f"ALTER TABLE users ADD COLUMN {col} INTEGER REFERENCES dialogs(dialog_id) ON DELETE SET NULL")
-
-        # --- Таблица dialogs ---
-        cursor.execute("PRAGMA table_info(dialogs)")
-        if not cursor.fetchall():
-            db_logger.info("Таблица 'dialogs' не найдена, создаем...")
-            cursor.execute("""
-            CREATE TABLE dialogs (
-                dialog_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-            )""")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_dialogs_user ON dialogs (user_id)")
-
-        # --- Таблица conversations ---
-        cursor.execute("PRAGMA table_info(conversations)")
-        conversation_columns = {col['name'] for col in cursor.fetchall()}
-        if not conversation_columns:
-             db_logger.info("Таблица 'conversations' не найдена, создаем...")
-             cursor.execute("""
-                CREATE TABLE conversations (
-                    conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    timestamp TEXT NOT NULL,
-                    role TEXT NOT NULL CHECK(role IN ('user', 'bot')),
-                    message_text TEXT,
-                    prompt_tokens INTEGER NOT NULL DEFAULT 0,
-                    completion_tokens INTEGER NOT NULL DEFAULT 0,
-                    total_tokens INTEGER NOT NULL DEFAULT 0,
-                    dialog_id INTEGER NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
-                    FOREIGN KEY (dialog_id) REFERENCES dialogs(dialog_id) ON DELETE CASCADE
-                )""")
-             cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_dialog_time ON conversations (dialog_id, timestamp)")
-        elif 'dialog_id' not in conversation_columns:
-            db_logger.info("Добавляем отсутствующий столбец 'dialog_id' в 'conversations'...")
-            cursor.execute("ALTER TABLE conversations ADD COLUMN dialog_id INTEGER REFERENCES dialogs(dialog_id) ON DELETE CASCADE")
-
-        conn.commit()
-
-        # --- Миграция старых данных ---
-        cursor.execute("SELECT user_id FROM users WHERE active_dialog_id IS NULL")
-        users_to_migrate = cursor.fetchall()
-        if users_to_migrate:
-            db_logger.info(f"Найдено {len(users_to_migrate)} пользователей для миграции на систему диалогов...")
-            for row in users_to_migrate:
-                user_id = row['user_id']
-                default_dialog_name = "Основной диалог"
-                now_str = datetime.datetime.now(datetime.timezone.utc).isoformat()
-                cursor.execute("INSERT INTO dialogs (user_id, name, created_at) VALUES (?, ?, ?)",
-                               (user_id, default_dialog_name, now_str))
-                new_dialog_id = cursor.lastrowid
-                cursor.execute("UPDATE users SET active_dialog_id = ? WHERE user_id = ?", (new_dialog_id, user_id))
-                cursor.execute("UPDATE conversations SET dialog_id = ? WHERE user_id = ? AND dialog_id IS NULL", (new_dialog_id, user_id))
-                db_logger.info(f"Пользователь {user_id} успешно мигрирован. Создан диалог ID: {new_dialog_id}.")
-            conn.commit()
-
-            # Пересоздаем таблицу, чтобы сделать dialog_id NOT NULL
-            db_logger.info("Пересоздание таблицы 'conversations', чтобы сделать столбец 'dialog_id' NOT NULL...")
-            cursor.execute("PRAGMA foreign_keys=off")
-            cursor.execute("BEGIN TRANSACTION")
-            cursor.execute("""
-                CREATE TABLE conversations_new (
-                    conversation_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
-                    timestamp TEXT NOT NULL, role TEXT NOT NULL CHECK(role IN ('user', 'bot')),
-                    message_text TEXT, prompt_tokens INTEGER NOT NULL DEFAULT 0,
-                    completion_tokens INTEGER NOT NULL DEFAULT 0, total_tokens INTEGER NOT NULL DEFAULT 0,
-                    dialog_id INTEGER NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
-                    FOREIGN KEY (dialog_id) REFERENCES dialogs(dialog_id) ON DELETE CASCADE
-                )""")
-            cursor.execute("INSERT INTO conversations_new SELECT * FROM conversations WHERE dialog_id IS NOT NULL")
-            cursor.execute("DROP TABLE conversations")
-            cursor.execute("ALTER TABLE conversations_new RENAME TO conversations")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_dialog_time ON conversations (dialog_id, timestamp)")
-            cursor.execute("COMMIT")
-            cursor.execute("PRAGMA foreign_keys=on")
-            db_logger.info("Столбец 'dialog_id' в таблице 'conversations' успешно обновлен.")
-
-        db_logger.info("Проверка и настройка базы данных завершена.")
+        archived: Dict[Tuple[int, str, str], List[int]] = {}
+        for message in archive.iterate_messages_sync(conn):
+            if message['role'] != 'bot' or message['ts'] is None:
+                continue
+            key = (message['user_id'], archive.utc_day(message['ts']), message['model'] or '')
+            sums = archived.setdefault(key, [0, 0, 0, 0])
+            sums[0] += message['prompt_tokens']
+            sums[1] += message['completion_tokens']
+            sums[2] += message['total_tokens']
+            sums[3] += 1
+        conn.executemany("""
+            INSERT INTO usage_daily (user_id, day, model, prompt, completion, total, requests)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, day, model) DO UPDATE SET
+                prompt = prompt + excluded.prompt,
+                completion = completion + excluded.completion,
+                total = total + excluded.total,
+                requests = requests + excluded.requests
+        """, [key + tuple(sums) for key, sums in archived.items()])
+        rows = conn.execute("SELECT COUNT(*) FROM usage_daily").fetchone()[0]
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+    db_logger.info(f"Таблица usage_daily пересчитана: {rows} строк.")
+    return rows
+
+
+def _message_totals_sql(key: str) -> str:
+    """
+    Подзапрос: число сообщений и время последнего по `key` (dialog_id или user_id) в обоих уровнях истории.
+    Сообщения диалогов, ожидающих удаления, не учитываются (см. dialog_reaper).
+    """
+    live = f"dialog_id NOT IN ({dialog_reaper.DELETED_DIALOGS_SQL})"
+    return f"""
+        SELECT {key}, SUM(cnt) AS cnt, MAX(last_ts) AS last_ts FROM (
+            SELECT {key}, COUNT(*) AS cnt, MAX(ts) AS last_ts FROM conversations WHERE {live} GROUP BY {key}
+            UNION ALL
+            SELECT {key}, SUM(message_count), MAX(last_ts) FROM {archive.SCHEMA}.conversation_blocks
+            WHERE {live} GROUP BY {key}
+        ) GROUP BY {key}
+    """
+
+
+def check_message_counters_sync(conn: sqlite3.Connection, repair: bool = False) -> Dict[str, int]:
+    """
+    Сверяет счетчики message_count/last_message_at в dialogs и users с историей сообщений
+    (conversations и архив).
+
+    Args:
+        conn: Соединение с БД.
+        repair: Если True — исправляет расхождения в той же транзакции, что и сверка.
+
+    Returns:
+        Количество строк с расхождениями: {'dialogs': N, 'users': M}.
+    """
+    if repair:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        dialog_drift = conn.execute(f"""
+            SELECT d.dialog_id, COALESCE(c.cnt, 0), c.last_ts
+            FROM dialogs d
+            LEFT JOIN ({_message_totals_sql('dialog_id')}) c ON c.dialog_id = d.dialog_id
+            WHERE d.deleted_at IS NULL
+              AND (d.message_count != COALESCE(c.cnt, 0) OR d.last_message_at IS NOT c.last_ts)
+        """).fetchall()
+        user_drift = conn.execute(f"""
+            SELECT u.user_id, COALESCE(c.cnt, 0), c.last_ts
+            FROM users u
+            LEFT JOIN ({_message_totals_sql('user_id')}) c ON c.user_id = u.user_id
+            WHERE u.message_count != COALESCE(c.cnt, 0) OR u.last_message_at IS NOT c.last_ts
+        """).fetchall()
+        if repair:
+            conn.executemany("UPDATE dialogs SET message_count = ?, last_message_at = ? WHERE dialog_id = ?",
+                             [(cnt, last_ts, dialog_id) for dialog_id, cnt, last_ts in dialog_drift])
+            conn.executemany("UPDATE users SET message_count = ?, last_message_at = ? WHERE user_id = ?",
+                             [(cnt, last_ts, user_id) for user_id, cnt, last_ts in user_drift])
+            conn.execute("COMMIT")
+    except sqlite3.Error:
+        if repair:
+            conn.execute("ROLLBACK")
+        raise
+    if repair and (dialog_drift or user_drift):
+        db_logger.info(f"Счетчики сообщений исправлены: диалогов {len(dialog_drift)}, пользователей {len(user_drift)}.")
+    return {'dialogs': len(dialog_drift), 'users': len(user_drift)}
+
+
+def _fetch_page_sync(conn: sqlite3.Connection, query: str, params: tuple) -> List[sqlite3.Row]:
+    """(СИНХРОННАЯ ВНУТРЕННЯЯ ФУНКЦИЯ) Читает одну страницу потоковой выборки."""
+    return conn.execute(query, params).fetchall()
+
+
+async def iterate_rows(table: str, columns: str, key: str, where: str = "", params: tuple = (),
+                       page_size: int = DB_STREAM_PAGE_SIZE,
+                       prefetch: int = DB_STREAM_PREFETCH, shard: int = 0) -> AsyncIterator[sqlite3.Row]:
+    """
+    Потоково перебирает строки таблицы (`async for`), не загружая всю выборку в память.
+
+    Строки читаются страницами по `page_size` с keyset-пагинацией по возрастанию `key`
+    (ключ должен быть уникальным и входить в `columns`). Страницы заранее читаются
+    потоками-читателями пула, но не больше `prefetch` страниц впереди потребителя.
+
+    Args:
+        table: Имя таблицы.
+        columns: Список столбцов для SELECT.
+        key: Уникальный столбец для пагинации (обычно первичный ключ).
+        where: Необязательное дополнительное условие с плейсхолдерами.
+        params: Параметры для `where`.
+        shard: Шард, из которого читается таблица (см. iterate_all_shards).
+    """
+    extra = f" AND ({where})" if where else ""
+    first_query = f"SELECT {columns} FROM {table} WHERE 1{extra} ORDER BY {key} LIMIT ?"
+    next_query = f"SELECT {columns} FROM {table} WHERE {key} > ?{extra} ORDER BY {key} LIMIT ?"
+    pages: asyncio.Queue = asyncio.Queue(maxsize=max(1, prefetch))
+    pool = _get_pool(shard)
+
+    async def _produce():
+        last_key = None
+        try:
+            while True:
+                if last_key is None:
+                    page_params = (*params, page_size)
+                    query = first_query
+                else:
+                    page_params = (last_key, *params, page_size)
+                    query = next_query
+                rows = await pool.run(functools.partial(_fetch_page_sync, query=query, params=page_params))
+                if rows:
+                    await pages.put(rows)
+                if len(rows) < page_size:
+                    break
+                last_key = rows[-1][key]
+            await pages.put(None)
+        except Exception as e:
+            db_logger.exception(f"Ошибка потокового чтения из '{table}': {e}")
+            await pages.put(e)
+
+    producer = asyncio.create_task(_produce())
+    try:
+        while True:
+            page = await pages.get()
+            if page is None:
+                break
+            if isinstance(page, Exception):
+                raise page
+            for row in page:
+                yield row
+    finally:
+        producer.cancel()
+
+
+async def iterate_all_shards(table: str, columns: str, key: str) -> AsyncIterator[sqlite3.Row]:
+    """
+    Потоково перебирает строки таблицы во всех шардах по возрастанию `key`: потоки шардов
+    (см. iterate_rows) читаются параллельно и сливаются по ключу.
+    """
+    streams = [iterate_rows(table, columns, key=key, shard=shard) for shard in shard_ids()]
+    heads: List[Tuple[Any, int, sqlite3.Row]] = []
+
+    async def _advance(index: int):
+        try:
+            row = await streams[index].__anext__()
+        except StopAsyncIteration:
+            return
+        heapq.heappush(heads, (row[key], index, row))
+
+    try:
+        await asyncio.gather(*(_advance(index) for index in range(len(streams))))
+        while heads:
+            _, index, row = heapq.heappop(heads)
+            yield row
+            await _advance(index)
+    finally:
+        for stream in streams:
+            await stream.aclose()
+
+
+async def _sum_over_shards(query: str, params: tuple = ()) -> int:
+    """Выполняет агрегирующий запрос (COUNT/SUM) в каждом шарде и складывает результаты."""
+    counts = await asyncio.gather(*(_execute_query(query, params, shard=shard) for shard in shard_ids()))
+    return sum(count or 0 for count in counts)
+
+
+@contextlib.asynccontextmanager
+async def transaction(shard: int = 0) -> AsyncIterator[UnitOfWork]:
+    """
+    Составная операция в одной транзакции: запросы, добавленные в UnitOfWork внутри блока,
+    выполняются при выходе из него одним заданием писателя пула шарда `shard`
+    (транзакция не может охватывать несколько шардов).
+
+    Если предусловие (`require`) не выполнено, все изменения откатываются, а у единицы
+    работы выставляется `aborted`. Ошибки SQLite логируются и пробрасываются.
+    """
+    unit = UnitOfWork()
+    yield unit
+    if not unit:
+        return
+    try:
+        await _get_pool(shard).run(unit.apply, write=True)
+    except UnitAborted as e:
+        unit.mark_aborted(e.reason)
+    except Exception as e:
+        db_logger.exception(f"Ошибка выполнения транзакции: {e}")
+        raise
+
+
+def _setup_shard_sync(conn: sqlite3.Connection) -> int:
+    """
+    Приводит файлы одного шарда (основную базу и архив) к актуальной схеме: схема архива
+    и перевод в auto_vacuum=INCREMENTAL — тоже шаги миграций, поэтому на актуальной базе
+    это один SELECT. Соединение должно работать в режиме autocommit.
+
+    Returns:
+        Версия схемы.
+    """
+    return migrations.migrate(conn)
+
+
+def _check_shard_layout(conn: sqlite3.Connection) -> Dict[str, int]:
+    """
+    Сверяет раскладку базы (app_settings шарда 0) с DB_SHARDS; для новой базы записывает ее.
+
+    Raises:
+        sharding.ShardLayoutError: Если база разбита на другое число шардов.
+    """
+    shards = max(1, DB_SHARDS)
+    layout = sharding.read_layout(conn)
+    if layout is None:
+        if shards > 1 and conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            raise sharding.ShardLayoutError(
+                f"База не шардирована, а DB_SHARDS = {shards}: выполните python -m database.maintenance reshard.")
+        layout = {'shards': shards, 'epoch': 0}
+        sharding.write_layout(conn, shards, 0)
+    elif layout['shards'] != shards:
+        raise sharding.ShardLayoutError(
+            f"База разбита на {layout['shards']} шардов, а DB_SHARDS = {shards}: "
+            f"выполните python -m database.maintenance reshard.")
+    return layout
+
+
+def setup_database_sync():
+    """
+    Синхронная функция для инициализации и миграции структуры базы данных (всех шардов).
+    Миграции версионированы (см. database/migrations.py): на актуальной базе это один SELECT.
+    Раскладка шардов должна совпадать с DB_SHARDS (см. database/sharding.py).
+    """
+    try:
+        layout: Dict[str, int] = {}
+        for shard in shard_ids():
+            conn = _get_db_connection(shard)
+            conn.isolation_level = None
+            try:
+                version = _setup_shard_sync(conn)
+                if shard == 0:
+                    layout = _check_shard_layout(conn)
+                base = sharding.id_base(layout['epoch'], layout['shards'], shard)
+                if base:
+                    sharding.seed_id_sequences(conn, base)
+            finally:
+                conn.close()
+        db_logger.info(f"Проверка и настройка базы данных завершена. Версия схемы: {version}, шардов: {len(shard_ids())}.")
+    except sharding.ShardLayoutError as e:
+        db_logger.critical(str(e))
+        raise
     except Exception as e:
         db_logger.exception(f"Критическая ошибка при настройке/миграции базы данных: {e}")
-        if conn: conn.rollback()
         raise
-    finally:
-        if conn: conn.close()
 
 
 async def setup_database():
-    """Асинхронная обертка для запуска синхронной настройки БД в отдельном потоке."""
+    """
+    Асинхронная обертка для запуска синхронной настройки БД в отдельном потоке.
+    После миграций запускает пул соединений, который используется всеми запросами,
+    и фоновые задачи обслуживания.
+    """
     await asyncio.to_thread(setup_database_sync)
+    for shard in shard_ids():
+        await asyncio.to_thread(_get_pool, shard)
+    if ARCHIVE_AFTER_DAYS > 0:
+        _background_tasks.append(asyncio.create_task(_archiver_loop(), name="db-archiver"))
+    _background_tasks.append(asyncio.create_task(_retention_loop(), name="db-retention"))
+    _background_tasks.append(asyncio.create_task(_reaper_loop(), name="db-dialog-reaper"))
+    if BACKUP_INTERVAL_HOURS > 0:
+        _background_tasks.append(asyncio.create_task(_backup_loop(), name="db-backup"))
+    if DB_CHECKPOINT_INTERVAL_SECONDS > 0:
+        _background_tasks.append(asyncio.create_task(_checkpoint_loop(), name="db-checkpoint"))
+    elif DB_WAL_AUTOCHECKPOINT <= 0:
+        db_logger.warning("Фоновые контрольные точки и wal_autocheckpoint выключены: файл WAL будет только расти.")
+
+
+def _remove_files(*paths: str):
+    """Удаляет файлы БД вместе с их -wal/-shm, если они есть."""
+    for path in paths:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def reshard_sync(shards: int) -> Dict[str, int]:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Перераспределяет пользователей по `shards` шардам. Бот должен быть остановлен.
+
+    Текущая раскладка читается из app_settings шарда 0 (база без записанной раскладки — один файл).
+    Новые шарды собираются во временных файлах и заменяют старые только после копирования всех
+    данных; старые файлы остаются рядом с суффиксом `.pre-reshard`. Идентификаторы диалогов и
+    сообщений сохраняются, новые выдаются из полос следующей эпохи (см. database/sharding.py).
+
+    Returns:
+        {'users': перенесено пользователей, 'shards': число шардов, 'epoch': эпоха идентификаторов}.
+    """
+    shards = max(1, shards)
+    conn = _get_db_connection(0)
+    conn.isolation_level = None
+    try:
+        _setup_shard_sync(conn)
+        layout = sharding.read_layout(conn) or {'shards': 1, 'epoch': 0}
+    finally:
+        conn.close()
+    old_files = [(sharding.shard_path(DATABASE_NAME, shard), sharding.shard_path(ARCHIVE_DATABASE_NAME, shard))
+                 for shard in range(layout['shards'])]
+    top_id = 0
+    for database_path, archive_path in old_files:
+        conn = _open_connection(database_path, archive_path)
+        conn.isolation_level = None
+        try:
+            _setup_shard_sync(conn)
+            top_id = max(top_id, sharding.max_id(conn))
+        finally:
+            conn.close()
+    epoch = sharding.next_epoch(top_id, shards)
+
+    new_files = [(f"{sharding.shard_path(DATABASE_NAME, shard)}.reshard",
+                  f"{sharding.shard_path(ARCHIVE_DATABASE_NAME, shard)}.reshard") for shard in range(shards)]
+    moved = 0
+    try:
+        for shard, (database_path, archive_path) in enumerate(new_files):
+            _remove_files(database_path, archive_path)
+            conn = _open_connection(database_path, archive_path)
+            conn.isolation_level = None
+            try:
+                _setup_shard_sync(conn)
+                for old_database, old_archive in old_files:
+                    moved += sharding.copy_users_sync(conn, old_database, old_archive, shard, shards)
+                if shard == 0:
+                    sharding.copy_settings_sync(conn, old_files[0][0])
+                    sharding.write_layout(conn, shards, epoch)
+                sharding.seed_id_sequences(conn, sharding.id_base(epoch, shards, shard))
+                db_logger.info(f"Шард {shard} из {shards} собран.")
+            finally:
+                conn.close()
+    except Exception:
+        for paths in new_files:
+            _remove_files(*paths)
+        raise
+
+    for paths in old_files:
+        for path in paths:
+            if os.path.exists(path):
+                os.replace(path, f"{path}.pre-reshard")
+    for shard, paths in enumerate(new_files):
+        for path, final_path in zip(paths, _shard_files(shard)):
+            os.replace(path, final_path)
+    db_logger.info(f"Решардинг завершен: пользователей {moved}, шардов {layout['shards']} -> {shards}, эпоха {epoch}.")
+    return {'users': moved, 'shards': shards, 'epoch': epoch}
+
+
+# --- Холодный архив истории ---
+
+def _archive_cutoff_ts() -> int:
+    return int(time.time()) - ARCHIVE_AFTER_DAYS * 86400
+
+
+def archive_cold_messages_sync(conn: sqlite3.Connection) -> int:
+    """
+    Переносит в архив все сообщения старше ARCHIVE_AFTER_DAYS пачками по ARCHIVE_BATCH_SIZE,
+    каждую пачку — отдельной транзакцией (соединение в режиме autocommit, для служебных команд).
+
+    Returns:
+        Количество перенесенных сообщений.
+    """
+    cutoff_ts, moved, cursor = _archive_cutoff_ts(), 0, 0
+    while cursor is not None:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            batch, cursor = archive.archive_batch_sync(conn, cutoff_ts, ARCHIVE_KEEP_LAST, ARCHIVE_BATCH_SIZE, cursor)
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        moved += batch
+    db_logger.info(f"В архив перенесено сообщений: {moved}.")
+    return moved
+
+
+async def archive_cold_messages() -> int:
+    """
+    Переносит в архив сообщения старше ARCHIVE_AFTER_DAYS через писателей пулов всех шардов: пачки идут
+    отдельными заданиями, так что обычные записи не ждут окончания всего прохода.
+
+    Returns:
+        Количество перенесенных сообщений.
+    """
+    cutoff_ts, moved = _archive_cutoff_ts(), 0
+    job = functools.partial(archive.archive_batch_sync, cutoff_ts=cutoff_ts,
+                            keep_last=ARCHIVE_KEEP_LAST, batch_size=ARCHIVE_BATCH_SIZE)
+    for shard in shard_ids():
+        cursor = 0
+        while cursor is not None:
+            batch, cursor = await _get_pool(shard).run(functools.partial(job, from_dialog_id=cursor), write=True)
+            moved += batch
+    _archive_stats['runs'] += 1
+    _archive_stats['moved_total'] += moved
+    _archive_stats['last_moved'] = moved
+    _archive_stats['last_run_at'] = datetime.datetime.now(datetime.timezone.utc)
+    if moved:
+        db_logger.info(f"В архив перенесено сообщений: {moved}.")
+    return moved
+
+
+async def _archiver_loop():
+    """Фоновая задача: периодически переносит холодную историю в архив."""
+    while True:
+        try:
+            await archive_cold_messages()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            db_logger.exception(f"Ошибка фонового архивирования истории: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+
+def get_archive_stats() -> Dict[str, Any]:
+    """Возвращает счетчики архиватора с момента запуска: проходы, перенесено всего и в последнем проходе."""
+    return dict(_archive_stats)
+
+
+# --- Политика хранения и возврат места ---
+
+def _retention_jobs() -> List[Callable[[sqlite3.Connection], int]]:
+    """Задания удаления по включенным правилам хранения (каждое удаляет одну пачку)."""
+    jobs = []
+    if RETENTION_MAX_AGE_DAYS > 0:
+        cutoff_ts = int(time.time()) - RETENTION_MAX_AGE_DAYS * 86400
+        jobs.append(functools.partial(retention.purge_by_age_sync, cutoff_ts=cutoff_ts,
+                                      batch_size=RETENTION_BATCH_SIZE))
+    if RETENTION_MAX_MESSAGES_PER_DIALOG > 0:
+        jobs.append(functools.partial(retention.purge_dialog_overflow_sync,
+                                      max_messages=RETENTION_MAX_MESSAGES_PER_DIALOG,
+                                      batch_size=RETENTION_BATCH_SIZE))
+    return jobs
+
+
+def apply_retention_sync(conn: sqlite3.Connection) -> Tuple[int, int]:
+    """
+    Применяет политику хранения и возвращает освободившееся место; каждая пачка — отдельной
+    транзакцией (соединение в режиме autocommit, для служебных команд).
+
+    Returns:
+        (удалено сообщений, освобождено байт).
+    """
+    def run(job: Callable[[sqlite3.Connection], int]) -> int:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = job(conn)
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    removed = reclaimed = 0
+    for job in _retention_jobs():
+        while True:
+            batch = run(job)
+            removed += batch
+            if batch < RETENTION_BATCH_SIZE:
+                break
+    for schema in ('main', archive.SCHEMA):
+        while True:
+            freed = run(functools.partial(retention.incremental_vacuum_sync, schema=schema,
+                                          max_pages=VACUUM_PAGES_PER_STEP))
+            reclaimed += freed
+            if not freed:
+                break
+    db_logger.info(f"Политика хранения применена: удалено сообщений {removed}, освобождено байт {reclaimed}.")
+    return removed, reclaimed
+
+
+async def apply_retention() -> Tuple[int, int]:
+    """
+    Применяет политику хранения через писателей пулов всех шардов: каждая пачка удаления и каждый шаг
+    incremental_vacuum — отдельное небольшое задание, так что записи пользователей не ждут
+    окончания всего прохода.
+
+    Returns:
+        (удалено сообщений, освобождено байт).
+    """
+    removed = reclaimed = 0
+    for shard in shard_ids():
+        pool = _get_pool(shard)
+        for job in _retention_jobs():
+            while True:
+                batch = await pool.run(job, write=True)
+                removed += batch
+                if batch < RETENTION_BATCH_SIZE:
+                    break
+        for schema in ('main', archive.SCHEMA):
+            while True:
+                freed = await pool.run(functools.partial(retention.incremental_vacuum_sync, schema=schema,
+                                                         max_pages=VACUUM_PAGES_PER_STEP), write=True)
+                reclaimed += freed
+                if not freed:
+                    break
+    _retention_stats['runs'] += 1
+    _retention_stats['removed_total'] += removed
+    _retention_stats['reclaimed_total'] += reclaimed
+    _retention_stats['last_removed'] = removed
+    _retention_stats['last_reclaimed'] = reclaimed
+    _retention_stats['last_run_at'] = datetime.datetime.now(datetime.timezone.utc)
+    if removed or reclaimed:
+        db_logger.info(f"Политика хранения применена: удалено сообщений {removed}, освобождено байт {reclaimed}.")
+    return removed, reclaimed
+
+
+async def _retention_loop():
+    """Фоновая задача: периодически применяет политику хранения и возвращает свободные страницы файлу."""
+    while True:
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+        try:
+            await apply_retention()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            db_logger.exception(f"Ошибка применения политики хранения: {e}")
+
+
+def get_retention_stats() -> Dict[str, Any]:
+    """Возвращает счетчики политики хранения с момента запуска: удалено сообщений и освобождено байт."""
+    return dict(_retention_stats)
+
+
+# --- Фоновое удаление истории удаленных диалогов ---
+
+async def reap_deleted_dialogs() -> int:
+    """
+    Удаляет историю диалогов, помеченных удаленными, через писателей пулов всех шардов: каждая пачка
+    до DIALOG_REAPER_BATCH_SIZE сообщений — отдельное задание, так что записи пользователей не ждут
+    удаления всего диалога.
+
+    Returns:
+        Количество удаленных сообщений.
+    """
+    removed_total = pending_dialogs = pending_messages = 0
+    job = functools.partial(dialog_reaper.reap_batch_sync, batch_size=DIALOG_REAPER_BATCH_SIZE)
+    for shard in shard_ids():
+        pool = _get_pool(shard)
+        while True:
+            dialog_id, removed, finished = await pool.run(job, write=True)
+            if dialog_id is None:
+                break
+            removed_total += removed
+            _reaper_stats['removed_total'] += removed
+            if finished:
+                _reaper_stats['dialogs_total'] += 1
+                db_logger.info(f"История удаленного диалога ID {dialog_id} удалена полностью.")
+        dialogs, messages = await pool.run(dialog_reaper.pending_sync)
+        pending_dialogs += dialogs
+        pending_messages += messages
+    _reaper_stats['pending_dialogs'] = pending_dialogs
+    _reaper_stats['pending_messages'] = pending_messages
+    _reaper_stats['last_run_at'] = datetime.datetime.now(datetime.timezone.utc)
+    if removed_total:
+        db_logger.info(f"Удаление истории диалогов: удалено сообщений {removed_total}, "
+                       f"осталось диалогов {pending_dialogs} (сообщений {pending_messages}).")
+    return removed_total
+
+
+async def _reaper_loop():
+    """Фоновая задача: удаляет историю удаленных диалогов сразу после удаления и раз в интервал."""
+    global _reaper_wakeup
+    _reaper_wakeup = asyncio.Event()
+    while True:
+        _reaper_wakeup.clear()
+        try:
+            await reap_deleted_dialogs()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            db_logger.exception(f"Ошибка фонового удаления истории диалогов: {e}")
+        # asyncio.wait, а не wait_for: в Python 3.11 wait_for теряет отмену задачи, если событие
+        # выставлено одновременно с ней (delete_dialog прямо перед close_database), и остановка зависает
+        wakeup = asyncio.ensure_future(_reaper_wakeup.wait())
+        try:
+            await asyncio.wait({wakeup}, timeout=DIALOG_REAPER_INTERVAL_SECONDS)
+        finally:
+            wakeup.cancel()
+
+
+def get_reaper_stats() -> Dict[str, Any]:
+    """Возвращает счетчики фонового удаления истории диалогов: удалено с момента запуска и осталось."""
+    return dict(_reaper_stats)
+
+
+# --- Контрольные точки WAL и PRAGMA optimize ---
+
+async def run_checkpoint(truncate: bool = False, shard: int = 0) -> Dict[str, int]:
+    """
+    Выполняет контрольную точку WAL основной базы и архива шарда на писателе его пула, между пачками записи.
+
+    Args:
+        truncate: True — TRUNCATE (ждет читателей и обрезает WAL, только в простое), иначе PASSIVE.
+        shard: Номер шарда.
+
+    Returns:
+        Итог контрольной точки (см. pragmas.checkpoint_sync).
+    """
+    mode = 'TRUNCATE' if truncate else 'PASSIVE'
+    result = await _get_pool(shard).run(functools.partial(pragmas.checkpoint_sync, schemas=('main', archive.SCHEMA),
+                                                     mode=mode), write=True, transaction=False)
+    _checkpoint_stats[mode.lower()] += 1
+    _checkpoint_stats['busy'] += int(result['busy'] > 0)
+    _checkpoint_stats['last_mode'] = mode
+    _checkpoint_stats['last_wal_pages'] = result['wal_pages']
+    _checkpoint_stats['last_run_at'] = datetime.datetime.now(datetime.timezone.utc)
+    return result
+
+
+async def run_optimize():
+    """Выполняет PRAGMA optimize на писателях пулов всех шардов."""
+    for shard in shard_ids():
+        await _get_pool(shard).run(pragmas.optimize_sync, write=True, transaction=False)
+    _checkpoint_stats['optimize_runs'] += 1
+
+
+async def _checkpoint_loop():
+    """
+    Фоновая задача: каждые DB_CHECKPOINT_INTERVAL_SECONDS переносит WAL в файлы БД (TRUNCATE, если записей
+    не было DB_CHECKPOINT_IDLE_SECONDS, иначе PASSIVE) и раз в DB_OPTIMIZE_INTERVAL_SECONDS выполняет PRAGMA optimize.
+    """
+    last_optimize = time.monotonic()
+    while True:
+        await asyncio.sleep(DB_CHECKPOINT_INTERVAL_SECONDS)
+        try:
+            for shard in shard_ids():
+                idle = _get_pool(shard).writer_idle_seconds() >= DB_CHECKPOINT_IDLE_SECONDS
+                await run_checkpoint(truncate=idle, shard=shard)
+            if DB_OPTIMIZE_INTERVAL_SECONDS > 0 and time.monotonic() - last_optimize >= DB_OPTIMIZE_INTERVAL_SECONDS:
+                await run_optimize()
+                last_optimize = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            db_logger.exception(f"Ошибка фоновой контрольной точки WAL: {e}")
+
+
+def get_checkpoint_stats() -> Dict[str, Any]:
+    """Возвращает счетчики контрольных точек WAL и запусков PRAGMA optimize с момента запуска."""
+    return dict(_checkpoint_stats)
+
+
+# --- Резервное копирование ---
+
+# Ключ app_settings, под которым хранится итог последнего резервного копирования (JSON)
+BACKUP_STATUS_KEY = 'last_backup'
+
+
+def create_backup_sync() -> Dict[str, Any]:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Создает снимок основной базы и архива всех шардов (см. database/backup.py).
+    Копирует с собственного соединения, а не из пула: пошаговое копирование с паузами
+    заняло бы читателя пула на все время копирования.
+
+    Returns:
+        Итог копирования: время начала (at, ISO UTC), ok и либо path/size/duration_s, либо error.
+    """
+    status: Dict[str, Any] = {'at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')}
+    connections: List[sqlite3.Connection] = []
+    try:
+        sources = []
+        for shard in shard_ids():
+            conn = _get_db_connection(shard)
+            connections.append(conn)
+            sources.append((conn, {'main': os.path.basename(_shard_files(shard)[0]),
+                                   archive.SCHEMA: os.path.basename(_shard_files(shard)[1])}))
+        result = backup.run_backup_sync(sources, BACKUP_DIR, keep=BACKUP_KEEP, pages=BACKUP_PAGES_PER_STEP,
+                                        sleep=BACKUP_STEP_SLEEP_MS / 1000, max_restarts=BACKUP_MAX_RESTARTS)
+        status.update(ok=True, **result)
+    except Exception as e:
+        db_logger.exception(f"Ошибка резервного копирования базы данных: {e}")
+        status.update(ok=False, error=str(e))
+    finally:
+        for conn in connections:
+            conn.close()
+    return status
+
+
+def save_backup_status_sync(conn: sqlite3.Connection, status: Dict[str, Any]):
+    """(СИНХРОННАЯ ФУНКЦИЯ) Сохраняет итог резервного копирования в app_settings (для консольной утилиты)."""
+    with conn:
+        conn.execute("INSERT INTO app_settings (key, value) VALUES (?, ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                     (BACKUP_STATUS_KEY, json.dumps(status, ensure_ascii=False)))
+
+
+def is_backup_running() -> bool:
+    """Проверяет, выполняется ли сейчас резервное копирование."""
+    return _backup_lock.locked()
+
+
+async def create_backup() -> Optional[Dict[str, Any]]:
+    """
+    Создает резервную копию в отдельном потоке и сохраняет ее итог в app_settings.
+
+    Returns:
+        Итог копирования (см. create_backup_sync) или None, если копирование уже выполняется.
+    """
+    if _backup_lock.locked():
+        return None
+    async with _backup_lock:
+        status = await asyncio.to_thread(create_backup_sync)
+        await set_app_setting(BACKUP_STATUS_KEY, json.dumps(status, ensure_ascii=False))
+    return status
+
+
+async def get_last_backup_status() -> Optional[Dict[str, Any]]:
+    """Возвращает итог последнего резервного копирования (None, если копий еще не было)."""
+    value = await get_app_setting(BACKUP_STATUS_KEY)
+    return json.loads(value) if value else None
+
+
+async def _backup_loop():
+    """Фоновая задача: создает резервную копию каждые BACKUP_INTERVAL_HOURS часов."""
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600)
+        try:
+            await create_backup()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            db_logger.exception(f"Ошибка фонового резервного копирования: {e}")
+
+
+async def get_user_profile(user_id: int) -> Optional[UserProfile]:
+    """
+    Возвращает профиль пользователя (строку `users` и имя активного диалога).
+    Читает из кэша, при промахе загружает строку одним запросом.
+    """
+    profile = _user_cache.get(user_id)
+    if profile is not None:
+        return profile
+    generation = _user_cache.generation
+    query = """
+        SELECT u.*, d.name AS active_dialog_name
+        FROM users u
+        LEFT JOIN dialogs d ON u.active_dialog_id = d.dialog_id
+        WHERE u.user_id = ?
+    """
+    row = await _execute_query(query, (user_id,), fetch_one=True, shard=_user_shard(user_id))
+    if not row:
+        return None
+    profile = UserProfile.from_row(row)
+    _user_cache.put(profile, generation=generation)
+    return profile
 
 
 async def add_or_update_user(user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]):
     """
     Добавляет нового пользователя или обновляет его данные (имена).
     Также создает диалог по умолчанию, если это необходимо.
+
+    Вызывается на каждое сообщение и callback, поэтому запись выполняется только при
+    изменении данных: сначала сверяется отпечаток последних увиденных имен, затем
+    закэшированный профиль, и лишь потом идет upsert с условием изменения полей.
     """
-    user_data = await _execute_query("SELECT user_id, active_dialog_id FROM users WHERE user_id = ?", (user_id,), fetch_one=True)
-
-    # ВРЕМЕННЫЙ ЛОГ 1
-    db_logger.info(f"[DEBUG] Проверка пользователя {user_id}. Найден в БД: {'Да' if user_data else 'Нет'}")
-
-    if not user_data:
-        # ВРЕМЕННЫЙ ЛОГ 2
-        db_logger.info(f"[DEBUG] Пользователь {user_id} определен как новый. Вызываю уведомление.")
-        db_logger.info(f"Добавляем нового пользователя {user_id} (@{username}).")
-        today_date_str = datetime.date.today().strftime('%Y-%m-%d')
-        query_insert_user = """
-            INSERT INTO users (user_id, username, first_name, last_name, first_interaction_date, gemini_model) 
-            VALUES (?, ?, ?, ?, ?, ?)
-        """
-        params = (user_id, username, first_name, last_name, today_date_str, DEFAULT_MODEL_ID)
-        await _execute_query(query_insert_user, params, is_write_operation=True)
+    identity = (username, first_name, last_name)
+    if _identity_fingerprints.get(user_id) == identity:
+        return
+
+    profile = await get_user_profile(user_id)
+    if profile and profile.active_dialog_id and (profile.username, profile.first_name, profile.last_name) == identity:
+        _identity_fingerprints[user_id] = identity
+        return
+
+    today_date_str = datetime.date.today().strftime('%Y-%m-%d')
+    now_str = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    try:
+        async with transaction(_user_shard(user_id)) as tx:
+            existing = tx.fetch_one("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
+            # Имена перезаписываются, только если хотя бы одно из них изменилось
+            tx.execute("""
+                INSERT INTO users (user_id, username, first_name, last_name, first_interaction_date, gemini_model)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name
+                WHERE users.username IS NOT excluded.username
+                   OR users.first_name IS NOT excluded.first_name
+                   OR users.last_name IS NOT excluded.last_name
+            """, (user_id, username, first_name, last_name, today_date_str, DEFAULT_MODEL_ID))
+            # Диалог по умолчанию создается, только если активного диалога нет
+            tx.execute("""
+                INSERT INTO dialogs (user_id, name, created_at)
+                SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ? AND active_dialog_id IS NULL)
+            """, (user_id, "Основной диалог", now_str, user_id))
+            dialog_assigned = tx.execute(
+                "UPDATE users SET active_dialog_id = last_insert_rowid() WHERE user_id = ? AND active_dialog_id IS NULL",
+                (user_id,)
+            )
+            active = tx.fetch_one("SELECT active_dialog_id FROM users WHERE user_id = ?", (user_id,))
+    except sqlite3.Error:
+        return
+    is_new = existing.value is None
+    new_dialog_id = active.value['active_dialog_id'] if dialog_assigned.value else None
+    _identity_fingerprints[user_id] = identity
+
+    if is_new:
+        db_logger.info(f"Добавлен новый пользователь {user_id} (@{username}).")
         # Отправка уведомления администратору
         await tg_helpers.notify_admin_of_new_user(user_id, username, first_name, last_name)
-        # Создаем диалог по умолчанию для нового пользователя
-        await create_dialog(user_id, "Основной диалог", set_active=True)
+    elif new_dialog_id:
+        db_logger.warning(f"У существующего пользователя {user_id} не было активного диалога.")
+
+    if new_dialog_id:
+        db_logger.info(f"Для пользователя {user_id} создан новый диалог 'Основной диалог' (ID: {new_dialog_id}).")
+        _user_cache.invalidate(user_id)
     else:
-        # Пользователь уже существует, обновляем его имена, так как они могли измениться
-        query_update_user = """
-            UPDATE users SET username = ?, first_name = ?, last_name = ? WHERE user_id = ?
-        """
-        params = (username, first_name, last_name, user_id)
-        await _execute_query(query_update_user, params, is_write_operation=True)
-        
-        # Проверяем, есть ли у пользователя активный диалог (для старых пользователей)
-        if not user_data['active_dialog_id']:
-            db_logger.warning(f"У существующего пользователя {user_id} нет активного диалога. Создаем новый.")
-            await create_dialog(user_id, "Основной диалог", set_active=True)
+        _user_cache.update(user_id, username=username, first_name=first_name, last_name=last_name)
 
 
 async def create_dialog(user_id: int, name: str, set_active: bool = False) -> Optional[int]:
-    """Создает новый диалог для пользователя и опционально делает его активным."""
+    """Создает новый диалог для пользователя и опционально делает его активным (в одной транзакции)."""
     now_str = datetime.datetime.now(datetime.timezone.utc).isoformat()
-    query = "INSERT INTO dialogs (user_id, name, created_at) VALUES (?, ?, ?)"
-    new_dialog_id = await _execute_query(query, (user_id, name, now_str), is_write_operation=True)
+    try:
+        async with transaction(_user_shard(user_id)) as tx:
+            inserted = tx.execute("INSERT INTO dialogs (user_id, name, created_at) VALUES (?, ?, ?)", (user_id, name, now_str))
+            if set_active:
+                tx.execute("UPDATE users SET active_dialog_id = last_insert_rowid() WHERE user_id = ?", (user_id,))
+    except sqlite3.Error:
+        return None
+    new_dialog_id = inserted.value
     if new_dialog_id:
         if set_active:
-            await set_active_dialog(user_id, new_dialog_id)
+            _user_cache.update(user_id, active_dialog_id=new_dialog_id, active_dialog_name=name)
         db_logger.info(f"Для пользователя {user_id} создан новый диалог '{name}' (ID: {new_dialog_id}).")
         return int(new_dialog_id)
     return None
 
 
 async def get_user_dialogs(user_id: int) -> List[Dict[str, Any]]:
-    """Получает список всех диалогов пользователя."""
-    query = "SELECT d.dialog_id, d.name, u.active_dialog_id FROM dialogs d JOIN users u ON d.user_id = u.user_id WHERE d.user_id = ? ORDER BY d.created_at DESC"
-    rows = await _execute_query(query, (user_id,), fetch_all=True)
+    """Получает список всех диалогов пользователя, недавно активные — первыми."""
+    query = """
+        SELECT d.dialog_id, d.name, u.active_dialog_id, d.message_count, d.last_message_at
+        FROM dialogs d JOIN users u ON d.user_id = u.user_id
+        WHERE d.user_id = ? AND d.deleted_at IS NULL
+        ORDER BY COALESCE(d.last_message_at, CAST(strftime('%s', d.created_at) AS INTEGER)) DESC, d.dialog_id DESC
+    """
+    rows = await _execute_query(query, (user_id,), fetch_all=True, shard=_user_shard(user_id))
     return [dict(row) for row in rows] if rows else []
 
 
 async def set_active_dialog(user_id: int, dialog_id: int):
-    """Устанавливает активный диалог для пользователя."""
-    query = "UPDATE users SET active_dialog_id = ? WHERE user_id = ?"
-    await _execute_query(query, (dialog_id, user_id), is_write_operation=True)
+    """Устанавливает активный диалог для пользователя (удаленный диалог активным не становится)."""
+    try:
+        async with transaction(_user_shard(user_id)) as tx:
+            dialog = tx.require("SELECT name FROM dialogs WHERE dialog_id = ? AND user_id = ? AND deleted_at IS NULL",
+                                (dialog_id, user_id), reason="диалог не найден или удален")
+            tx.execute("UPDATE users SET active_dialog_id = ? WHERE user_id = ?", (dialog_id, user_id))
+    except sqlite3.Error:
+        _user_cache.invalidate(user_id)
+        return
+    if tx.aborted:
+        db_logger.warning(f"Диалог {dialog_id} не установлен активным для пользователя {user_id}: {tx.abort_reason}.")
+        return
+    _user_cache.update(user_id, active_dialog_id=dialog_id,
+                       active_dialog_name=dialog.value['name'] if dialog.value else None)
     db_logger.info(f"Для пользователя {user_id} установлен активный диалог ID: {dialog_id}.")
 
 
-async def rename_dialog(dialog_id: int, new_name: str):
-    """Переименовывает диалог."""
-    query = "UPDATE dialogs SET name = ? WHERE dialog_id = ?"
-    await _execute_query(query, (new_name, dialog_id), is_write_operation=True)
+async def rename_dialog(user_id: int, dialog_id: int, new_name: str):
+    """Переименовывает диалог пользователя."""
+    query = "UPDATE dialogs SET name = ? WHERE dialog_id = ? AND user_id = ?"
+    if await _execute_query(query, (new_name, dialog_id, user_id), is_write_operation=True,
+                            shard=_user_shard(user_id)) is None:
+        return
+    _user_cache.rename_dialog(dialog_id, new_name)
     db_logger.info(f"Диалог ID {dialog_id} переименован в '{new_name}'.")
 
 
 async def delete_dialog(user_id: int, dialog_id_to_delete: int) -> Optional[str]:
     """
-    Удаляет диалог и его историю. Гарантирует, что у пользователя останется активный диалог.
-    Возвращает имя удаленного диалога.
+    Удаляет диалог: помечает его удаленным (он сразу пропадает из списка, поиска и счетчика сообщений
+    пользователя), а историю удаляет пачками фоновая задача (см. dialog_reaper). Гарантирует, что
+    у пользователя останется активный диалог. Возвращает имя удаленного диалога.
     """
-    other_dialogs = await _execute_query(
-        "SELECT dialog_id FROM dialogs WHERE user_id = ? AND dialog_id != ? ORDER BY created_at DESC",
-        (user_id, dialog_id_to_delete),
-        fetch_all=True
-    )
-    if not other_dialogs:
-        db_logger.warning(f"Попытка удалить последний диалог {dialog_id_to_delete} для пользователя {user_id}. Операция отменена.")
+    now_ts = int(time.time())
+    try:
+        async with transaction(_user_shard(user_id)) as tx:
+            tx.require("SELECT 1 FROM dialogs WHERE user_id = ? AND dialog_id != ? AND deleted_at IS NULL LIMIT 1",
+                       (user_id, dialog_id_to_delete), reason="последний диалог пользователя")
+            dialog = tx.require("SELECT name FROM dialogs WHERE dialog_id = ? AND user_id = ? AND deleted_at IS NULL",
+                                (dialog_id_to_delete, user_id), reason="диалог не найден")
+            # Если удаляется активный диалог — активным становится самый новый из оставшихся
+            tx.execute("""
+                UPDATE users SET active_dialog_id = (
+                    SELECT dialog_id FROM dialogs WHERE user_id = ? AND dialog_id != ? AND deleted_at IS NULL
+                    ORDER BY created_at DESC LIMIT 1
+                )
+                WHERE user_id = ? AND active_dialog_id = ?
+            """, (user_id, dialog_id_to_delete, user_id, dialog_id_to_delete))
+            # Сообщения удаляемого диалога сразу вычитаются из счетчика пользователя
+            tx.execute("""
+                UPDATE users SET message_count = MAX(message_count - COALESCE((
+                    SELECT message_count FROM dialogs WHERE dialog_id = ?
+                ), 0), 0)
+                WHERE user_id = ?
+            """, (dialog_id_to_delete, user_id))
+            deleted = tx.execute("UPDATE dialogs SET deleted_at = ? WHERE dialog_id = ?", (now_ts, dialog_id_to_delete))
+            tx.execute("""
+                UPDATE users SET last_message_at = (
+                    SELECT MAX(last_message_at) FROM dialogs WHERE user_id = ? AND deleted_at IS NULL
+                )
+                WHERE user_id = ?
+            """, (user_id, user_id))
+            active = tx.fetch_one("""
+                SELECT u.active_dialog_id, d.name FROM users u
+                LEFT JOIN dialogs d ON d.dialog_id = u.active_dialog_id
+                WHERE u.user_id = ?
+            """, (user_id,))
+    except sqlite3.Error:
         return None
-    
-    active_dialog_id = await get_active_dialog_id(user_id)
-    if active_dialog_id == dialog_id_to_delete:
-        new_active_dialog_id = other_dialogs[0]['dialog_id']
-        await set_active_dialog(user_id, new_active_dialog_id)
-
-    dialog_info = await _execute_query("SELECT name FROM dialogs WHERE dialog_id = ?", (dialog_id_to_delete,), fetch_one=True)
-    if not dialog_info: return None
-
-    delete_query = "DELETE FROM dialogs WHERE dialog_id = ?"
-    rows_affected = await _execute_query(delete_query, (dialog_id_to_delete,), is_write_operation=True)
-    if rows_affected:
-        db_logger.info(f"Диалог ID {dialog_id_to_delete} удален для пользователя {user_id}.")
-        return dialog_info['name']
+
+    if tx.aborted:
+        db_logger.warning(f"Удаление диалога {dialog_id_to_delete} для пользователя {user_id} отменено: {tx.abort_reason}.")
+        return None
+    if active.value:
+        _user_cache.update(user_id, active_dialog_id=active.value['active_dialog_id'],
+                           active_dialog_name=active.value['name'])
+    if deleted.value:
+        db_logger.info(f"Диалог ID {dialog_id_to_delete} удален для пользователя {user_id}, история удаляется в фоне.")
+        if _reaper_wakeup is not None:
+            _reaper_wakeup.set()
+        return dialog.value['name']
     return None
 
 
 async def get_active_dialog_id(user_id: int) -> Optional[int]:
     """Получает ID активного диалога пользователя."""
-    query = "SELECT active_dialog_id FROM users WHERE user_id = ?"
-    result = await _execute_query(query, (user_id,), fetch_one=True)
-    return result['active_dialog_id'] if result else None
+    profile = await get_user_profile(user_id)
+    return profile.active_dialog_id if profile else None
 
 
 async def get_user_context_info(user_id: int) -> Optional[Dict[str, Any]]:
-    """Получает единым запросом всю информацию для контекстного заголовка."""
-    query = """
-        SELECT
-            d.name as dialog_name,
-            u.gemini_model,
-            u.active_persona
-        FROM users u
-        LEFT JOIN dialogs d ON u.active_dialog_id = d.dialog_id
-        WHERE u.user_id = ?
+    """Получает из профиля всю информацию для контекстного заголовка."""
+    profile = await get_user_profile(user_id)
+    if not profile:
+        return None
+    return {
+        'dialog_name': profile.active_dialog_name,
+        'gemini_model': profile.gemini_model,
+        'active_persona': profile.active_persona,
+    }
+
+
+def _store_message_sync(conn: sqlite3.Connection, user_id: int, dialog_id: int, role: str, message_text: str,
+                        prompt_tokens: int, completion_tokens: int, total_tokens: int,
+                        model: Optional[str], now: datetime.datetime) -> Optional[int]:
     """
-    result = await _execute_query(query, (user_id,), fetch_one=True)
-    return dict(result) if result else None
+    (СИНХРОННАЯ ВНУТРЕННЯЯ ФУНКЦИЯ) Вставляет сообщение, обновляет счетчики сообщений диалога
+    и пользователя и, для ответа бота, увеличивает суточные суммы токенов в usage_daily.
+    Длинный текст сохраняется в message_blobs, а строка сообщения получает ссылку на него.
+    Сообщение в диалог, удаленный за время подготовки ответа, не сохраняется.
+    Выполняется писателем пула одной транзакцией.
+    """
+    dialog = conn.execute("SELECT deleted_at FROM dialogs WHERE dialog_id = ?", (dialog_id,)).fetchone()
+    if dialog is not None and dialog['deleted_at'] is not None:
+        return None
+    ts = int(now.timestamp())
+    blob_hash = None
+    if message_text and len(message_text.encode('utf-8')) >= MESSAGE_BLOB_MIN_BYTES:
+        blob_hash = message_blobs.store_sync(conn, message_text)
+        message_text = None
+    cursor = conn.execute("""
+        INSERT INTO conversations
+        (user_id, dialog_id, timestamp, ts, role, message_text, blob_hash,
+         prompt_tokens, completion_tokens, total_tokens, model)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, dialog_id, now.isoformat(), ts, role, message_text, blob_hash,
+          prompt_tokens, completion_tokens, total_tokens, model))
+    conn.execute("UPDATE dialogs SET message_count = message_count + 1, last_message_at = ? WHERE dialog_id = ?",
+                 (ts, dialog_id))
+    conn.execute("UPDATE users SET message_count = message_count + 1, last_message_at = ? WHERE user_id = ?",
+                 (ts, user_id))
+    if role == 'bot':
+        conn.execute("""
+            INSERT INTO usage_daily (user_id, day, model, prompt, completion, total, requests)
+            VALUES (?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT(user_id, day, model) DO UPDATE SET
+                prompt = prompt + excluded.prompt,
+                completion = completion + excluded.completion,
+                total = total + excluded.total,
+                requests = requests + 1
+        """, (user_id, now.strftime('%Y-%m-%d'), model or '', prompt_tokens, completion_tokens, total_tokens))
+    return cursor.lastrowid
 
 
 async def store_message(user_id: int, dialog_id: int, role: str, message_text: str,
-                  prompt_tokens: int = 0, completion_tokens: int = 0, total_tokens: int = 0):
-    """Сохраняет сообщение в базу данных с привязкой к диалогу."""
+                  prompt_tokens: int = 0, completion_tokens: int = 0, total_tokens: int = 0,
+                  model: Optional[str] = None):
+    """Сохраняет сообщение в базу данных с привязкой к диалогу (для ответа бота — с моделью и токенами)."""
     if role not in ('user', 'bot'): return
-    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
-    query = """
-        INSERT INTO conversations 
-        (user_id, dialog_id, timestamp, role, message_text, prompt_tokens, completion_tokens, total_tokens) 
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """
-    params = (user_id, dialog_id, timestamp, role, message_text, prompt_tokens, completion_tokens, total_tokens)
-    await _execute_query(query, params, is_write_operation=True)
+    job = functools.partial(
+        _store_message_sync, user_id=user_id, dialog_id=dialog_id, role=role, message_text=message_text,
+        prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=total_tokens,
+        model=model, now=datetime.datetime.now(datetime.timezone.utc)
+    )
+    await _run_in_pool(job, write=True, shard=_user_shard(user_id))
 
 
-async def get_conversation_history(dialog_id: int, limit: int = 20) -> List[Dict[str, Any]]:
-    """Получает историю сообщений для конкретного диалога."""
-    query = "SELECT role, message_text FROM conversations WHERE dialog_id = ? ORDER BY conversation_id DESC LIMIT ?"
-    rows = await _execute_query(query, (dialog_id, limit), fetch_all=True)
+async def get_conversation_history(user_id: int, dialog_id: int, limit: int = 20) -> List[Dict[str, Any]]:
+    """Получает историю сообщений для конкретного диалога пользователя."""
+    query = "SELECT role, message_text FROM conversations_text WHERE dialog_id = ? ORDER BY conversation_id DESC LIMIT ?"
+    rows = await _execute_query(query, (dialog_id, limit), fetch_all=True, shard=_user_shard(user_id))
     return [dict(row) for row in reversed(rows)] if rows else []
 
 
-async def get_conversation_history_by_date(dialog_id: int, history_date: datetime.date) -> List[Dict[str, Any]]:
-    """Получает историю сообщений для конкретного диалога за определенную дату."""
-    start_dt = datetime.datetime.combine(history_date, datetime.time.min, tzinfo=datetime.timezone.utc)
-    end_dt = datetime.datetime.combine(history_date, datetime.time.max, tzinfo=datetime.timezone.utc)
-    query = "SELECT role, message_text FROM conversations WHERE dialog_id = ? AND timestamp BETWEEN ? AND ? ORDER BY timestamp ASC"
-    rows = await _execute_query(query, (dialog_id, start_dt.isoformat(), end_dt.isoformat()), fetch_all=True)
-    return [dict(row) for row in rows] if rows else []
+def _history_by_date_sync(conn: sqlite3.Connection, dialog_id: int, history_date: datetime.date) -> List[Dict[str, Any]]:
+    """(СИНХРОННАЯ ВНУТРЕННЯЯ ФУНКЦИЯ) Сообщения диалога за день из основной базы и архива."""
+    start_ts = int(datetime.datetime.combine(history_date, datetime.time.min, tzinfo=datetime.timezone.utc).timestamp())
+    end_ts = start_ts + 86400
+    messages = {row['conversation_id']: dict(row) for row in conn.execute("""
+        SELECT conversation_id, role, message_text, ts FROM conversations_text
+        WHERE dialog_id = ? AND ts >= ? AND ts < ?
+    """, (dialog_id, start_ts, end_ts))}
+    for message in archive.read_day_sync(conn, dialog_id, history_date.strftime('%Y-%m-%d')):
+        if start_ts <= message['ts'] < end_ts:
+            messages.setdefault(message['conversation_id'], message)
+    ordered = sorted(messages.values(), key=lambda m: (m['ts'], m['conversation_id']))
+    return [{'role': m['role'], 'message_text': m['message_text']} for m in ordered]
+
+
+async def get_conversation_history_by_date(user_id: int, dialog_id: int,
+                                           history_date: datetime.date) -> List[Dict[str, Any]]:
+    """Получает историю сообщений для конкретного диалога пользователя за определенную дату (включая архив)."""
+    return await _run_in_pool(functools.partial(_history_by_date_sync, dialog_id=dialog_id, history_date=history_date),
+                              default=[], shard=_user_shard(user_id))
+
+
+# Маркеры подсветки совпадений в сниппетах поиска (управляющие символы, не встречающиеся в тексте)
+SEARCH_HIGHLIGHT_START = '\x02'
+SEARCH_HIGHLIGHT_END = '\x03'
+
+
+def _build_fts_query(text: str) -> Optional[str]:
+    """
+    Превращает пользовательский ввод в безопасный запрос FTS5: каждое слово берется
+    в кавычки (операторы FTS5 не интерпретируются) и ищется по префиксу; слова объединяются по И.
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def _search_messages_sync(conn: sqlite3.Connection, fts_query: str, user_id: int, dialog_id: Optional[int],
+                          count: int) -> List[Dict[str, Any]]:
+    """
+    (СИНХРОННАЯ ВНУТРЕННЯЯ ФУНКЦИЯ) Первые `count` совпадений по основной базе и архиву вместе,
+    по убыванию релевантности. Сообщение, оказавшееся в обоих местах после сбоя, берется из основной базы.
+    """
+    dialog_filter = " AND c.dialog_id = ?" if dialog_id is not None else ""
+    params: Tuple[Any, ...] = (SEARCH_HIGHLIGHT_START, SEARCH_HIGHLIGHT_END, fts_query, user_id)
+    if dialog_id is not None:
+        params += (dialog_id,)
+    rows = conn.execute(f"""
+        SELECT c.conversation_id, c.dialog_id, d.name AS dialog_name, c.role, c.ts,
+               snippet(conversations_fts, 0, ?, ?, '…', 12) AS snippet, rank
+        FROM conversations_fts
+        JOIN conversations c ON c.conversation_id = conversations_fts.rowid
+        JOIN dialogs d ON d.dialog_id = c.dialog_id
+        WHERE conversations_fts MATCH ? AND c.user_id = ? AND d.deleted_at IS NULL{dialog_filter}
+        ORDER BY rank
+        LIMIT ?
+    """, params + (count,)).fetchall()
+    found = {row['conversation_id']: dict(row) for row in rows}
+    for result in archive.search_sync(conn, fts_query, user_id, dialog_id, count,
+                                      (SEARCH_HIGHLIGHT_START, SEARCH_HIGHLIGHT_END)):
+        found.setdefault(result['conversation_id'], result)
+    # rank обоих индексов — bm25 со своей статистикой, для слияния страниц этого достаточно
+    merged = sorted(found.values(), key=lambda result: result.pop('rank'))
+    return merged[:count]
+
+
+async def search_messages(user_id: int, query: str, dialog_id: Optional[int] = None,
+                          limit: int = 5, offset: int = 0) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Полнотекстовый поиск по сообщениям пользователя (во всех диалогах или в одном), включая архив.
+
+    Args:
+        user_id: ID пользователя.
+        query: Поисковый запрос в свободной форме.
+        dialog_id: Ограничить поиск одним диалогом.
+        limit: Размер страницы.
+        offset: Смещение страницы.
+
+    Returns:
+        Кортеж (результаты страницы по убыванию релевантности, есть ли следующая страница).
+        Каждый результат: conversation_id, dialog_id, dialog_name, role, ts и snippet
+        с совпадениями между SEARCH_HIGHLIGHT_START и SEARCH_HIGHLIGHT_END.
+    """
+    fts_query = _build_fts_query(query)
+    if not fts_query:
+        return [], False
+    # Берем на одну строку больше, чтобы узнать, есть ли следующая страница
+    rows = await _run_in_pool(functools.partial(_search_messages_sync, fts_query=fts_query, user_id=user_id,
+                                                dialog_id=dialog_id, count=offset + limit + 1),
+                              default=[], shard=_user_shard(user_id))
+    return rows[offset:offset + limit], len(rows) > offset + limit
 
 
 async def get_total_user_message_count(user_id: int) -> int:
     """Получает общее количество сообщений пользователя во всех его диалогах."""
-    query = "SELECT COUNT(*) FROM conversations WHERE user_id = ?"
-    count = await _execute_query(query, (user_id,))
-    return count if count is not None else 0
+    query = "SELECT message_count FROM users WHERE user_id = ?"
+    result = await _execute_query(query, (user_id,), fetch_one=True, shard=_user_shard(user_id))
+    return result['message_count'] if result else 0
+
+
+async def _set_user_column(user_id: int, column: str, value: Any, **cached: Any) -> bool:
+    """
+    Записывает столбец `column` в users и только при успешной записи обновляет кэш профиля
+    полями `cached` (по умолчанию — тем же значением под именем столбца): _execute_query
+    глотает ошибки записи, и иначе кэш отдавал бы значение, которого нет в базе.
+    """
+    updated = await _execute_query(f"UPDATE users SET {column} = ? WHERE user_id = ?", (value, user_id),
+                                   is_write_operation=True, shard=_user_shard(user_id))
+    if updated is None:
+        return False
+    _user_cache.update(user_id, **(cached or {column: value}))
+    return True
 
 
 async def set_user_bot_style(user_id: int, style: str):
-    user_info = await _execute_query("SELECT username, first_name, last_name FROM users WHERE user_id = ?", (user_id,), fetch_one=True)
-    await add_or_update_user(user_id, user_info['username'], user_info['first_name'], user_info['last_name'])
-    query = "UPDATE users SET bot_style = ? WHERE user_id = ?"
-    await _execute_query(query, (style, user_id), is_write_operation=True)
+    await _set_user_column(user_id, 'bot_style', style)
 
 
 async def get_user_bot_style(user_id: int) -> str:
-    query = "SELECT bot_style FROM users WHERE user_id = ?"
-    result = await _execute_query(query, (user_id,), fetch_one=True)
-    return result['bot_style'] if result else 'default'
+    profile = await get_user_profile(user_id)
+    return profile.bot_style if profile else 'default'
 
 
 async def set_user_api_key(user_id: int, api_key: Optional[str]):
     """Устанавливает или сбрасывает API-ключ пользователя."""
-    user_info = await _execute_query("SELECT username, first_name, last_name FROM users WHERE user_id = ?", (user_id,), fetch_one=True)
-    await add_or_update_user(user_id, user_info['username'], user_info['first_name'], user_info['last_name'])
     encrypted_key = crypto_helpers.encrypt_data(api_key) if api_key else None
-    query = "UPDATE users SET api_key = ? WHERE user_id = ?"
-    await _execute_query(query, (encrypted_key, user_id), is_write_operation=True)
-    db_logger.info(f"API-ключ для пользователя {user_id} {'установлен' if api_key else 'сброшен'}.")
+    if await _set_user_column(user_id, 'api_key', encrypted_key):
+        db_logger.info(f"API-ключ для пользователя {user_id} {'установлен' if api_key else 'сброшен'}.")
 
 
 async def get_user_api_key(user_id: int) -> Optional[str]:
-    query = "SELECT api_key FROM users WHERE user_id = ?"
-    result = await _execute_query(query, (user_id,), fetch_one=True)
-    if result and result['api_key']:
-        encrypted_key = result['api_key']
+    profile = await get_user_profile(user_id)
+    if profile and profile.api_key:
+        encrypted_key = profile.api_key
         try:
             return crypto_helpers.decrypt_data(encrypted_key)
         except Exception as e:
@@ -439,62 +1434,51 @@ async def get_user_api_key(user_id: int) -> Optional[str]:
 
 
 async def set_user_language(user_id: int, lang_code: str):
-    user_info = await _execute_query("SELECT username, first_name, last_name FROM users WHERE user_id = ?", (user_id,), fetch_one=True)
-    await add_or_update_user(user_id, user_info['username'], user_info['first_name'], user_info['last_name'])
-    query = "UPDATE users SET language_code = ? WHERE user_id = ?"
-    await _execute_query(query, (lang_code, user_id), is_write_operation=True)
+    await _set_user_column(user_id, 'language_code', lang_code)
 
 
 async def get_user_language(user_id: int) -> str:
-    query = "SELECT language_code FROM users WHERE user_id = ?"
-    result = await _execute_query(query, (user_id,), fetch_one=True)
-    return result['language_code'] if result and result['language_code'] else 'ru'
+    profile = await get_user_profile(user_id)
+    return profile.language_code if profile and profile.language_code else 'ru'
 
 
 async def set_user_gemini_model(user_id: int, model_name: str):
-    user_info = await _execute_query("SELECT username, first_name, last_name FROM users WHERE user_id = ?", (user_id,), fetch_one=True)
-    await add_or_update_user(user_id, user_info['username'], user_info['first_name'], user_info['last_name'])
-    query = "UPDATE users SET gemini_model = ? WHERE user_id = ?"
-    await _execute_query(query, (model_name, user_id), is_write_operation=True)
+    await _set_user_column(user_id, 'gemini_model', model_name)
 
 
 async def get_user_gemini_model(user_id: int) -> Optional[str]:
-    query = "SELECT gemini_model FROM users WHERE user_id = ?"
-    result = await _execute_query(query, (user_id,), fetch_one=True)
-    return result['gemini_model'] if result and result['gemini_model'] else None
+    profile = await get_user_profile(user_id)
+    return profile.gemini_model if profile and profile.gemini_model else None
 
 
 async def set_user_persona(user_id: int, persona_id: str):
-    user_info = await _execute_query("SELECT username, first_name, last_name FROM users WHERE user_id = ?", (user_id,), fetch_one=True)
-    await add_or_update_user(user_id, user_info['username'], user_info['first_name'], user_info['last_name'])
-    query = "UPDATE users SET active_persona = ? WHERE user_id = ?"
-    await _execute_query(query, (persona_id, user_id), is_write_operation=True)
+    await _set_user_column(user_id, 'active_persona', persona_id)
 
 
 async def get_user_persona(user_id: int) -> str:
-    query = "SELECT active_persona FROM users WHERE user_id = ?"
-    result = await _execute_query(query, (user_id,), fetch_one=True)
-    return result['active_persona'] if result and result['active_persona'] else 'default'
+    profile = await get_user_profile(user_id)
+    return profile.active_persona if profile and profile.active_persona else 'default'
 
 
 async def get_first_interaction_date(user_id: int) -> Optional[str]:
-    query = "SELECT first_interaction_date FROM users WHERE user_id = ?"
-    result = await _execute_query(query, (user_id,), fetch_one=True)
-    return result['first_interaction_date'] if result else None
+    profile = await get_user_profile(user_id)
+    return profile.first_interaction_date if profile else None
 
 
 async def get_token_usage_by_period(user_id: int, period: str) -> Dict[str, int]:
+    # Сутки в usage_daily считаются по UTC
+    today = datetime.datetime.now(datetime.timezone.utc).date()
     if period == 'today':
-        start_date_str = datetime.date.today().isoformat() + "T00:00:00Z"
+        start_date = today
     elif period == 'month':
-        start_date_str = datetime.date.today().replace(day=1).isoformat() + "T00:00:00Z"
+        start_date = today.replace(day=1)
     else:
         return {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
 
-    query = "SELECT SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens) FROM conversations WHERE user_id = ? AND timestamp >= ?"
-    params = (user_id, start_date_str)
+    query = "SELECT SUM(prompt), SUM(completion), SUM(total) FROM usage_daily WHERE user_id = ? AND day >= ?"
+    params = (user_id, start_date.isoformat())
     
-    result_row = await _execute_query(query, params, fetch_one=True)
+    result_row = await _execute_query(query, params, fetch_one=True, shard=_user_shard(user_id))
     
     if result_row and result_row[0] is not None:
         return {
@@ -520,48 +1504,44 @@ async def get_app_setting(key: str) -> Optional[str]:
 
 async def is_user_blocked(user_id: int) -> bool:
     """Проверяет, заблокирован ли пользователь."""
-    query = "SELECT is_blocked FROM users WHERE user_id = ?"
-    result = await _execute_query(query, (user_id,), fetch_one=True)
-    return result['is_blocked'] == 1 if result else False
+    profile = await get_user_profile(user_id)
+    return profile.is_blocked if profile else False
 
 async def block_user(user_id: int):
     """Блокирует пользователя."""
-    await _execute_query("UPDATE users SET is_blocked = 1 WHERE user_id = ?", (user_id,), is_write_operation=True)
-    db_logger.info(f"Пользователь {user_id} заблокирован.")
+    if await _set_user_column(user_id, 'is_blocked', 1, is_blocked=True):
+        db_logger.info(f"Пользователь {user_id} заблокирован.")
 
 async def unblock_user(user_id: int):
     """Разблокирует пользователя."""
-    await _execute_query("UPDATE users SET is_blocked = 0 WHERE user_id = ?", (user_id,), is_write_operation=True)
-    db_logger.info(f"Пользователь {user_id} разблокирован.")
+    if await _set_user_column(user_id, 'is_blocked', 0, is_blocked=False):
+        db_logger.info(f"Пользователь {user_id} разблокирован.")
 
-async def get_all_user_ids() -> List[int]:
-    """Возвращает список ID всех пользователей."""
-    rows = await _execute_query("SELECT user_id FROM users", fetch_all=True)
-    return [row['user_id'] for row in rows] if rows else []
+async def iterate_user_ids() -> AsyncIterator[int]:
+    """Потоково перебирает ID всех пользователей всех шардов по возрастанию (см. iterate_all_shards)."""
+    async for row in iterate_all_shards("users", "user_id", key="user_id"):
+        yield row['user_id']
 
 async def get_total_users_count() -> int:
     """Возвращает общее количество пользователей."""
-    count = await _execute_query("SELECT COUNT(*) FROM users")
-    return count if count is not None else 0
+    return await _sum_over_shards("SELECT COUNT(*) FROM users")
 
 async def get_blocked_users_count() -> int:
     """Возвращает количество заблокированных пользователей."""
-    count = await _execute_query("SELECT COUNT(*) FROM users WHERE is_blocked = 1")
-    return count if count is not None else 0
+    return await _sum_over_shards("SELECT COUNT(*) FROM users WHERE is_blocked = 1")
 
 async def get_active_users_count(days: int = 7) -> int:
     """Возвращает количество пользователей, отправлявших сообщения за последние N дней."""
     start_date = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
-    query = "SELECT COUNT(DISTINCT user_id) FROM conversations WHERE timestamp >= ?"
-    count = await _execute_query(query, (start_date.isoformat(),))
-    return count if count is not None else 0
+    # Счетчики пользователя учитывают и архив истории
+    query = "SELECT COUNT(*) FROM users WHERE last_message_at >= ?"
+    return await _sum_over_shards(query, (int(start_date.timestamp()),))
 
 async def get_new_users_count(days: int = 7) -> int:
     """Возвращает количество новых пользователей за последние N дней."""
     start_date = datetime.date.today() - datetime.timedelta(days=days)
     query = "SELECT COUNT(*) FROM users WHERE first_interaction_date >= ?"
-    count = await _execute_query(query, (start_date.strftime('%Y-%m-%d'),))
-    return count if count is not None else 0
+    return await _sum_over_shards(query, (start_date.strftime('%Y-%m-%d'),))
 
 async def get_user_info_for_admin(user_id: int) -> Optional[Dict[str, Any]]:
     """Собирает подробную информацию о пользователе для админ-панели."""
@@ -574,11 +1554,12 @@ async def get_user_info_for_admin(user_id: int) -> Optional[Dict[str, Any]]:
             u.language_code,
             u.first_interaction_date,
             u.is_blocked,
-            (SELECT COUNT(*) FROM conversations WHERE user_id = u.user_id) as message_count
+            u.message_count,
+            u.last_message_at
         FROM users u
         WHERE u.user_id = ?
     """
-    row = await _execute_query(query, (user_id,), fetch_one=True)
+    row = await _execute_query(query, (user_id,), fetch_one=True, shard=_user_shard(user_id))
     # Также обновляем информацию о пользователе при просмотре
     if row:
         user_info = dict(row)
@@ -590,19 +1571,8 @@ async def get_user_info_for_admin(user_id: int) -> Optional[Dict[str, Any]]:
 
 
 # --- НОВАЯ ФУНКЦИЯ ДЛЯ ЭКСПОРТА ---
-async def get_all_users_for_export() -> List[Dict[str, Any]]:
-    """Извлекает всех пользователей со всеми необходимыми полями для экспорта в CSV."""
-    query = """
-        SELECT
-            user_id,
-            username,
-            first_name,
-            last_name,
-            language_code,
-            first_interaction_date,
-            is_blocked
-        FROM users
-        ORDER BY user_id ASC
-    """
-    rows = await _execute_query(query, fetch_all=True)
-    return [dict(row) for row in rows] if rows else []
\ No newline at end of file
+async def iterate_users_for_export() -> AsyncIterator[sqlite3.Row]:
+    """Потоково перебирает всех пользователей всех шардов со всеми необходимыми полями для экспорта в CSV."""
+    columns = "user_id, username, first_name, last_name, language_code, first_interaction_date, is_blocked"
+    async for row in iterate_all_shards("users", columns, key="user_id"):
+        yield row
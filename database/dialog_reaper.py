@@ -0,0 +1,77 @@
+# File: database/dialog_reaper.py
+"""
+Фоновое удаление истории удаленных диалогов.
+
+`delete_dialog` только помечает диалог удаленным (dialogs.deleted_at): он сразу
+пропадает из списка диалогов и поиска, а его сообщения — из счетчика
+пользователя. Сами сообщения (в основной базе и в архиве) удаляются здесь
+пачками до `batch_size` штук; каждая пачка — отдельное задание писателя пула,
+так что между пачками проходят обычные записи пользователей. Когда у диалога
+не остается сообщений, удаляется и строка dialogs.
+
+Счетчик dialogs.message_count удаленного диалога уменьшается по мере удаления
+и показывает, сколько его сообщений еще осталось.
+"""
+import json
+import sqlite3
+from typing import Optional, Tuple
+
+from . import archive
+
+# Подзапрос: диалоги, ожидающие удаления (их сообщения не учитываются счетчиками пользователей)
+DELETED_DIALOGS_SQL = "SELECT dialog_id FROM dialogs WHERE deleted_at IS NOT NULL"
+
+
+def reap_batch_sync(conn: sqlite3.Connection, batch_size: int) -> Tuple[Optional[int], int, bool]:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Удаляет до `batch_size` сообщений диалога, помеченного удаленным раньше других:
+    сначала блоки архива (целиком, но хотя бы один за вызов), затем строки conversations (индекс FTS и
+    счетчики ссылок блобов обновляют триггеры). Выполняется писателем пула внутри его транзакции.
+
+    Returns:
+        (ID диалога или None, если удалять нечего; удалено сообщений; удален ли диалог полностью).
+    """
+    dialog = conn.execute("""
+        SELECT dialog_id FROM dialogs WHERE deleted_at IS NOT NULL ORDER BY deleted_at, dialog_id LIMIT 1
+    """).fetchone()
+    if dialog is None:
+        return None, 0, False
+    dialog_id = dialog['dialog_id']
+
+    blocks = conn.execute(f"""
+        SELECT block_id, message_count FROM {archive.SCHEMA}.conversation_blocks
+        WHERE dialog_id = ? ORDER BY day, seq
+    """, (dialog_id,)).fetchall()
+    removed, dropped_blocks = 0, []
+    for block in blocks:
+        if dropped_blocks and removed + block['message_count'] > batch_size:
+            break
+        dropped_blocks.append(block['block_id'])
+        removed += block['message_count']
+    if dropped_blocks:
+        conn.execute(f"DELETE FROM {archive.SCHEMA}.conversation_blocks "
+                     f"WHERE block_id IN (SELECT value FROM json_each(?))", (json.dumps(dropped_blocks),))
+    if removed < batch_size:
+        removed += conn.execute("""
+            DELETE FROM conversations WHERE conversation_id IN (
+                SELECT conversation_id FROM conversations WHERE dialog_id = ?
+                ORDER BY conversation_id LIMIT ?
+            )
+        """, (dialog_id, batch_size - removed)).rowcount
+
+    finished = (len(dropped_blocks) == len(blocks)
+                and conn.execute("SELECT 1 FROM conversations WHERE dialog_id = ? LIMIT 1", (dialog_id,)).fetchone() is None)
+    if finished:
+        conn.execute("DELETE FROM dialogs WHERE dialog_id = ?", (dialog_id,))
+    else:
+        conn.execute("UPDATE dialogs SET message_count = MAX(message_count - ?, 0) WHERE dialog_id = ?",
+                     (removed, dialog_id))
+    return dialog_id, removed, finished
+
+
+def pending_sync(conn: sqlite3.Connection) -> Tuple[int, int]:
+    """(СИНХРОННАЯ ФУНКЦИЯ) Сколько диалогов ожидают удаления и сколько в них осталось сообщений."""
+    row = conn.execute("""
+        SELECT COUNT(*), COALESCE(SUM(message_count), 0) FROM dialogs WHERE deleted_at IS NOT NULL
+    """).fetchone()
+    return row[0], row[1]
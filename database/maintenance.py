@@ -0,0 +1,157 @@
+# File: database/maintenance.py
+"""
+Служебные команды обслуживания базы данных.
+
+Запуск из корня проекта:
+    python -m database.maintenance rebuild-usage              — пересчитать usage_daily из conversations
+    python -m database.maintenance check-counters [--repair]  — сверить (и исправить) счетчики сообщений
+    python -m database.maintenance archive                    — перенести холодную историю в архив
+    python -m database.maintenance purge                      — применить политику хранения и вернуть место
+    python -m database.maintenance backup                     — создать проверенную резервную копию
+    python -m database.maintenance reshard [--shards N]       — перераспределить пользователей по N шардам
+
+Команды, работающие с данными, выполняются для каждого шарда (см. DB_SHARDS).
+"""
+import argparse
+import sys
+from typing import List, Optional
+
+from logger_config import setup_logging, get_logger
+from . import db_manager
+
+maintenance_logger = get_logger('database', user_id='System')
+
+
+def rebuild_usage(args: argparse.Namespace) -> int:
+    """Пересчитывает суточные суммы токенов (usage_daily) по истории сообщений."""
+    rows = 0
+    for shard in db_manager.shard_ids():
+        conn = db_manager._get_db_connection(shard)
+        try:
+            rows += db_manager.rebuild_usage_daily_sync(conn)
+        finally:
+            conn.close()
+    print(f"usage_daily пересчитана: {rows} строк.")
+    return 0
+
+
+def check_counters(args: argparse.Namespace) -> int:
+    """Сверяет денормализованные счетчики сообщений с историей и, по флагу --repair, исправляет их."""
+    drift = {'dialogs': 0, 'users': 0}
+    for shard in db_manager.shard_ids():
+        conn = db_manager._get_db_connection(shard)
+        try:
+            for key, value in db_manager.check_message_counters_sync(conn, repair=args.repair).items():
+                drift[key] += value
+        finally:
+            conn.close()
+    print(f"Расхождения счетчиков: диалогов {drift['dialogs']}, пользователей {drift['users']}.")
+    if args.repair:
+        print("Счетчики исправлены." if any(drift.values()) else "Исправлять нечего.")
+        return 0
+    return 1 if any(drift.values()) else 0
+
+
+def archive_history(args: argparse.Namespace) -> int:
+    """Переносит сообщения старше ARCHIVE_AFTER_DAYS в архив (не дожидаясь фонового архиватора)."""
+    if db_manager.ARCHIVE_AFTER_DAYS <= 0:
+        print("Архивирование выключено (ARCHIVE_AFTER_DAYS = 0).")
+        return 0
+    moved = 0
+    for shard in db_manager.shard_ids():
+        conn = db_manager._get_db_connection(shard)
+        conn.isolation_level = None
+        try:
+            moved += db_manager.archive_cold_messages_sync(conn)
+        finally:
+            conn.close()
+    print(f"В архив перенесено сообщений: {moved}.")
+    return 0
+
+
+def purge(args: argparse.Namespace) -> int:
+    """Применяет политику хранения (RETENTION_*) и возвращает свободные страницы файлам БД."""
+    removed = reclaimed = 0
+    for shard in db_manager.shard_ids():
+        conn = db_manager._get_db_connection(shard)
+        conn.isolation_level = None
+        try:
+            shard_removed, shard_reclaimed = db_manager.apply_retention_sync(conn)
+        finally:
+            conn.close()
+        removed += shard_removed
+        reclaimed += shard_reclaimed
+    print(f"Удалено сообщений: {removed}. Освобождено: {reclaimed} байт.")
+    return 0
+
+
+def backup(args: argparse.Namespace) -> int:
+    """Создает резервную копию основной базы и архива в BACKUP_DIR и сохраняет ее итог."""
+    status = db_manager.create_backup_sync()
+    conn = db_manager._get_db_connection()
+    try:
+        db_manager.save_backup_status_sync(conn, status)
+    finally:
+        conn.close()
+    if not status['ok']:
+        print(f"Резервная копия не создана: {status['error']}")
+        return 1
+    print(f"Резервная копия создана: {status['path']} ({status['size']} байт, {status['duration_s']} с).")
+    return 0
+
+
+def reshard(args: argparse.Namespace) -> int:
+    """Перераспределяет пользователей по шардам (бот должен быть остановлен)."""
+    result = db_manager.reshard_sync(args.shards)
+    print(f"Пользователей перенесено: {result['users']}, шардов: {result['shards']}. "
+          f"Старые файлы сохранены с суффиксом .pre-reshard.")
+    if result['shards'] != db_manager.DB_SHARDS:
+        print(f"Перед запуском бота установите DB_SHARDS={result['shards']}.")
+    return 0
+
+
+def _configure_reshard(parser: argparse.ArgumentParser):
+    parser.add_argument('--shards', type=int, default=db_manager.DB_SHARDS,
+                        help="Число шардов (по умолчанию DB_SHARDS).")
+
+
+def _configure_check_counters(parser: argparse.ArgumentParser):
+    parser.add_argument('--repair', action='store_true', help="Исправить найденные расхождения.")
+
+
+# Команда: (обработчик, описание, настройка аргументов подкоманды)
+COMMANDS = {
+    'rebuild-usage': (rebuild_usage, "Пересчитать таблицу usage_daily из conversations.", None),
+    'check-counters': (check_counters, "Сверить счетчики сообщений пользователей и диалогов.",
+                       _configure_check_counters),
+    'archive': (archive_history, "Перенести сообщения старше ARCHIVE_AFTER_DAYS в архив.", None),
+    'purge': (purge, "Применить политику хранения и выполнить incremental_vacuum.", None),
+    'backup': (backup, "Создать резервную копию базы и архива в BACKUP_DIR.", None),
+    'reshard': (reshard, "Перераспределить пользователей по шардам (бот должен быть остановлен).", _configure_reshard),
+}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m database.maintenance",
+                                     description="Обслуживание базы данных бота.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, (_, help_text, configure) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text)
+        if configure:
+            configure(subparser)
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    # Приводим схему к актуальной версии перед любой командой (решардинг сам мигрирует старую раскладку)
+    if args.command != 'reshard':
+        db_manager.setup_database_sync()
+    handler = COMMANDS[args.command][0]
+    try:
+        return handler(args)
+    except Exception as e:
+        maintenance_logger.exception(f"Ошибка выполнения команды '{args.command}': {e}")
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
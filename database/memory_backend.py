@@ -0,0 +1,397 @@
+# File: database/memory_backend.py
+"""
+Хранилище в памяти процесса (STORAGE_BACKEND=memory).
+
+Реализует тот же интерфейс `StorageBackend`, что и SQLite, на словарях и
+отсортированных списках: строки пользователей и диалогов — словари с теми же
+полями, что в таблицах; сообщения диалога — список по возрастанию ID (он же —
+по времени), поэтому история за день находится двоичным поиском по ts.
+Все операции выполняются в потоке event loop без ожидания, блокировки не нужны.
+
+Данные не сохраняются между запусками: хранилище предназначено для
+нагрузочных тестов и бенчмарков, которые измеряют стоимость обработчиков
+без дискового ввода-вывода.
+"""
+import bisect
+import datetime
+import itertools
+import re
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from logger_config import get_logger
+from config.settings import DEFAULT_MODEL_ID
+from utils import crypto_helpers
+from handlers import telegram_helpers as tg_helpers
+from .db_manager import SEARCH_HIGHLIGHT_START, SEARCH_HIGHLIGHT_END
+from .user_cache import UserProfile
+
+memory_logger = get_logger('database', user_id='System')
+
+# Слов по обе стороны от первого совпадения в сниппете поиска (как snippet(..., 12) в SQLite)
+_SNIPPET_WORDS = 6
+_EMPTY_USAGE = {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _snippet(text: str, words: List[str]) -> Optional[str]:
+    """Сниппет с подсвеченными словами, начинающимися с одного из `words`; None, если совпали не все слова."""
+    tokens = list(re.finditer(r'\w+', text))
+    hits = [i for i, token in enumerate(tokens) if token.group().lower().startswith(tuple(words))]
+    matched = {word for word in words if any(tokens[i].group().lower().startswith(word) for i in hits)}
+    if len(matched) < len(words):
+        return None
+    first, last = max(hits[0] - _SNIPPET_WORDS, 0), min(hits[0] + _SNIPPET_WORDS, len(tokens) - 1)
+    parts, cursor = [], tokens[first].start()
+    for i in range(first, last + 1):
+        token = tokens[i]
+        parts.append(text[cursor:token.start()])
+        parts.append(f"{SEARCH_HIGHLIGHT_START}{token.group()}{SEARCH_HIGHLIGHT_END}" if i in hits else token.group())
+        cursor = token.end()
+    prefix = '…' if first > 0 else ''
+    suffix = '…' if last < len(tokens) - 1 else ''
+    return prefix + "".join(parts) + suffix
+
+
+class InMemoryBackend:
+    """Хранилище на словарях в памяти процесса."""
+
+    def __init__(self):
+        self._users: Dict[int, Dict[str, Any]] = {}
+        # ID пользователей по возрастанию (для перебора, как ORDER BY user_id)
+        self._user_ids: List[int] = []
+        self._dialogs: Dict[int, Dict[str, Any]] = {}
+        self._user_dialogs: Dict[int, List[int]] = {}
+        # Сообщения диалога по возрастанию conversation_id и параллельный список их ts
+        self._messages: Dict[int, List[Dict[str, Any]]] = {}
+        self._message_ts: Dict[int, List[int]] = {}
+        # (user_id, день UTC, модель) -> [prompt, completion, total, requests], как usage_daily
+        self._usage: Dict[Tuple[int, str, str], List[int]] = {}
+        self._settings: Dict[str, str] = {}
+        self._dialog_ids = itertools.count(1)
+        self._conversation_ids = itertools.count(1)
+
+    # --- Жизненный цикл ---
+
+    async def setup_database(self):
+        memory_logger.warning("Используется хранилище в памяти (STORAGE_BACKEND=memory): данные не сохраняются.")
+
+    async def close_database(self):
+        memory_logger.info(f"Хранилище в памяти закрыто (пользователей: {len(self._users)}).")
+
+    # --- Пользователь и его настройки ---
+
+    async def get_user_profile(self, user_id: int) -> Optional[UserProfile]:
+        user = self._users.get(user_id)
+        if user is None:
+            return None
+        dialog = self._dialogs.get(user['active_dialog_id'])
+        return UserProfile.from_row({**user, 'active_dialog_name': dialog['name'] if dialog else None})
+
+    def _new_dialog(self, user_id: int, name: str) -> int:
+        dialog_id = next(self._dialog_ids)
+        self._dialogs[dialog_id] = {'dialog_id': dialog_id, 'user_id': user_id, 'name': name,
+                                    'created_at': _now().isoformat(), 'created_ts': int(_now().timestamp()),
+                                    'message_count': 0, 'last_message_at': None, 'deleted_at': None}
+        self._user_dialogs.setdefault(user_id, []).append(dialog_id)
+        self._messages[dialog_id] = []
+        self._message_ts[dialog_id] = []
+        return dialog_id
+
+    async def add_or_update_user(self, user_id: int, username: Optional[str], first_name: Optional[str],
+                                 last_name: Optional[str]):
+        user = self._users.get(user_id)
+        is_new = user is None
+        if is_new:
+            user = {
+                'user_id': user_id, 'username': username, 'first_name': first_name, 'last_name': last_name,
+                'bot_style': 'default', 'first_interaction_date': datetime.date.today().strftime('%Y-%m-%d'),
+                'api_key': None, 'language_code': 'ru', 'gemini_model': DEFAULT_MODEL_ID,
+                'active_persona': 'default', 'active_dialog_id': None, 'is_blocked': 0,
+                'message_count': 0, 'last_message_at': None,
+            }
+            self._users[user_id] = user
+            bisect.insort(self._user_ids, user_id)
+        else:
+            user.update(username=username, first_name=first_name, last_name=last_name)
+
+        new_dialog_id = None
+        if user['active_dialog_id'] is None:
+            new_dialog_id = user['active_dialog_id'] = self._new_dialog(user_id, "Основной диалог")
+
+        if is_new:
+            memory_logger.info(f"Добавлен новый пользователь {user_id} (@{username}).")
+            await tg_helpers.notify_admin_of_new_user(user_id, username, first_name, last_name)
+        elif new_dialog_id:
+            memory_logger.warning(f"У существующего пользователя {user_id} не было активного диалога.")
+        if new_dialog_id:
+            memory_logger.info(f"Для пользователя {user_id} создан новый диалог 'Основной диалог' (ID: {new_dialog_id}).")
+
+    def _user_field(self, user_id: int, name: str, default: Any = None) -> Any:
+        user = self._users.get(user_id)
+        return user[name] if user and user[name] else default
+
+    def _set_user_field(self, user_id: int, name: str, value: Any):
+        user = self._users.get(user_id)
+        if user is not None:
+            user[name] = value
+
+    async def get_user_language(self, user_id: int) -> str:
+        return self._user_field(user_id, 'language_code', 'ru')
+
+    async def set_user_language(self, user_id: int, lang_code: str):
+        self._set_user_field(user_id, 'language_code', lang_code)
+
+    async def get_user_bot_style(self, user_id: int) -> str:
+        return self._user_field(user_id, 'bot_style', 'default')
+
+    async def set_user_bot_style(self, user_id: int, style: str):
+        self._set_user_field(user_id, 'bot_style', style)
+
+    async def get_user_api_key(self, user_id: int) -> Optional[str]:
+        user = self._users.get(user_id)
+        if not user or not user['api_key']:
+            return None
+        try:
+            return crypto_helpers.decrypt_data(user['api_key'])
+        except Exception as e:
+            memory_logger.exception(f"Ошибка при дешифровании API-ключа для {user_id}: {e}",
+                                    extra={'user_id': str(user_id)})
+            return None
+
+    async def set_user_api_key(self, user_id: int, api_key: Optional[str]):
+        # Ключ хранится зашифрованным, как в SQLite: профиль отдает его в том же виде
+        self._set_user_field(user_id, 'api_key', crypto_helpers.encrypt_data(api_key) if api_key else None)
+        memory_logger.info(f"API-ключ для пользователя {user_id} {'установлен' if api_key else 'сброшен'}.")
+
+    async def get_user_gemini_model(self, user_id: int) -> Optional[str]:
+        return self._user_field(user_id, 'gemini_model')
+
+    async def set_user_gemini_model(self, user_id: int, model_name: str):
+        self._set_user_field(user_id, 'gemini_model', model_name)
+
+    async def get_user_persona(self, user_id: int) -> str:
+        return self._user_field(user_id, 'active_persona', 'default')
+
+    async def set_user_persona(self, user_id: int, persona_id: str):
+        self._set_user_field(user_id, 'active_persona', persona_id)
+
+    async def get_first_interaction_date(self, user_id: int) -> Optional[str]:
+        return self._user_field(user_id, 'first_interaction_date')
+
+    async def get_user_context_info(self, user_id: int) -> Optional[Dict[str, Any]]:
+        profile = await self.get_user_profile(user_id)
+        if not profile:
+            return None
+        return {
+            'dialog_name': profile.active_dialog_name,
+            'gemini_model': profile.gemini_model,
+            'active_persona': profile.active_persona,
+        }
+
+    # --- Диалоги ---
+
+    async def get_active_dialog_id(self, user_id: int) -> Optional[int]:
+        return self._user_field(user_id, 'active_dialog_id')
+
+    async def create_dialog(self, user_id: int, name: str, set_active: bool = False) -> Optional[int]:
+        # Как внешний ключ dialogs.user_id в SQLite: диалог неизвестного пользователя не создается
+        if user_id not in self._users:
+            memory_logger.warning(f"Диалог '{name}' не создан: пользователь {user_id} не найден.")
+            return None
+        dialog_id = self._new_dialog(user_id, name)
+        if set_active:
+            self._set_user_field(user_id, 'active_dialog_id', dialog_id)
+        memory_logger.info(f"Для пользователя {user_id} создан новый диалог '{name}' (ID: {dialog_id}).")
+        return dialog_id
+
+    async def get_user_dialogs(self, user_id: int) -> List[Dict[str, Any]]:
+        user = self._users.get(user_id)
+        if user is None:
+            return []
+        dialogs = [self._dialogs[dialog_id] for dialog_id in self._user_dialogs.get(user_id, [])]
+        dialogs.sort(key=lambda d: (d['last_message_at'] or d['created_ts'], d['dialog_id']), reverse=True)
+        return [{'dialog_id': d['dialog_id'], 'name': d['name'], 'active_dialog_id': user['active_dialog_id'],
+                 'message_count': d['message_count'], 'last_message_at': d['last_message_at']} for d in dialogs]
+
+    async def set_active_dialog(self, user_id: int, dialog_id: int):
+        dialog = self._dialogs.get(dialog_id)
+        if dialog is None or dialog['user_id'] != user_id or dialog['deleted_at'] is not None:
+            memory_logger.warning(f"Диалог {dialog_id} не установлен активным для пользователя {user_id}: "
+                                  f"диалог не найден или удален.")
+            return
+        self._set_user_field(user_id, 'active_dialog_id', dialog_id)
+        memory_logger.info(f"Для пользователя {user_id} установлен активный диалог ID: {dialog_id}.")
+
+    async def rename_dialog(self, user_id: int, dialog_id: int, new_name: str):
+        dialog = self._dialogs.get(dialog_id)
+        if dialog and dialog['user_id'] == user_id:
+            dialog['name'] = new_name
+            memory_logger.info(f"Диалог ID {dialog_id} переименован в '{new_name}'.")
+
+    async def delete_dialog(self, user_id: int, dialog_id_to_delete: int) -> Optional[str]:
+        dialog_ids = self._user_dialogs.get(user_id, [])
+        dialog = self._dialogs.get(dialog_id_to_delete)
+        if len(dialog_ids) < 2 or dialog is None or dialog['user_id'] != user_id:
+            reason = "последний диалог пользователя" if len(dialog_ids) < 2 else "диалог не найден"
+            memory_logger.warning(f"Удаление диалога {dialog_id_to_delete} для пользователя {user_id} отменено: {reason}.")
+            return None
+        dialog_ids.remove(dialog_id_to_delete)
+        del self._dialogs[dialog_id_to_delete]
+        del self._messages[dialog_id_to_delete]
+        del self._message_ts[dialog_id_to_delete]
+        user = self._users[user_id]
+        if user['active_dialog_id'] == dialog_id_to_delete:
+            # Активным становится самый новый из оставшихся
+            user['active_dialog_id'] = max(dialog_ids, key=lambda i: (self._dialogs[i]['created_at'], i))
+        user['message_count'] = max(user['message_count'] - dialog['message_count'], 0)
+        user['last_message_at'] = max((self._dialogs[i]['last_message_at'] for i in dialog_ids
+                                       if self._dialogs[i]['last_message_at'] is not None), default=None)
+        memory_logger.info(f"Диалог ID {dialog_id_to_delete} удален для пользователя {user_id}.")
+        return dialog['name']
+
+    # --- История сообщений и статистика пользователя ---
+
+    async def store_message(self, user_id: int, dialog_id: int, role: str, message_text: str,
+                            prompt_tokens: int = 0, completion_tokens: int = 0, total_tokens: int = 0,
+                            model: Optional[str] = None):
+        if role not in ('user', 'bot') or dialog_id not in self._dialogs:
+            return
+        now = _now()
+        ts = int(now.timestamp())
+        self._messages[dialog_id].append({'conversation_id': next(self._conversation_ids), 'user_id': user_id,
+                                          'dialog_id': dialog_id, 'role': role, 'message_text': message_text, 'ts': ts})
+        self._message_ts[dialog_id].append(ts)
+        for row in (self._dialogs[dialog_id], self._users.get(user_id)):
+            if row is not None:
+                row['message_count'] += 1
+                row['last_message_at'] = ts
+        if role == 'bot':
+            usage = self._usage.setdefault((user_id, now.strftime('%Y-%m-%d'), model or ''), [0, 0, 0, 0])
+            usage[0] += prompt_tokens
+            usage[1] += completion_tokens
+            usage[2] += total_tokens
+            usage[3] += 1
+
+    def _dialog_messages(self, user_id: int, dialog_id: int) -> List[Dict[str, Any]]:
+        dialog = self._dialogs.get(dialog_id)
+        return self._messages[dialog_id] if dialog and dialog['user_id'] == user_id else []
+
+    async def get_conversation_history(self, user_id: int, dialog_id: int, limit: int = 20) -> List[Dict[str, Any]]:
+        messages = self._dialog_messages(user_id, dialog_id)[-limit:] if limit > 0 else []
+        return [{'role': m['role'], 'message_text': m['message_text']} for m in messages]
+
+    async def get_conversation_history_by_date(self, user_id: int, dialog_id: int,
+                                               history_date: datetime.date) -> List[Dict[str, Any]]:
+        messages = self._dialog_messages(user_id, dialog_id)
+        if not messages:
+            return []
+        start_ts = int(datetime.datetime.combine(history_date, datetime.time.min,
+                                                 tzinfo=datetime.timezone.utc).timestamp())
+        timestamps = self._message_ts[dialog_id]
+        lo = bisect.bisect_left(timestamps, start_ts)
+        hi = bisect.bisect_left(timestamps, start_ts + 86400)
+        return [{'role': m['role'], 'message_text': m['message_text']} for m in messages[lo:hi]]
+
+    async def search_messages(self, user_id: int, query: str, dialog_id: Optional[int] = None,
+                              limit: int = 5, offset: int = 0) -> Tuple[List[Dict[str, Any]], bool]:
+        # Все слова запроса ищутся по префиксу; результаты — от новых к старым (релевантность не оценивается)
+        words = [word.lower() for word in re.findall(r'\w+', query)]
+        if not words:
+            return [], False
+        dialog_ids = [dialog_id] if dialog_id is not None else self._user_dialogs.get(user_id, [])
+        candidates = [message for i in dialog_ids for message in self._dialog_messages(user_id, i)]
+        candidates.sort(key=lambda m: m['conversation_id'], reverse=True)
+        results: List[Dict[str, Any]] = []
+        skipped = 0
+        for message in candidates:
+            snippet = _snippet(message['message_text'] or '', words)
+            if snippet is None:
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            if len(results) == limit:
+                return results, True
+            results.append({'conversation_id': message['conversation_id'], 'dialog_id': message['dialog_id'],
+                            'dialog_name': self._dialogs[message['dialog_id']]['name'], 'role': message['role'], 'ts': message['ts'],
+                            'snippet': snippet})
+        return results, False
+
+    async def get_total_user_message_count(self, user_id: int) -> int:
+        user = self._users.get(user_id)
+        return user['message_count'] if user else 0
+
+    async def get_token_usage_by_period(self, user_id: int, period: str) -> Dict[str, int]:
+        today = _now().date()
+        if period == 'today':
+            start_day = today.isoformat()
+        elif period == 'month':
+            start_day = today.replace(day=1).isoformat()
+        else:
+            return dict(_EMPTY_USAGE)
+        rows = [usage for (uid, day, _), usage in self._usage.items() if uid == user_id and day >= start_day]
+        if not rows:
+            return dict(_EMPTY_USAGE)
+        return {'prompt_tokens': sum(r[0] for r in rows), 'completion_tokens': sum(r[1] for r in rows),
+                'total_tokens': sum(r[2] for r in rows)}
+
+    # --- Глобальные настройки ---
+
+    async def set_app_setting(self, key: str, value: str):
+        self._settings[key] = value
+        memory_logger.info(f"Глобальная настройка '{key}' установлена в значение '{value}'.")
+
+    async def get_app_setting(self, key: str) -> Optional[str]:
+        return self._settings.get(key)
+
+    # --- Администрирование ---
+
+    async def is_user_blocked(self, user_id: int) -> bool:
+        user = self._users.get(user_id)
+        return bool(user['is_blocked']) if user else False
+
+    async def block_user(self, user_id: int):
+        self._set_user_field(user_id, 'is_blocked', 1)
+        memory_logger.info(f"Пользователь {user_id} заблокирован.")
+
+    async def unblock_user(self, user_id: int):
+        self._set_user_field(user_id, 'is_blocked', 0)
+        memory_logger.info(f"Пользователь {user_id} разблокирован.")
+
+    async def iterate_user_ids(self) -> AsyncIterator[int]:
+        for user_id in list(self._user_ids):
+            yield user_id
+
+    async def get_total_users_count(self) -> int:
+        return len(self._users)
+
+    async def get_blocked_users_count(self) -> int:
+        return sum(1 for user in self._users.values() if user['is_blocked'])
+
+    async def get_active_users_count(self, days: int = 7) -> int:
+        start_ts = int((_now() - datetime.timedelta(days=days)).timestamp())
+        return sum(1 for user in self._users.values()
+                   if user['last_message_at'] is not None and user['last_message_at'] >= start_ts)
+
+    async def get_new_users_count(self, days: int = 7) -> int:
+        start_date = (datetime.date.today() - datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+        return sum(1 for user in self._users.values() if user['first_interaction_date'] >= start_date)
+
+    async def get_user_info_for_admin(self, user_id: int) -> Optional[Dict[str, Any]]:
+        user = self._users.get(user_id)
+        if user is None:
+            return None
+        fields = ('user_id', 'username', 'first_name', 'last_name', 'language_code', 'first_interaction_date',
+                  'is_blocked', 'message_count', 'last_message_at')
+        return {name: user[name] for name in fields}
+
+    async def iterate_users_for_export(self) -> AsyncIterator[Dict[str, Any]]:
+        fields = ('user_id', 'username', 'first_name', 'last_name', 'language_code', 'first_interaction_date',
+                  'is_blocked')
+        for user_id in list(self._user_ids):
+            user = self._users.get(user_id)
+            if user is not None:
+                yield {name: user[name] for name in fields}
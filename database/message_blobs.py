@@ -0,0 +1,66 @@
+# File: database/message_blobs.py
+"""
+Контентно-адресуемое хранилище длинных текстов сообщений.
+
+Тексты длиннее порога хранятся один раз в таблице `message_blobs` под ключом
+SHA-256 от их содержимого (сжатыми zlib, если это уменьшает размер), а строка
+`conversations` хранит только ссылку `blob_hash` и NULL в `message_text`.
+Одинаковые ответы бота занимают место один раз. Короткие тексты остаются в
+`message_text`: ссылка на них заняла бы не меньше места, чем сам текст.
+
+Число ссылок (`refcount`) поддерживают триггеры `conversations`; блоб без
+ссылок удаляется тем же триггером. Полный текст сообщения дает представление
+`conversations_text`, которое распаковывает блобы SQL-функцией
+`decode_blob(codec, data)` — ее регистрирует `register_functions` на каждом
+соединении.
+"""
+import hashlib
+import sqlite3
+import zlib
+from typing import Optional, Tuple
+
+CODEC_RAW = 'raw'
+CODEC_ZLIB = 'zlib'
+
+
+def content_hash(text: str) -> bytes:
+    """Ключ блоба: SHA-256 от текста в UTF-8."""
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+
+def encode(text: str) -> Tuple[str, bytes]:
+    """Возвращает (кодек, данные): сжатый текст, если сжатие его уменьшает, иначе исходные байты."""
+    raw = text.encode('utf-8')
+    compressed = zlib.compress(raw, 6)
+    if len(compressed) < len(raw):
+        return CODEC_ZLIB, compressed
+    return CODEC_RAW, raw
+
+
+def decode(codec: Optional[str], data: Optional[bytes]) -> Optional[str]:
+    """Восстанавливает текст блоба. Используется и как SQL-функция `decode_blob`."""
+    if data is None:
+        return None
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data).decode('utf-8')
+    if codec == CODEC_RAW:
+        return bytes(data).decode('utf-8')
+    raise ValueError(f"Неизвестный кодек блоба сообщения: {codec}")
+
+
+def register_functions(conn: sqlite3.Connection):
+    """Регистрирует на соединении SQL-функцию `decode_blob`, нужную представлению и триггерам."""
+    conn.create_function('decode_blob', 2, decode, deterministic=True)
+
+
+def store_sync(conn: sqlite3.Connection, text: str) -> bytes:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Сохраняет текст в `message_blobs`, если такого еще нет, и возвращает его ключ.
+    Счетчик ссылок увеличит триггер при вставке строки `conversations` с этим ключом.
+    """
+    key = content_hash(text)
+    if conn.execute("SELECT 1 FROM message_blobs WHERE hash = ?", (key,)).fetchone() is None:
+        codec, data = encode(text)
+        conn.execute("INSERT INTO message_blobs (hash, codec, size, refcount, data) VALUES (?, ?, ?, 0, ?)",
+                     (key, codec, len(text.encode('utf-8')), data))
+    return key
@@ -0,0 +1,447 @@
+# File: database/migrations.py
+"""
+Версионированные миграции схемы базы данных.
+
+Номер примененной версии хранится в таблице `schema_version`. Каждый шаг
+выполняется один раз, в собственной транзакции; миграции данных написаны
+множественными (set-based) SQL-запросами. Шаги, помеченные `_own_transactions`,
+обходят большие таблицы пачками с фиксацией после каждой (чтобы не держать
+блокировку записи на все время миграции) и должны быть безопасны для
+повторного запуска после сбоя: версия записывается только после последней
+пачки. Запуск на актуальной базе стоит одного SELECT.
+
+Шаги нельзя менять после выпуска — только добавлять новые в конец MIGRATIONS.
+Первые шаги написаны так, чтобы принять и базы, созданные до появления
+`schema_version` (все изменения проверяют, не применены ли они уже).
+"""
+import datetime
+import sqlite3
+from typing import Callable, Dict, List, Tuple
+
+from logger_config import get_logger
+from config.settings import MESSAGE_BLOB_MIN_BYTES
+from . import archive, message_blobs, retention
+
+migrations_logger = get_logger('database', user_id='System')
+
+# Размер пачки при заполнении столбца conversations.ts для старых строк
+_TS_BACKFILL_CHUNK = 5000
+
+
+def _table_columns(conn: sqlite3.Connection, table: str) -> Dict[str, sqlite3.Row]:
+    return {col['name']: col for col in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_missing_columns(conn: sqlite3.Connection, table: str, columns: Dict[str, str]):
+    """Добавляет в таблицу столбцы из `columns` ({имя: определение}), которых в ней еще нет."""
+    existing = _table_columns(conn, table)
+    for name, definition in columns.items():
+        if name not in existing:
+            migrations_logger.info(f"Добавляем столбец '{name}' в '{table}'...")
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def _own_transactions(step: Callable[[sqlite3.Connection], None]) -> Callable[[sqlite3.Connection], None]:
+    """Помечает шаг, который сам открывает и фиксирует транзакции (не выполняется в одной общей)."""
+    step.own_transactions = True
+    return step
+
+
+def _in_transaction(conn: sqlite3.Connection, fn: Callable[[], None]):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        fn()
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+# --- Шаги миграций ---
+
+def _m001_base_schema(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS app_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            bot_style TEXT DEFAULT 'default' NOT NULL,
+            first_interaction_date TEXT,
+            api_key TEXT DEFAULT NULL,
+            language_code TEXT DEFAULT 'ru' NOT NULL,
+            gemini_model TEXT DEFAULT NULL,
+            active_persona TEXT DEFAULT 'default' NOT NULL,
+            active_dialog_id INTEGER REFERENCES dialogs(dialog_id) ON DELETE SET NULL,
+            is_blocked INTEGER NOT NULL DEFAULT 0
+        )""")
+    # Базы, созданные до появления диалогов, персон и блокировки
+    _add_missing_columns(conn, 'users', {
+        'username': "TEXT",
+        'first_name': "TEXT",
+        'last_name': "TEXT",
+        'active_persona': "TEXT DEFAULT 'default' NOT NULL",
+        'active_dialog_id': "INTEGER REFERENCES dialogs(dialog_id) ON DELETE SET NULL",
+        'is_blocked': "INTEGER NOT NULL DEFAULT 0",
+    })
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS dialogs (
+            dialog_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_dialogs_user ON dialogs (user_id)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            role TEXT NOT NULL CHECK(role IN ('user', 'bot')),
+            message_text TEXT,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            total_tokens INTEGER NOT NULL DEFAULT 0,
+            dialog_id INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+            FOREIGN KEY (dialog_id) REFERENCES dialogs(dialog_id) ON DELETE CASCADE
+        )""")
+    _add_missing_columns(conn, 'conversations', {
+        'dialog_id': "INTEGER REFERENCES dialogs(dialog_id) ON DELETE CASCADE",
+    })
+
+
+def _m002_default_dialogs(conn: sqlite3.Connection):
+    """Создает диалог по умолчанию пользователям без активного диалога и привязывает к нему их историю."""
+    now_str = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    created = conn.execute("""
+        INSERT INTO dialogs (user_id, name, created_at)
+        SELECT user_id, 'Основной диалог', ? FROM users WHERE active_dialog_id IS NULL
+    """, (now_str,)).rowcount
+    if created:
+        # Новые диалоги получили наибольшие ID у своих пользователей
+        conn.execute("""
+            UPDATE users SET active_dialog_id = (SELECT MAX(dialog_id) FROM dialogs WHERE dialogs.user_id = users.user_id)
+            WHERE active_dialog_id IS NULL
+        """)
+        migrations_logger.info(f"Создано {created} диалогов по умолчанию для пользователей без активного диалога.")
+    conn.execute("""
+        UPDATE conversations SET dialog_id = (SELECT active_dialog_id FROM users WHERE users.user_id = conversations.user_id)
+        WHERE dialog_id IS NULL
+    """)
+
+    # В старых базах столбец dialog_id добавлен через ALTER TABLE и допускает NULL — пересоздаем таблицу
+    if not _table_columns(conn, 'conversations')['dialog_id']['notnull']:
+        migrations_logger.info("Пересоздание таблицы 'conversations', чтобы сделать столбец 'dialog_id' NOT NULL...")
+        conn.execute("""
+            CREATE TABLE conversations_new (
+                conversation_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+                timestamp TEXT NOT NULL, role TEXT NOT NULL CHECK(role IN ('user', 'bot')),
+                message_text TEXT, prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0, total_tokens INTEGER NOT NULL DEFAULT 0,
+                dialog_id INTEGER NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+                FOREIGN KEY (dialog_id) REFERENCES dialogs(dialog_id) ON DELETE CASCADE
+            )""")
+        columns = ("conversation_id, user_id, timestamp, role, message_text, prompt_tokens, "
+                   "completion_tokens, total_tokens, dialog_id")
+        conn.execute(f"INSERT INTO conversations_new ({columns}) SELECT {columns} FROM conversations WHERE dialog_id IS NOT NULL")
+        conn.execute("DROP TABLE conversations")
+        conn.execute("ALTER TABLE conversations_new RENAME TO conversations")
+
+
+@_own_transactions
+def _m003_conversation_ts(conn: sqlite3.Connection):
+    """
+    Время сообщения в секундах Unix (UTC) и индексы по нему. Старые строки заполняются
+    пачками по _TS_BACKFILL_CHUNK строк (диапазонами conversation_id) с фиксацией после каждой.
+    """
+    _in_transaction(conn, lambda: _add_missing_columns(conn, 'conversations', {'ts': "INTEGER"}))
+    last_id = conn.execute("SELECT MAX(conversation_id) FROM conversations").fetchone()[0] or 0
+    total = 0
+    for start in range(0, last_id, _TS_BACKFILL_CHUNK):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            updated = conn.execute("""
+                UPDATE conversations SET ts = CAST(strftime('%s', timestamp) AS INTEGER)
+                WHERE conversation_id > ? AND conversation_id <= ? AND ts IS NULL
+            """, (start, start + _TS_BACKFILL_CHUNK)).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if updated:
+            total += updated
+            migrations_logger.info(f"Заполнение conversations.ts: обработано {total} строк...")
+    if total:
+        migrations_logger.info(f"Столбец conversations.ts заполнен для {total} строк.")
+    _in_transaction(conn, lambda: _create_conversation_ts_indexes(conn))
+
+
+def _create_conversation_ts_indexes(conn: sqlite3.Connection):
+    conn.execute("DROP INDEX IF EXISTS idx_conversations_dialog_time")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_dialog_ts ON conversations (dialog_id, ts)")
+    # Покрывающий индекс для сумм токенов пользователя за период
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_ts
+        ON conversations (user_id, ts, prompt_tokens, completion_tokens, total_tokens)
+    """)
+    # Для подсчета активных пользователей за период
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_ts_user ON conversations (ts, user_id)")
+
+
+def _m004_usage_daily(conn: sqlite3.Connection):
+    """Модель ответа в conversations и суточные суммы токенов usage_daily."""
+    _add_missing_columns(conn, 'conversations', {'model': "TEXT"})
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            model TEXT NOT NULL,
+            prompt INTEGER NOT NULL DEFAULT 0,
+            completion INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            requests INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, model),
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        ) WITHOUT ROWID""")
+    conn.execute("DELETE FROM usage_daily")
+    conn.execute("""
+        INSERT INTO usage_daily (user_id, day, model, prompt, completion, total, requests)
+        SELECT user_id, strftime('%Y-%m-%d', ts, 'unixepoch'), COALESCE(model, ''),
+               SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens), COUNT(*)
+        FROM conversations
+        WHERE role = 'bot' AND ts IS NOT NULL
+        GROUP BY 1, 2, 3
+    """)
+
+
+def _m005_message_counters(conn: sqlite3.Connection):
+    """Денормализованные счетчики сообщений и время последней активности."""
+    for table in ('users', 'dialogs'):
+        _add_missing_columns(conn, table, {
+            'message_count': "INTEGER NOT NULL DEFAULT 0",
+            'last_message_at': "INTEGER",
+        })
+    conn.execute("""
+        UPDATE dialogs SET
+            message_count = (SELECT COUNT(*) FROM conversations WHERE dialog_id = dialogs.dialog_id),
+            last_message_at = (SELECT MAX(ts) FROM conversations WHERE dialog_id = dialogs.dialog_id)
+    """)
+    conn.execute("""
+        UPDATE users SET
+            message_count = (SELECT COUNT(*) FROM conversations WHERE user_id = users.user_id),
+            last_message_at = (SELECT MAX(ts) FROM conversations WHERE user_id = users.user_id)
+    """)
+
+
+def _m006_conversations_fts(conn: sqlite3.Connection):
+    """Полнотекстовый индекс FTS5 по тексту сообщений, синхронизируемый триггерами."""
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            message_text,
+            content='conversations',
+            content_rowid='conversation_id',
+            tokenize='unicode61 remove_diacritics 2'
+        )""")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_ai AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts (rowid, message_text) VALUES (new.conversation_id, new.message_text);
+        END""")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_ad AFTER DELETE ON conversations BEGIN
+            INSERT INTO conversations_fts (conversations_fts, rowid, message_text)
+            VALUES ('delete', old.conversation_id, old.message_text);
+        END""")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_au AFTER UPDATE OF message_text ON conversations BEGIN
+            INSERT INTO conversations_fts (conversations_fts, rowid, message_text)
+            VALUES ('delete', old.conversation_id, old.message_text);
+            INSERT INTO conversations_fts (rowid, message_text) VALUES (new.conversation_id, new.message_text);
+        END""")
+    conn.execute("INSERT INTO conversations_fts (conversations_fts) VALUES ('rebuild')")
+
+
+def _m007_message_blobs(conn: sqlite3.Connection):
+    """
+    Длинные тексты сообщений — в контентно-адресуемую таблицу message_blobs.
+    Индекс FTS переводится на представление conversations_text с полным текстом.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_blobs (
+            hash BLOB PRIMARY KEY,
+            codec TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            data BLOB NOT NULL
+        )""")
+    _add_missing_columns(conn, 'conversations', {'blob_hash': "BLOB"})
+    for trigger in ('conversations_fts_ai', 'conversations_fts_ad', 'conversations_fts_au'):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.execute("DROP TABLE IF EXISTS conversations_fts")
+
+    # Переносим существующие длинные тексты; счетчики ссылок считаем здесь же (триггеры еще не созданы)
+    refcounts: Dict[bytes, int] = {}
+    moved = []
+    for row in conn.execute("""
+        SELECT conversation_id, message_text FROM conversations
+        WHERE blob_hash IS NULL AND length(CAST(message_text AS BLOB)) >= ?
+    """, (MESSAGE_BLOB_MIN_BYTES,)).fetchall():
+        key = message_blobs.store_sync(conn, row['message_text'])
+        refcounts[key] = refcounts.get(key, 0) + 1
+        moved.append((key, row['conversation_id']))
+    conn.executemany("UPDATE conversations SET blob_hash = ?, message_text = NULL WHERE conversation_id = ?", moved)
+    conn.executemany("UPDATE message_blobs SET refcount = refcount + ? WHERE hash = ?",
+                     [(count, key) for key, count in refcounts.items()])
+    if moved:
+        migrations_logger.info(f"В message_blobs перенесено текстов: {len(moved)} (уникальных {len(refcounts)}).")
+
+    conn.execute("""
+        CREATE VIEW IF NOT EXISTS conversations_text AS
+        SELECT c.conversation_id, c.user_id, c.dialog_id, c.role, c.ts, c.model,
+               c.prompt_tokens, c.completion_tokens, c.total_tokens,
+               COALESCE(c.message_text, decode_blob(b.codec, b.data)) AS message_text
+        FROM conversations c
+        LEFT JOIN message_blobs b ON b.hash = c.blob_hash
+    """)
+    conn.execute("""
+        CREATE VIRTUAL TABLE conversations_fts USING fts5(
+            message_text,
+            content='conversations_text',
+            content_rowid='conversation_id',
+            tokenize='unicode61 remove_diacritics 2'
+        )""")
+    # Текст удаляемой строки нужен индексу FTS, поэтому блоб освобождается в том же триггере после него
+    conn.execute("""
+        CREATE TRIGGER conversations_ai AFTER INSERT ON conversations BEGIN
+            UPDATE message_blobs SET refcount = refcount + 1 WHERE hash = new.blob_hash;
+            INSERT INTO conversations_fts (rowid, message_text)
+            SELECT conversation_id, message_text FROM conversations_text WHERE conversation_id = new.conversation_id;
+        END""")
+    conn.execute("""
+        CREATE TRIGGER conversations_ad AFTER DELETE ON conversations BEGIN
+            INSERT INTO conversations_fts (conversations_fts, rowid, message_text)
+            VALUES ('delete', old.conversation_id, COALESCE(old.message_text, (
+                SELECT decode_blob(codec, data) FROM message_blobs WHERE hash = old.blob_hash
+            )));
+            UPDATE message_blobs SET refcount = refcount - 1 WHERE hash = old.blob_hash;
+            DELETE FROM message_blobs WHERE hash = old.blob_hash AND refcount <= 0;
+        END""")
+    conn.execute("""
+        CREATE TRIGGER conversations_au AFTER UPDATE OF message_text, blob_hash ON conversations BEGIN
+            INSERT INTO conversations_fts (conversations_fts, rowid, message_text)
+            VALUES ('delete', old.conversation_id, COALESCE(old.message_text, (
+                SELECT decode_blob(codec, data) FROM message_blobs WHERE hash = old.blob_hash
+            )));
+            UPDATE message_blobs SET refcount = refcount + 1 WHERE hash = new.blob_hash;
+            UPDATE message_blobs SET refcount = refcount - 1 WHERE hash = old.blob_hash;
+            DELETE FROM message_blobs WHERE hash = old.blob_hash AND refcount <= 0;
+            INSERT INTO conversations_fts (rowid, message_text)
+            SELECT conversation_id, message_text FROM conversations_text WHERE conversation_id = new.conversation_id;
+        END""")
+    conn.execute("INSERT INTO conversations_fts (conversations_fts) VALUES ('rebuild')")
+
+
+def _m008_dialog_soft_delete(conn: sqlite3.Connection):
+    """Пометка удаленного диалога: история удаляется фоновой задачей (см. dialog_reaper)."""
+    _add_missing_columns(conn, 'dialogs', {'deleted_at': "INTEGER"})
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_dialogs_deleted ON dialogs (deleted_at) WHERE deleted_at IS NOT NULL")
+
+
+@_own_transactions
+def _m009_archive_schema(conn: sqlite3.Connection):
+    """Таблица блоков архива и ее поисковый индекс (PRAGMA journal_mode нельзя менять внутри транзакции)."""
+    archive.ensure_schema(conn)
+
+
+@_own_transactions
+def _m010_incremental_auto_vacuum(conn: sqlite3.Connection):
+    """
+    Перевод основной базы и архива, созданных до включения auto_vacuum, в режим INCREMENTAL.
+    Для непустого файла это полный VACUUM — он возможен только вне транзакции.
+    """
+    retention.ensure_incremental_auto_vacuum(conn, 'main')
+    retention.ensure_incremental_auto_vacuum(conn, archive.SCHEMA)
+
+
+# (версия, описание, шаг)
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "Базовая схема: app_settings, users, dialogs, conversations", _m001_base_schema),
+    (2, "Диалоги по умолчанию для старых пользователей, conversations.dialog_id NOT NULL", _m002_default_dialogs),
+    (3, "conversations.ts (секунды Unix) и индексы по времени", _m003_conversation_ts),
+    (4, "conversations.model и суточная сводка токенов usage_daily", _m004_usage_daily),
+    (5, "Счетчики message_count/last_message_at в users и dialogs", _m005_message_counters),
+    (6, "Полнотекстовый поиск conversations_fts (FTS5)", _m006_conversations_fts),
+    (7, "Длинные тексты сообщений в message_blobs, FTS по представлению conversations_text", _m007_message_blobs),
+    (8, "dialogs.deleted_at: фоновое удаление истории диалогов", _m008_dialog_soft_delete),
+    (9, "Архив: таблица блоков conversation_blocks и поисковый индекс", _m009_archive_schema),
+    (10, "auto_vacuum=INCREMENTAL для основной базы и архива", _m010_incremental_auto_vacuum),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Возвращает номер примененной версии схемы (0 — база еще не версионирована)."""
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] or 0
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Применяет недостающие миграции. Соединение должно работать в режиме autocommit
+    (isolation_level=None): каждая миграция сама открывает и фиксирует транзакцию.
+    Архив шарда должен быть подключен к соединению (см. archive.attach), а SQL-функции
+    message_blobs и archive — зарегистрированы.
+
+    Returns:
+        Номер версии схемы после миграции.
+    """
+    current = get_schema_version(conn)
+    if current >= LATEST_VERSION:
+        return current
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TEXT NOT NULL
+        )""")
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        if getattr(step, 'own_transactions', False):
+            if conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                continue
+            migrations_logger.info(f"Применяем миграцию {version}: {description}...")
+            step(conn)
+            # Шаг идемпотентен, поэтому версию, записанную параллельным процессом, просто не дублируем
+            _in_transaction(conn, lambda: conn.execute(
+                "INSERT OR IGNORE INTO schema_version (version, applied_at) VALUES (?, ?)",
+                (version, datetime.datetime.now(datetime.timezone.utc).isoformat())))
+            migrations_logger.info(f"Миграция {version} применена.")
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Другой процесс мог применить эту миграцию, пока мы ждали блокировку
+            if conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                conn.execute("ROLLBACK")
+                continue
+            migrations_logger.info(f"Применяем миграцию {version}: {description}...")
+            step(conn)
+            conn.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                         (version, datetime.datetime.now(datetime.timezone.utc).isoformat()))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        migrations_logger.info(f"Миграция {version} применена.")
+    return LATEST_VERSION
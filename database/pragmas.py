@@ -0,0 +1,68 @@
+# File: database/pragmas.py
+"""
+Профиль производительности соединений SQLite и обслуживание WAL.
+
+Все соединения получают один профиль PRAGMA (synchronous, cache_size, mmap_size,
+temp_store) для основной базы и архива. Автоматическая контрольная точка WAL
+по умолчанию выключена (`wal_autocheckpoint = 0`): иначе ее выполняет та
+транзакция записи, на которой WAL превысил порог, и пользователь получает
+случайную задержку. Вместо этого фоновая задача периодически переносит WAL в
+файл базы на соединении-писателе пула, между пачками записи: в режиме
+PASSIVE под нагрузкой (никого не ждет) и TRUNCATE в простое (файл WAL
+обрезается до нуля). Изредка выполняется `PRAGMA optimize`.
+"""
+import sqlite3
+from typing import Dict, Iterable, Tuple
+
+_SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+_TEMP_STORE_MODES = ('DEFAULT', 'FILE', 'MEMORY')
+_CHECKPOINT_MODES = ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
+
+def _choice(value: str, allowed: Tuple[str, ...], name: str) -> str:
+    """Проверяет значение настройки, подставляемое в текст PRAGMA."""
+    value = value.upper()
+    if value not in allowed:
+        raise ValueError(f"Недопустимое значение {name}: {value} (допустимы: {', '.join(allowed)})")
+    return value
+
+
+def apply_profile(conn: sqlite3.Connection, schemas: Iterable[str], synchronous: str, cache_size_mb: int,
+                  mmap_size_mb: int, temp_store: str, wal_autocheckpoint: int):
+    """
+    Применяет профиль PRAGMA к соединению. Параметры synchronous, cache_size и mmap_size
+    задаются для каждой схемы из `schemas` (основная база и подключенный архив).
+    """
+    synchronous = _choice(synchronous, _SYNCHRONOUS_MODES, 'synchronous')
+    temp_store = _choice(temp_store, _TEMP_STORE_MODES, 'temp_store')
+    for schema in schemas:
+        conn.execute(f"PRAGMA {schema}.synchronous = {synchronous}")
+        # Отрицательное значение cache_size задает размер в КиБ, а не в страницах
+        conn.execute(f"PRAGMA {schema}.cache_size = {-int(cache_size_mb) * 1024}")
+        conn.execute(f"PRAGMA {schema}.mmap_size = {int(mmap_size_mb) * 1024 * 1024}")
+    conn.execute(f"PRAGMA temp_store = {temp_store}")
+    conn.execute(f"PRAGMA wal_autocheckpoint = {int(wal_autocheckpoint)}")
+
+
+def checkpoint_sync(conn: sqlite3.Connection, schemas: Iterable[str], mode: str) -> Dict[str, int]:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Выполняет контрольную точку WAL каждой схемы вне транзакции.
+
+    Returns:
+        Суммы по схемам: busy (схем, где контрольная точка не завершена из-за читателей/писателей),
+        wal_pages (страниц в WAL) и checkpointed (перенесено страниц).
+    """
+    mode = _choice(mode, _CHECKPOINT_MODES, 'checkpoint')
+    totals = {'busy': 0, 'wal_pages': 0, 'checkpointed': 0}
+    for schema in schemas:
+        busy, wal_pages, checkpointed = conn.execute(f"PRAGMA {schema}.wal_checkpoint({mode})").fetchone()
+        totals['busy'] += busy
+        # -1: схема не в режиме WAL
+        totals['wal_pages'] += max(wal_pages, 0)
+        totals['checkpointed'] += max(checkpointed, 0)
+    return totals
+
+
+def optimize_sync(conn: sqlite3.Connection):
+    """(СИНХРОННАЯ ФУНКЦИЯ) Обновляет статистику планировщика там, где она устарела (PRAGMA optimize)."""
+    conn.execute("PRAGMA optimize").fetchall()
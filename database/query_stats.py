@@ -0,0 +1,202 @@
+# File: database/query_stats.py
+"""
+Статистика времени SQL-запросов и журнал медленных запросов.
+
+Соединения БД создаются с фабрикой `TimedConnection`: каждый execute/executemany
+замеряется и учитывается в гистограмме своего запроса. Запросы группируются по
+нормализованному тексту (пробелы схлопнуты, числовые и строковые литералы
+заменены на '?'). Замер охватывает выполнение до первой строки результата —
+для записи, агрегатов и сортировок это практически все время запроса;
+дочитывание строк курсора не учитывается.
+
+Запрос, впервые превысивший порог `slow_ms`, один раз записывается в журнал
+вместе с планом EXPLAIN QUERY PLAN и формой параметров (только типы: в
+параметрах бывают тексты сообщений и ключи API).
+
+Статистика пополняется из потоков пула соединений, поэтому защищена блокировкой.
+"""
+import functools
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from logger_config import get_logger
+
+query_logger = get_logger('database', user_id='System')
+
+# Верхние границы корзин гистограммы, мс (последняя корзина — все, что дольше)
+BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+# Запросы сверх лимита различных текстов учитываются под этим ключом
+OTHER_STATEMENTS = '<прочие запросы>'
+# Для этих запросов бывает план выполнения (для PRAGMA, BEGIN/COMMIT и т.п. — нет)
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql: str) -> str:
+    """Нормализованный текст запроса: ключ статистики."""
+    return _WHITESPACE.sub(' ', _LITERALS.sub('?', sql)).strip().rstrip(';')
+
+
+def params_shape(params: Any) -> str:
+    """Форма параметров без значений: типы позиционных или имена и типы именованных."""
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in params.items()) + "}"
+    if isinstance(params, (list, tuple)):
+        return "(" + ", ".join(type(value).__name__ for value in params) + ")"
+    return type(params).__name__
+
+
+def _format_plan(rows: List[tuple]) -> str:
+    """План EXPLAIN QUERY PLAN в виде дерева с отступами."""
+    depth: Dict[int, int] = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append(f"{'  ' * (depth[node_id] + 1)}{detail}")
+    return "\n".join(lines)
+
+
+class _Statement:
+    __slots__ = ('calls', 'total_ms', 'max_ms', 'slow', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.slow = 0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def percentile_ms(self, fraction: float) -> float:
+        """Оценка перцентиля по гистограмме: верхняя граница корзины, но не больше наблюдавшегося максимума."""
+        target = fraction * self.calls
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target and count and index < len(BUCKETS_MS):
+                return round(min(float(BUCKETS_MS[index]), self.max_ms), 2)
+        return round(self.max_ms, 2)
+
+
+class QueryStats:
+    """
+    Гистограммы времени выполнения по нормализованным запросам.
+
+    Args:
+        slow_ms: Порог медленного запроса, мс (0 — журнал медленных запросов выключен).
+        max_statements: Максимум различных запросов в статистике.
+    """
+
+    def __init__(self, slow_ms: float, max_statements: int):
+        self.slow_ms = slow_ms
+        self.max_statements = max_statements
+        self._statements: Dict[str, _Statement] = {}
+        self._reported: set = set()
+        self._lock = threading.Lock()
+
+    def observe(self, conn: sqlite3.Connection, sql: str, params: Any, elapsed_ms: float):
+        """Учитывает выполнение запроса; медленный запрос при первом превышении порога пишет в журнал."""
+        key = normalize(sql)
+        is_slow = 0 < self.slow_ms <= elapsed_ms
+        with self._lock:
+            statement = self._statements.get(key)
+            if statement is None:
+                if len(self._statements) >= self.max_statements:
+                    key = OTHER_STATEMENTS
+                statement = self._statements.setdefault(key, _Statement())
+            statement.calls += 1
+            statement.total_ms += elapsed_ms
+            statement.max_ms = max(statement.max_ms, elapsed_ms)
+            index = 0
+            while index < len(BUCKETS_MS) and elapsed_ms > BUCKETS_MS[index]:
+                index += 1
+            statement.buckets[index] += 1
+            report = False
+            if is_slow:
+                statement.slow += 1
+                report = key != OTHER_STATEMENTS and key not in self._reported
+                if report:
+                    self._reported.add(key)
+        if report:
+            self._report(conn, sql, key, params, elapsed_ms)
+
+    def _report(self, conn: sqlite3.Connection, sql: str, key: str, params: Any, elapsed_ms: float):
+        plan = "  (нет)"
+        if key.lstrip('( ').upper().startswith(_EXPLAINABLE) and params is not None:
+            try:
+                # Запрос плана выполняется мимо замера, на том же соединении и в той же транзакции
+                rows = sqlite3.Connection.execute(conn, f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+                plan = _format_plan([tuple(row) for row in rows]) or plan
+            except sqlite3.Error as e:
+                plan = f"  (не получен: {e})"
+        query_logger.warning(f"Медленный запрос: {elapsed_ms:.1f} мс (порог {self.slow_ms} мс), "
+                             f"параметры {params_shape(params)}\nSQL: {key}\nПлан:\n{plan}")
+
+    def top(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """Запросы с наибольшим суммарным временем выполнения."""
+        with self._lock:
+            items = sorted(self._statements.items(), key=lambda item: item[1].total_ms, reverse=True)[:limit]
+            return [{
+                'sql': key,
+                'calls': statement.calls,
+                'total_ms': round(statement.total_ms, 1),
+                'avg_ms': round(statement.total_ms / statement.calls, 2),
+                'p95_ms': statement.percentile_ms(0.95),
+                'max_ms': round(statement.max_ms, 2),
+                'slow': statement.slow,
+            } for key, statement in items]
+
+    def summary(self) -> Dict[str, Any]:
+        """Общее число запросов, их суммарное время и число медленных."""
+        with self._lock:
+            return {
+                'statements': len(self._statements),
+                'calls': sum(s.calls for s in self._statements.values()),
+                'total_ms': round(sum(s.total_ms for s in self._statements.values()), 1),
+                'slow': sum(s.slow for s in self._statements.values()),
+            }
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, замеряющий execute/executemany (статистика — в `connection.query_stats`)."""
+
+    def execute(self, sql: str, parameters: Any = ()):
+        stats = self.connection.query_stats
+        if stats is None:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            stats.observe(self.connection, sql, parameters, (time.perf_counter() - started) * 1000)
+
+    def executemany(self, sql: str, seq_of_parameters: Any):
+        stats = self.connection.query_stats
+        if stats is None:
+            return super().executemany(sql, seq_of_parameters)
+        # План строится по первому набору параметров, если он доступен без расхода итератора
+        sample = seq_of_parameters[0] if isinstance(seq_of_parameters, (list, tuple)) and seq_of_parameters else None
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            stats.observe(self.connection, sql, sample, (time.perf_counter() - started) * 1000)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого замеряют запросы. Статистика включается присвоением `query_stats`."""
+
+    query_stats: Optional[QueryStats] = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters: Any = ()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Any):
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,181 @@
+# File: database/retention.py
+"""
+Политика хранения истории сообщений и возврат освободившегося места.
+
+Два правила, каждое включается своей настройкой:
+    * максимальный возраст — удаляются сообщения старше N дней;
+    * максимум сообщений в диалоге — удаляются самые старые сверх N.
+Оба правила действуют на основную базу и на архив (блоки архива при
+необходимости переписываются без удаленных сообщений). Диалоги, помеченные
+удаленными, пропускаются: их историю целиком удаляет dialog_reaper.
+
+Функции этого модуля удаляют не больше `batch_size` сообщений за вызов (кроме
+единственного блока архива крупнее пачки) и выполняются писателем пула внутри его транзакции: между пачками успевают
+пройти обычные записи пользователей. Счетчики сообщений в users/dialogs
+уменьшаются на число удаленных сообщений; суточные суммы токенов
+(usage_daily) остаются — это статистика, а не содержимое переписки.
+
+Освобожденные страницы возвращаются файлу через `PRAGMA incremental_vacuum`,
+для чего база переводится в режим `auto_vacuum = INCREMENTAL`.
+"""
+import json
+import sqlite3
+from typing import Dict
+
+from logger_config import get_logger
+from . import archive
+from .dialog_reaper import DELETED_DIALOGS_SQL
+
+retention_logger = get_logger('database', user_id='System')
+
+# Значение PRAGMA auto_vacuum для режима INCREMENTAL
+_AUTO_VACUUM_INCREMENTAL = 2
+
+
+def _release_counters(conn: sqlite3.Connection, per_dialog: Dict[int, int], per_user: Dict[int, int]):
+    """Уменьшает счетчики сообщений диалогов и пользователей на число удаленных сообщений."""
+    conn.executemany("""
+        UPDATE dialogs SET message_count = MAX(message_count - ?, 0),
+            last_message_at = CASE WHEN message_count - ? <= 0 THEN NULL ELSE last_message_at END
+        WHERE dialog_id = ?
+    """, [(count, count, dialog_id) for dialog_id, count in per_dialog.items()])
+    conn.executemany("""
+        UPDATE users SET message_count = MAX(message_count - ?, 0),
+            last_message_at = CASE WHEN message_count - ? <= 0 THEN NULL ELSE last_message_at END
+        WHERE user_id = ?
+    """, [(count, count, user_id) for user_id, count in per_user.items()])
+
+
+def _count(counter: Dict[int, int], key: int, value: int):
+    counter[key] = counter.get(key, 0) + value
+
+
+def purge_by_age_sync(conn: sqlite3.Connection, cutoff_ts: int, batch_size: int) -> int:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Удаляет до `batch_size` сообщений старше `cutoff_ts`: сначала из архива, затем
+    из основной базы. Блок архива обрабатывается целиком, поэтому пачка превышает `batch_size`, только
+    если первый же блок крупнее нее (как в dialog_reaper.reap_batch_sync).
+
+    Returns:
+        Количество удаленных сообщений.
+    """
+    per_dialog: Dict[int, int] = {}
+    per_user: Dict[int, int] = {}
+    removed = 0
+    for block in conn.execute(f"""
+        SELECT block_id, dialog_id, user_id, message_count, last_ts
+        FROM {archive.SCHEMA}.conversation_blocks
+        WHERE first_ts < ? AND dialog_id NOT IN ({DELETED_DIALOGS_SQL})
+        ORDER BY first_ts LIMIT ?
+    """, (cutoff_ts, batch_size)).fetchall():
+        # Блок удаляется целиком или не трогается; блок крупнее пачки допускается только первым
+        if removed and removed + block['message_count'] > batch_size:
+            break
+        if block['last_ts'] < cutoff_ts:
+            dropped = block['message_count']
+            archive.rewrite_block_sync(conn, block['block_id'], [])
+        else:
+            messages = archive.read_block_sync(conn, block['block_id'])
+            kept = [message for message in messages if message['ts'] >= cutoff_ts]
+            dropped = len(messages) - len(kept)
+            archive.rewrite_block_sync(conn, block['block_id'], kept)
+        removed += dropped
+        _count(per_dialog, block['dialog_id'], dropped)
+        _count(per_user, block['user_id'], dropped)
+
+    if removed < batch_size:
+        rows = conn.execute(f"""
+            SELECT conversation_id, dialog_id, user_id FROM conversations
+            WHERE ts < ? AND dialog_id NOT IN ({DELETED_DIALOGS_SQL}) ORDER BY ts LIMIT ?
+        """, (cutoff_ts, batch_size - removed)).fetchall()
+        if rows:
+            conn.execute("DELETE FROM conversations WHERE conversation_id IN (SELECT value FROM json_each(?))",
+                         (json.dumps([row['conversation_id'] for row in rows]),))
+            for row in rows:
+                _count(per_dialog, row['dialog_id'], 1)
+                _count(per_user, row['user_id'], 1)
+            removed += len(rows)
+
+    _release_counters(conn, per_dialog, per_user)
+    return removed
+
+
+def purge_dialog_overflow_sync(conn: sqlite3.Connection, max_messages: int, batch_size: int) -> int:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Удаляет до `batch_size` самых старых сообщений в диалогах, где их больше
+    `max_messages`. Лишние сообщения определяются по счетчику dialogs.message_count (он учитывает архив);
+    самые старые лежат в архиве, поэтому удаление начинается с него.
+
+    Returns:
+        Количество удаленных сообщений.
+    """
+    per_dialog: Dict[int, int] = {}
+    per_user: Dict[int, int] = {}
+    removed = 0
+    for dialog in conn.execute("""
+        SELECT dialog_id, user_id, message_count - ? AS excess FROM dialogs
+        WHERE message_count > ? AND deleted_at IS NULL ORDER BY dialog_id LIMIT ?
+    """, (max_messages, max_messages, batch_size)).fetchall():
+        excess = min(dialog['excess'], batch_size - removed)
+        if excess <= 0:
+            break
+        dropped = 0
+        for block in conn.execute(f"""
+            SELECT block_id, message_count FROM {archive.SCHEMA}.conversation_blocks
+            WHERE dialog_id = ? ORDER BY day, seq
+        """, (dialog['dialog_id'],)).fetchall():
+            if dropped >= excess:
+                break
+            if block['message_count'] <= excess - dropped:
+                archive.rewrite_block_sync(conn, block['block_id'], [])
+                dropped += block['message_count']
+            else:
+                messages = archive.read_block_sync(conn, block['block_id'])
+                archive.rewrite_block_sync(conn, block['block_id'], messages[excess - dropped:])
+                dropped = excess
+        if dropped < excess:
+            dropped += conn.execute("""
+                DELETE FROM conversations WHERE conversation_id IN (
+                    SELECT conversation_id FROM conversations WHERE dialog_id = ?
+                    ORDER BY conversation_id LIMIT ?
+                )
+            """, (dialog['dialog_id'], excess - dropped)).rowcount
+        removed += dropped
+        _count(per_dialog, dialog['dialog_id'], dropped)
+        _count(per_user, dialog['user_id'], dropped)
+
+    _release_counters(conn, per_dialog, per_user)
+    return removed
+
+
+def incremental_vacuum_sync(conn: sqlite3.Connection, schema: str, max_pages: int) -> int:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Возвращает файлу схемы `schema` до `max_pages` свободных страниц.
+
+    Returns:
+        Количество освобожденных байт.
+    """
+    page_size = conn.execute(f"PRAGMA {schema}.page_size").fetchone()[0]
+    before = conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+    if not before:
+        return 0
+    # PRAGMA incremental_vacuum освобождает по странице на каждый шаг выполнения — читаем результат до конца
+    conn.execute(f"PRAGMA {schema}.incremental_vacuum({int(max_pages)})").fetchall()
+    after = conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+    return (before - after) * page_size
+
+
+def ensure_incremental_auto_vacuum(conn: sqlite3.Connection, schema: str):
+    """
+    Переводит файл схемы в режим auto_vacuum = INCREMENTAL. Для непустой базы это требует
+    полного VACUUM, поэтому выполняется один раз (миграцией) и только вне транзакции.
+    Если база занята другим процессом, VACUUM завершается ошибкой, и миграция повторится
+    при следующем запуске.
+    """
+    if conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] == _AUTO_VACUUM_INCREMENTAL:
+        return
+    conn.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+    if conn.execute(f"SELECT COUNT(*) FROM {schema}.sqlite_master").fetchone()[0]:
+        retention_logger.warning(f"Перевод базы '{schema}' в режим auto_vacuum=INCREMENTAL (полный VACUUM)...")
+        conn.execute(f"VACUUM {schema}")
+        retention_logger.info(f"База '{schema}' переведена в режим auto_vacuum=INCREMENTAL.")
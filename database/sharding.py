@@ -0,0 +1,160 @@
+# File: database/sharding.py
+"""
+Шардирование хранилища по пользователям.
+
+При DB_SHARDS > 1 пользователи распределяются по N файлам БД по хэшу user_id;
+у каждого шарда свой файл архива и свой пул соединений со своим писателем.
+Шард 0 — это исходные файлы (DATABASE_NAME и ARCHIVE_DATABASE_NAME), шард k —
+файлы с суффиксом `.shard<k>` рядом с ними. Все данные пользователя (профиль,
+диалоги, история, архив, usage_daily) лежат в его шарде; глобальные настройки
+(app_settings) — в шарде 0.
+
+Идентификаторы диалогов и сообщений уникальны во всех шардах: каждый шард
+выдает их из своей полосы шириной ID_BAND (значение sqlite_sequence задается
+при настройке). После решардинга полосы начинаются выше всех существующих
+идентификаторов (новая «эпоха»), поэтому перенесенные строки сохраняют свои ID.
+
+Число шардов и эпоха хранятся в app_settings шарда 0: бот не запустится,
+если DB_SHARDS не совпадает с раскладкой базы — сначала нужно выполнить
+`python -m database.maintenance reshard`.
+"""
+import json
+import os
+import sqlite3
+import zlib
+from typing import Dict, List, Optional
+
+from . import archive
+
+# Ширина полосы идентификаторов одного шарда
+ID_BAND = 1 << 40
+# Ключ app_settings шарда 0 с раскладкой: {"shards": N, "epoch": E}
+LAYOUT_SETTING_KEY = 'db_shard_layout'
+# Таблицы с AUTOINCREMENT, идентификаторы которых выдаются из полосы шарда
+_SEQUENCE_TABLES = ('dialogs', 'conversations')
+# Таблицы основной базы с данными пользователя (в порядке копирования)
+_USER_TABLES = ('users', 'dialogs', 'conversations', 'usage_daily')
+
+
+class ShardLayoutError(RuntimeError):
+    """Раскладка базы не совпадает с настройкой DB_SHARDS."""
+
+
+def shard_for_user(user_id: int, shards: int) -> int:
+    """Номер шарда пользователя: CRC32 от user_id по модулю числа шардов."""
+    if shards <= 1:
+        return 0
+    return zlib.crc32(str(user_id).encode('ascii')) % shards
+
+
+def shard_path(base_path: str, shard: int) -> str:
+    """Путь к файлу шарда: для шарда 0 — исходный путь, иначе `<имя>.shard<k><расширение>`."""
+    if shard == 0:
+        return base_path
+    root, ext = os.path.splitext(base_path)
+    return f"{root}.shard{shard}{ext}"
+
+
+def id_base(epoch: int, shards: int, shard: int) -> int:
+    """Начало полосы идентификаторов шарда в эпохе `epoch`."""
+    return (epoch * shards + shard) * ID_BAND
+
+
+def next_epoch(max_id: int, shards: int) -> int:
+    """Первая эпоха, все полосы которой лежат выше `max_id`."""
+    return max_id // (shards * ID_BAND) + 1 if max_id > 0 else 0
+
+
+def read_layout(conn: sqlite3.Connection) -> Optional[Dict[str, int]]:
+    """Читает раскладку шардов из app_settings (None, если она еще не записана)."""
+    row = conn.execute("SELECT value FROM app_settings WHERE key = ?", (LAYOUT_SETTING_KEY,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def write_layout(conn: sqlite3.Connection, shards: int, epoch: int):
+    """Записывает раскладку шардов в app_settings."""
+    conn.execute("INSERT INTO app_settings (key, value) VALUES (?, ?) "
+                 "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                 (LAYOUT_SETTING_KEY, json.dumps({'shards': shards, 'epoch': epoch})))
+
+
+def seed_id_sequences(conn: sqlite3.Connection, base: int):
+    """Поднимает sqlite_sequence таблиц с AUTOINCREMENT до начала полосы шарда (если они ниже)."""
+    for table in _SEQUENCE_TABLES:
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+        if row is None:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, base))
+        elif row[0] < base:
+            conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (base, table))
+
+
+def max_id(conn: sqlite3.Connection) -> int:
+    """Наибольший выданный идентификатор диалога или сообщения в шарде (с учетом sqlite_sequence)."""
+    values = []
+    for table in _SEQUENCE_TABLES:
+        values.append(conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone())
+        values.append(conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone())
+    return max((row[0] or 0) for row in values if row is not None)
+
+
+def copy_settings_sync(dest: sqlite3.Connection, source_main: str):
+    """(СИНХРОННАЯ ФУНКЦИЯ) Копирует глобальные настройки (app_settings, кроме раскладки) из исходного шарда 0."""
+    dest.execute("ATTACH DATABASE ? AS src", (source_main,))
+    try:
+        with dest:
+            dest.execute("INSERT OR REPLACE INTO app_settings (key, value) "
+                         "SELECT key, value FROM src.app_settings WHERE key != ?", (LAYOUT_SETTING_KEY,))
+    finally:
+        dest.execute("DETACH DATABASE src")
+
+
+def _columns(conn: sqlite3.Connection, schema: str, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def copy_users_sync(dest: sqlite3.Connection, source_main: str, source_archive: str, shard: int, shards: int) -> int:
+    """
+    (СИНХРОННАЯ ФУНКЦИЯ) Копирует в `dest` (новый шард `shard`) данные пользователей исходного шарда,
+    которые при `shards` шардах попадают в `shard`, одной транзакцией и с сохранением идентификаторов.
+    Индекс FTS и счетчики ссылок блобов заполняют триггеры conversations, поисковый индекс архива —
+    триггеры conversation_blocks. Соединение — в режиме autocommit.
+
+    Returns:
+        Количество перенесенных пользователей.
+    """
+    dest.create_function('user_shard', 1, lambda user_id: shard_for_user(user_id, shards), deterministic=True)
+    dest.execute("ATTACH DATABASE ? AS src", (source_main,))
+    dest.execute("ATTACH DATABASE ? AS src_archive", (source_archive,))
+    # users и dialogs ссылаются друг на друга (active_dialog_id), проверка внешних ключей на время копирования выключена
+    dest.execute("PRAGMA foreign_keys = OFF")
+    try:
+        dest.execute("BEGIN IMMEDIATE")
+        try:
+            for table in _USER_TABLES:
+                if table == 'conversations':
+                    dest.execute("""
+                        INSERT OR IGNORE INTO message_blobs (hash, codec, size, refcount, data)
+                        SELECT hash, codec, size, 0, data FROM src.message_blobs WHERE hash IN (
+                            SELECT blob_hash FROM src.conversations
+                            WHERE blob_hash IS NOT NULL AND user_shard(user_id) = ?
+                        )""", (shard,))
+                columns = ", ".join(_columns(dest, 'main', table))
+                order = " ORDER BY conversation_id" if table == 'conversations' else ""
+                dest.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM src.{table} "
+                             f"WHERE user_shard(user_id) = ?{order}", (shard,))
+            # block_id не используется вне архива и назначается заново
+            columns = ", ".join(name for name in _columns(dest, archive.SCHEMA, 'conversation_blocks')
+                                if name != 'block_id')
+            dest.execute(f"INSERT INTO {archive.SCHEMA}.conversation_blocks ({columns}) "
+                         f"SELECT {columns} FROM src_archive.conversation_blocks WHERE user_shard(user_id) = ? "
+                         f"ORDER BY block_id", (shard,))
+            copied = dest.execute("SELECT COUNT(*) FROM src.users WHERE user_shard(user_id) = ?", (shard,)).fetchone()[0]
+            dest.execute("COMMIT")
+        except sqlite3.Error:
+            dest.execute("ROLLBACK")
+            raise
+    finally:
+        dest.execute("PRAGMA foreign_keys = ON")
+        dest.execute("DETACH DATABASE src")
+        dest.execute("DETACH DATABASE src_archive")
+    return copied
@@ -0,0 +1,138 @@
+# File: database/storage.py
+"""
+Интерфейс хранилища данных бота и выбор его реализации.
+
+Обработчики обращаются к хранилищу через этот модуль, например
+`await storage.get_user_language(user_id)`: вызов передается текущей
+реализации `StorageBackend`, выбранной настройкой STORAGE_BACKEND:
+    * sqlite — SQLite (функции database/db_manager.py), рабочий режим;
+    * memory — словари и отсортированные списки в памяти процесса
+      (database/memory_backend.py). Данные теряются при перезапуске; режим
+      нужен для нагрузочных тестов и бенчмарков без дискового ввода-вывода.
+
+Служебные возможности SQLite (пулы соединений, архив, политика хранения,
+резервные копии, шардирование) в интерфейс не входят и вызываются из db_manager;
+при другом хранилище их разделы в админ-панели скрыты (см. `is_sqlite`).
+"""
+import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Protocol, Tuple, runtime_checkable
+
+from config.settings import STORAGE_BACKEND
+from . import db_manager
+from .user_cache import UserProfile
+
+
+@runtime_checkable
+class StorageBackend(Protocol):
+    """Операции с данными, которые используют обработчики бота."""
+
+    # Жизненный цикл
+    async def setup_database(self) -> None: ...
+    async def close_database(self) -> None: ...
+
+    # Пользователь и его настройки
+    async def get_user_profile(self, user_id: int) -> Optional[UserProfile]: ...
+    async def add_or_update_user(self, user_id: int, username: Optional[str], first_name: Optional[str],
+                                 last_name: Optional[str]) -> None: ...
+    async def get_user_language(self, user_id: int) -> str: ...
+    async def set_user_language(self, user_id: int, lang_code: str) -> None: ...
+    async def get_user_bot_style(self, user_id: int) -> str: ...
+    async def set_user_bot_style(self, user_id: int, style: str) -> None: ...
+    async def get_user_api_key(self, user_id: int) -> Optional[str]: ...
+    async def set_user_api_key(self, user_id: int, api_key: Optional[str]) -> None: ...
+    async def get_user_gemini_model(self, user_id: int) -> Optional[str]: ...
+    async def set_user_gemini_model(self, user_id: int, model_name: str) -> None: ...
+    async def get_user_persona(self, user_id: int) -> str: ...
+    async def set_user_persona(self, user_id: int, persona_id: str) -> None: ...
+    async def get_first_interaction_date(self, user_id: int) -> Optional[str]: ...
+    async def get_user_context_info(self, user_id: int) -> Optional[Dict[str, Any]]: ...
+
+    # Диалоги
+    async def get_active_dialog_id(self, user_id: int) -> Optional[int]: ...
+    async def create_dialog(self, user_id: int, name: str, set_active: bool = False) -> Optional[int]: ...
+    async def get_user_dialogs(self, user_id: int) -> List[Dict[str, Any]]: ...
+    async def set_active_dialog(self, user_id: int, dialog_id: int) -> None: ...
+    async def rename_dialog(self, user_id: int, dialog_id: int, new_name: str) -> None: ...
+    async def delete_dialog(self, user_id: int, dialog_id_to_delete: int) -> Optional[str]: ...
+
+    # История сообщений и статистика пользователя
+    async def store_message(self, user_id: int, dialog_id: int, role: str, message_text: str,
+                            prompt_tokens: int = 0, completion_tokens: int = 0, total_tokens: int = 0,
+                            model: Optional[str] = None) -> None: ...
+    async def get_conversation_history(self, user_id: int, dialog_id: int,
+                                       limit: int = 20) -> List[Dict[str, Any]]: ...
+    async def get_conversation_history_by_date(self, user_id: int, dialog_id: int,
+                                               history_date: datetime.date) -> List[Dict[str, Any]]: ...
+    async def search_messages(self, user_id: int, query: str, dialog_id: Optional[int] = None,
+                              limit: int = 5, offset: int = 0) -> Tuple[List[Dict[str, Any]], bool]: ...
+    async def get_total_user_message_count(self, user_id: int) -> int: ...
+    async def get_token_usage_by_period(self, user_id: int, period: str) -> Dict[str, int]: ...
+
+    # Глобальные настройки
+    async def set_app_setting(self, key: str, value: str) -> None: ...
+    async def get_app_setting(self, key: str) -> Optional[str]: ...
+
+    # Администрирование
+    async def is_user_blocked(self, user_id: int) -> bool: ...
+    async def block_user(self, user_id: int) -> None: ...
+    async def unblock_user(self, user_id: int) -> None: ...
+    def iterate_user_ids(self) -> AsyncIterator[int]: ...
+    async def get_total_users_count(self) -> int: ...
+    async def get_blocked_users_count(self) -> int: ...
+    async def get_active_users_count(self, days: int = 7) -> int: ...
+    async def get_new_users_count(self, days: int = 7) -> int: ...
+    async def get_user_info_for_admin(self, user_id: int) -> Optional[Dict[str, Any]]: ...
+    def iterate_users_for_export(self) -> AsyncIterator[Any]: ...
+
+
+# Имена операций интерфейса
+OPERATIONS = frozenset(name for name, value in vars(StorageBackend).items()
+                       if callable(value) and not name.startswith('_'))
+
+
+class SQLiteBackend:
+    """Хранилище на SQLite: операции интерфейса — одноименные функции модуля db_manager."""
+
+    def __getattr__(self, name: str) -> Any:
+        if name not in OPERATIONS:
+            raise AttributeError(name)
+        return getattr(db_manager, name)
+
+
+def select_backend(name: str) -> StorageBackend:
+    """Создает реализацию хранилища по имени ('sqlite' или 'memory')."""
+    if name == 'sqlite':
+        return SQLiteBackend()
+    if name == 'memory':
+        from .memory_backend import InMemoryBackend
+        return InMemoryBackend()
+    raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND: {name} (допустимы: sqlite, memory)")
+
+
+_backend: Optional[StorageBackend] = None
+
+
+def get_backend() -> StorageBackend:
+    """Возвращает текущую реализацию хранилища (при первом обращении — выбранную STORAGE_BACKEND)."""
+    global _backend
+    if _backend is None:
+        _backend = select_backend(STORAGE_BACKEND)
+    return _backend
+
+
+def is_sqlite() -> bool:
+    """Работает ли бот на SQLite, то есть доступны ли служебные возможности db_manager."""
+    return isinstance(get_backend(), SQLiteBackend)
+
+
+def use_backend(backend: StorageBackend):
+    """Подменяет реализацию хранилища (бенчмарки, нагрузочные тесты)."""
+    global _backend
+    _backend = backend
+
+
+def __getattr__(name: str) -> Any:
+    # storage.<операция> — операция текущей реализации
+    if name in OPERATIONS:
+        return getattr(get_backend(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,103 @@
+# File: database/unit_of_work.py
+"""
+Единица работы (unit of work) для составных операций с БД.
+
+Операции сначала накапливаются в объекте `UnitOfWork`, а затем выполняются
+одним заданием писателя пула — на одном соединении, в одной транзакции и за
+один переход между потоками. Промежуточные решения принимаются средствами SQL
+(подзапросы, `last_insert_rowid()`), а предусловия — через `require`: если
+предусловие не выполнено, вся единица работы откатывается.
+
+Пример:
+    async with db_manager.transaction() as tx:
+        tx.require("SELECT 1 FROM dialogs WHERE dialog_id = ?", (dialog_id,), reason="диалог не найден")
+        deleted = tx.execute("DELETE FROM dialogs WHERE dialog_id = ?", (dialog_id,))
+    if not tx.aborted:
+        print(deleted.value)
+"""
+import sqlite3
+from typing import Any, Callable, List, Optional
+
+
+class UnitAborted(Exception):
+    """Предусловие единицы работы не выполнено; транзакция откатывается."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class OpResult:
+    """Результат отложенной операции. Поле `value` заполняется после фиксации транзакции."""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value: Any = None
+
+
+class UnitOfWork:
+    """Накапливает операции для выполнения одной транзакцией."""
+
+    def __init__(self):
+        self._ops: List[tuple] = []
+        self.aborted = False
+        self.abort_reason: Optional[str] = None
+
+    def __bool__(self) -> bool:
+        return bool(self._ops)
+
+    def execute(self, query: str, params: tuple = ()) -> OpResult:
+        """Добавляет запрос на запись. Результат: lastrowid для INSERT, rowcount для UPDATE/DELETE."""
+        return self._add('execute', query, params)
+
+    def fetch_one(self, query: str, params: tuple = ()) -> OpResult:
+        """Добавляет запрос на чтение одной строки (внутри той же транзакции)."""
+        return self._add('fetch_one', query, params)
+
+    def fetch_all(self, query: str, params: tuple = ()) -> OpResult:
+        """Добавляет запрос на чтение всех строк (внутри той же транзакции)."""
+        return self._add('fetch_all', query, params)
+
+    def require(self, query: str, params: tuple = (), reason: str = "предусловие не выполнено") -> OpResult:
+        """Добавляет предусловие: если запрос не вернул строку, единица работы откатывается целиком."""
+        return self._add('require', query, params, reason)
+
+    def run(self, fn: Callable[[sqlite3.Connection], Any]) -> OpResult:
+        """Добавляет произвольный шаг `fn(conn)`; он не должен управлять транзакцией сам."""
+        return self._add('run', fn, None)
+
+    def mark_aborted(self, reason: str):
+        """Помечает единицу работы откатившейся и сбрасывает частично заполненные результаты."""
+        self.aborted = True
+        self.abort_reason = reason
+        for *_, result in self._ops:
+            result.value = None
+
+    def _add(self, kind: str, target: Any, params: Any, reason: Optional[str] = None) -> OpResult:
+        result = OpResult()
+        self._ops.append((kind, target, params, reason, result))
+        return result
+
+    def apply(self, conn: sqlite3.Connection):
+        """
+        (СИНХРОННЫЙ МЕТОД) Выполняет накопленные операции на соединении писателя.
+        Транзакцию открывает и фиксирует пул; исключение откатывает все операции.
+        """
+        for kind, target, params, reason, result in self._ops:
+            if kind == 'run':
+                result.value = target(conn)
+                continue
+            cursor = conn.execute(target, params)
+            if kind == 'fetch_one':
+                result.value = cursor.fetchone()
+            elif kind == 'fetch_all':
+                result.value = cursor.fetchall()
+            elif kind == 'require':
+                row = cursor.fetchone()
+                if row is None:
+                    raise UnitAborted(reason)
+                result.value = row
+            elif target.lstrip().upper().startswith("INSERT"):
+                result.value = cursor.lastrowid
+            else:
+                result.value = cursor.rowcount
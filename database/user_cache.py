@@ -0,0 +1,111 @@
+# File: database/user_cache.py
+"""
+Кэш профилей пользователей.
+
+Один текстовый запрос пользователя читает язык, статус блокировки, API-ключ,
+активный диалог, модель, персону и стиль — все это поля одной строки `users`.
+Кэш хранит строку целиком (`UserProfile`) и обновляется по принципу
+write-through функциями записи из db_manager. Вытеснение — LRU с ограничением
+времени жизни записи (TTL).
+
+Кэш используется только из потока event loop, поэтому блокировки не нужны.
+"""
+import dataclasses
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from cachetools import TTLCache
+
+
+@dataclass(frozen=True)
+class UserProfile:
+    """Снимок строки `users` вместе с именем активного диалога."""
+    user_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    bot_style: str
+    first_interaction_date: Optional[str]
+    api_key: Optional[str] = field(repr=False)  # В зашифрованном виде, как в БД
+    language_code: str
+    gemini_model: Optional[str]
+    active_persona: str
+    active_dialog_id: Optional[int]
+    active_dialog_name: Optional[str]
+    is_blocked: bool
+
+    @classmethod
+    def from_row(cls, row) -> 'UserProfile':
+        """Создает профиль из строки запроса (sqlite3.Row или dict) с полями `users` и `active_dialog_name`."""
+        data = {f.name: row[f.name] for f in dataclasses.fields(cls)}
+        data['is_blocked'] = bool(data['is_blocked'])
+        return cls(**data)
+
+
+class UserProfileCache:
+    """
+    LRU-кэш профилей с TTL и счетчиками попаданий.
+
+    Args:
+        maxsize: Максимальное число профилей в памяти.
+        ttl: Время жизни записи в секундах.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._hits = 0
+        self._misses = 0
+        # Счетчик записей: загрузка, начатая до записи, не должна положить в кэш устаревшую строку
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, user_id: int) -> Optional[UserProfile]:
+        profile = self._cache.get(user_id)
+        if profile is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+        return profile
+
+    def put(self, profile: UserProfile, generation: Optional[int] = None):
+        """Кладет профиль в кэш. Если передан `generation` и с тех пор были записи — профиль отбрасывается."""
+        if generation is not None and generation != self._generation:
+            return
+        self._cache[profile.user_id] = profile
+
+    def update(self, user_id: int, **fields: Any):
+        """Write-through: обновляет поля закэшированного профиля (если он есть в кэше)."""
+        self._generation += 1
+        profile = self._cache.get(user_id)
+        if profile is not None:
+            self._cache[user_id] = dataclasses.replace(profile, **fields)
+
+    def rename_dialog(self, dialog_id: int, name: str):
+        """Обновляет имя диалога во всех профилях, где он активен."""
+        self._generation += 1
+        for user_id, profile in list(self._cache.items()):
+            if profile.active_dialog_id == dialog_id:
+                self._cache[user_id] = dataclasses.replace(profile, active_dialog_name=name)
+
+    def invalidate(self, user_id: int):
+        self._generation += 1
+        self._cache.pop(user_id, None)
+
+    def clear(self):
+        self._generation += 1
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает размер кэша и счетчики попаданий/промахов."""
+        lookups = self._hits + self._misses
+        return {
+            'size': len(self._cache),
+            'maxsize': int(self._cache.maxsize),
+            'ttl': self._cache.ttl,
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': round(self._hits / lookups * 100, 1) if lookups else 0.0,
+        }
@@ -0,0 +1,60 @@
+# File: features/search.py
+import datetime
+from typing import Optional, Tuple
+
+from cachetools import LRUCache
+from telebot import types
+
+from database import db_manager, storage
+from config.settings import SEARCH_PAGE_SIZE, USER_CACHE_SIZE
+from utils import markup_helpers as mk
+from utils import localization as loc
+from utils import text_helpers as th
+from logger_config import get_logger
+
+logger = get_logger(__name__, user_id='System')
+
+# Последний поисковый запрос пользователя: callback_data ограничена 64 байтами,
+# поэтому кнопки листания передают только смещение, а запрос хранится здесь.
+_last_queries: LRUCache = LRUCache(maxsize=USER_CACHE_SIZE)
+
+
+def remember_query(user_id: int, query: str):
+    _last_queries[user_id] = query
+
+
+def get_last_query(user_id: int) -> Optional[str]:
+    return _last_queries.get(user_id)
+
+
+def _format_snippet(snippet: Optional[str]) -> str:
+    """Экранирует сниппет и выделяет найденные слова жирным."""
+    safe = th.escape_markdown(snippet or "")
+    return safe.replace(db_manager.SEARCH_HIGHLIGHT_START, "*").replace(db_manager.SEARCH_HIGHLIGHT_END, "*")
+
+
+async def build_results_page(user_id: int, query: str, offset: int,
+                             lang_code: str) -> Tuple[str, Optional[types.InlineKeyboardMarkup]]:
+    """
+    Формирует страницу результатов поиска по истории пользователя.
+
+    Returns:
+        Текст страницы и клавиатура листания (None, если страница единственная).
+    """
+    results, has_more = await storage.search_messages(user_id, query, limit=SEARCH_PAGE_SIZE, offset=offset)
+    if not results:
+        key = 'search_no_results' if offset == 0 else 'search_no_more_results'
+        return loc.get_text(key, lang_code).format(query=th.escape_markdown(query)), None
+
+    lines = [loc.get_text('search_results_title', lang_code).format(query=th.escape_markdown(query)), ""]
+    for number, item in enumerate(results, start=offset + 1):
+        role_key = 'history_role_user' if item['role'] == 'user' else 'history_role_bot'
+        role_icon = "👤" if item['role'] == 'user' else "🤖"
+        date_str = ""
+        if item['ts'] is not None:
+            date_str = datetime.datetime.fromtimestamp(item['ts'], datetime.timezone.utc).strftime('%d.%m.%Y')
+        header = f"*{number}.* {role_icon} *{loc.get_text(role_key, lang_code)}* · " \
+                 f"_{th.escape_markdown(item['dialog_name'])}_ · {date_str}"
+        lines.append(f"{header}\n{_format_snippet(item['snippet'])}\n")
+    markup = mk.create_search_pagination_keyboard(offset, SEARCH_PAGE_SIZE, has_more)
+    return "\n".join(lines), markup
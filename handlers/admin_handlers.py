@@ -8,6 +8,7 @@ import asyncio
 import csv
 import io
 from datetime import datetime
+from typing import Any, Dict, Optional
 from telebot.async_telebot import AsyncTeleBot
 from telebot import types
 from telebot.apihelper import ApiException
@@ -22,12 +23,14 @@ from config.settings import (
     CALLBACK_ADMIN_STATS_MENU, CALLBACK_ADMIN_USER_MANAGEMENT_MENU,
     STATE_ADMIN_WAITING_FOR_USER_ID_TO_MANAGE,
     CALLBACK_ADMIN_TOGGLE_BLOCK_PREFIX, CALLBACK_ADMIN_RESET_API_KEY_PREFIX,
-    CALLBACK_ADMIN_EXPORT_USERS
+    CALLBACK_ADMIN_EXPORT_USERS, CALLBACK_ADMIN_DATABASE_MENU, CALLBACK_ADMIN_BACKUP_NOW,
+    CALLBACK_ADMIN_QUERY_STATS
 )
 from utils import markup_helpers as mk
 from utils import localization as loc
 from . import telegram_helpers as tg_helpers
-from database import db_manager
+from database import db_manager, storage
+from services import http_session
 from logger_config import get_logger
 from .decorators import admin_required
 
@@ -46,7 +49,7 @@ async def handle_admin_command(message: types.Message, bot: AsyncTeleBot):
         bot: Экземпляр AsyncTeleBot.
     """
     user_id = message.from_user.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
 
     admin_keyboard = await mk.create_admin_main_menu_keyboard(lang_code)
     await bot.send_message(
@@ -65,7 +68,7 @@ async def handle_reply_command(message: types.Message, bot: AsyncTeleBot):
         bot: Экземпляр AsyncTeleBot.
     """
     admin_id = message.from_user.id
-    lang_code = await db_manager.get_user_language(admin_id)
+    lang_code = await storage.get_user_language(admin_id)
     parts = message.text.split(maxsplit=2)
     if len(parts) < 3:
         await bot.reply_to(message, "Использование: `/reply <user_id> <текст сообщения>`")
@@ -75,11 +78,11 @@ async def handle_reply_command(message: types.Message, bot: AsyncTeleBot):
         await bot.reply_to(message, f"Ошибка: User ID '{target_user_id_str}' должен быть числом.")
         return
     target_user_id = int(target_user_id_str)
-    if not await db_manager.get_user_info_for_admin(target_user_id):
+    if not await storage.get_user_info_for_admin(target_user_id):
         await bot.reply_to(message, loc.get_text('admin.user_not_found', lang_code).format(user_id=target_user_id))
         return
     
-    target_lang_code = await db_manager.get_user_language(target_user_id)
+    target_lang_code = await storage.get_user_language(target_user_id)
     notification_text = loc.get_text('admin.reply_admin_notification', target_lang_code).format(text=text_to_send)
     try:
         await bot.send_message(target_user_id, telegramify_markdown.markdownify(notification_text), parse_mode='MarkdownV2')
@@ -104,7 +107,7 @@ async def handle_admin_main_menu(call: types.CallbackQuery, bot: AsyncTeleBot):
         bot: Экземпляр AsyncTeleBot.
     """
     user_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     admin_keyboard = await mk.create_admin_main_menu_keyboard(lang_code)
     await tg_helpers.edit_message_text_safe(
         bot,
@@ -127,7 +130,7 @@ async def handle_maintenance_menu(call: types.CallbackQuery, bot: AsyncTeleBot):
         bot: Экземпляр AsyncTeleBot.
     """
     user_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     maintenance_keyboard = await mk.create_maintenance_menu_keyboard(lang_code)
     await tg_helpers.edit_message_text_safe(
         bot,
@@ -149,13 +152,13 @@ async def handle_toggle_maintenance(call: types.CallbackQuery, bot: AsyncTeleBot
     """
     action = call.data.split(':')[1]
     user_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     if action == 'on':
-        await db_manager.set_app_setting('maintenance_mode', 'true')
+        await storage.set_app_setting('maintenance_mode', 'true')
         answer_text = loc.get_text('admin.maintenance_enabled_msg', lang_code)
         logger.warning("Активирован режим технического обслуживания.", extra={'user_id': str(user_id)})
     else:
-        await db_manager.set_app_setting('maintenance_mode', 'false')
+        await storage.set_app_setting('maintenance_mode', 'false')
         answer_text = loc.get_text('admin.maintenance_disabled_msg', lang_code)
         logger.info("Режим технического обслуживания отключен.", extra={'user_id': str(user_id)})
     maintenance_keyboard = await mk.create_maintenance_menu_keyboard(lang_code)
@@ -178,7 +181,7 @@ async def handle_communication_menu(call: types.CallbackQuery, bot: AsyncTeleBot
         bot: Экземпляр AsyncTeleBot.
     """
     user_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     comm_keyboard = await mk.create_communication_menu_keyboard(lang_code)
     await tg_helpers.edit_message_text_safe(
         bot,
@@ -199,7 +202,7 @@ async def handle_broadcast_start(call: types.CallbackQuery, bot: AsyncTeleBot):
         bot: Экземпляр AsyncTeleBot.
     """
     user_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     await bot.set_state(user_id, STATE_ADMIN_WAITING_FOR_BROADCAST_MSG, user_id)
     await tg_helpers.edit_message_text_safe(
         bot,
@@ -220,7 +223,7 @@ async def handle_broadcast_cancel(call: types.CallbackQuery, bot: AsyncTeleBot):
         bot: Экземпляр AsyncTeleBot.
     """
     user_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     await bot.delete_state(user_id, user_id)
     await tg_helpers.edit_message_text_safe(
         bot,
@@ -241,11 +244,10 @@ async def _run_broadcast(bot: AsyncTeleBot, admin_id: int, message_text: str, la
         message_text: Текст для рассылки.
         lang_code: Языковой код администратора.
     """
-    all_user_ids = await db_manager.get_all_user_ids()
     sent_count = 0
     failed_count = 0
     formatted_message = telegramify_markdown.markdownify(message_text)
-    for user_id in all_user_ids:
+    async for user_id in storage.iterate_user_ids():
         try:
             await bot.send_message(user_id, formatted_message, parse_mode='MarkdownV2', disable_web_page_preview=True)
             sent_count += 1
@@ -266,7 +268,7 @@ async def handle_broadcast_confirm(call: types.CallbackQuery, bot: AsyncTeleBot)
         bot: Экземпляр AsyncTeleBot.
     """
     admin_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(admin_id)
+    lang_code = await storage.get_user_language(admin_id)
     async with bot.retrieve_data(admin_id, admin_id) as data:
         message_text = data.get('broadcast_message')
     if not message_text:
@@ -294,18 +296,28 @@ async def handle_stats_menu(call: types.CallbackQuery, bot: AsyncTeleBot):
         bot: Экземпляр AsyncTeleBot.
     """
     user_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
 
-    total_users = await db_manager.get_total_users_count()
-    active_users = await db_manager.get_active_users_count(days=7)
-    new_users = await db_manager.get_new_users_count(days=7)
-    blocked_users = await db_manager.get_blocked_users_count()
+    total_users = await storage.get_total_users_count()
+    active_users = await storage.get_active_users_count(days=7)
+    new_users = await storage.get_new_users_count(days=7)
+    blocked_users = await storage.get_blocked_users_count()
+
+    http = http_session.get_stats()
 
     stats_text = (f"{loc.get_text('admin.stats_title', lang_code)}\n\n"
                   f"{loc.get_text('admin.stats_total_users', lang_code)} `{total_users}`\n"
                   f"{loc.get_text('admin.stats_active_users', lang_code)} `{active_users}`\n"
                   f"{loc.get_text('admin.stats_new_users', lang_code)} `{new_users}`\n"
-                  f"{loc.get_text('admin.stats_blocked_users', lang_code)} `{blocked_users}`")
+                  f"{loc.get_text('admin.stats_blocked_users', lang_code)} `{blocked_users}`\n\n"
+                  f"{loc.get_text('admin.stats_http_header', lang_code)}\n"
+                  f"{loc.get_text('admin.stats_http_requests', lang_code)} `{http['requests']} / {http['in_flight']}`\n"
+                  f"{loc.get_text('admin.stats_http_connections', lang_code)} "
+                  f"`{http['connections_created']} / {http['connections_reused']} / {http['reuse_rate']}`\n"
+                  f"{loc.get_text('admin.stats_http_connect', lang_code)} `{http['connect_avg_ms']}`\n"
+                  f"{loc.get_text('admin.stats_http_queued', lang_code)} "
+                  f"`{http['queued']} / {http['queued_avg_ms']} ({http['limit_per_host']})`\n"
+                  f"{loc.get_text('admin.stats_http_dns', lang_code)} `{http['dns_cache_hits']} / {http['dns_cache_misses']}`")
 
     back_keyboard = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton(
         loc.get_text('admin.btn_back_to_admin_menu', lang_code),
@@ -322,6 +334,230 @@ async def handle_stats_menu(call: types.CallbackQuery, bot: AsyncTeleBot):
     )
     await bot.answer_callback_query(call.id)
 
+# --- Блок базы данных ---
+
+def _format_bytes(size: int) -> str:
+    """Размер в байтах в удобочитаемом виде (B, KB, MB, GB)."""
+    if size < 1024:
+        return f"{size} B"
+    for unit in ('KB', 'MB', 'GB'):
+        size /= 1024
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}"
+
+
+def _build_database_report(lang_code: str, backup_status: Optional[Dict[str, Any]]) -> str:
+    """
+    Формирует текст раздела 'База данных' с метриками хранилища.
+
+    Args:
+        lang_code: Языковой код администратора.
+        backup_status: Итог последнего резервного копирования (см. db_manager.get_last_backup_status).
+    """
+    lines = [loc.get_text('admin.db_title', lang_code), "", loc.get_text('admin.db_pool_header', lang_code)]
+    pool = db_manager.get_pool_stats()
+    if not pool:
+        lines.append(loc.get_text('admin.db_pool_not_started', lang_code))
+    else:
+        lines += [
+            f"{loc.get_text('admin.db_pool_size', lang_code)} `{pool['readers']} / {pool['writers']}`",
+            f"{loc.get_text('admin.db_pool_checkouts', lang_code)} `{pool['reader_checkouts']} / {pool['writer_checkouts']}`",
+            f"{loc.get_text('admin.db_pool_wait_read', lang_code)} `{pool['reader_wait_avg_ms']} / {pool['reader_wait_max_ms']}`",
+            f"{loc.get_text('admin.db_pool_wait_write', lang_code)} `{pool['writer_wait_avg_ms']} / {pool['writer_wait_max_ms']}`",
+            f"{loc.get_text('admin.db_pool_queued', lang_code)} `{pool['reader_queued']} / {pool['writer_queued']}`",
+            f"{loc.get_text('admin.db_pool_write_batches', lang_code)} "
+            f"`{pool['write_batches']} / {pool['write_batch_avg']} / {pool['write_commit_avg_ms']}`",
+        ]
+    cache = db_manager.get_user_cache_stats()
+    lines += [
+        "",
+        loc.get_text('admin.db_cache_header', lang_code),
+        f"{loc.get_text('admin.db_cache_size', lang_code)} `{cache['size']} / {cache['maxsize']}`",
+        f"{loc.get_text('admin.db_cache_hits', lang_code)} `{cache['hits']} / {cache['misses']}`",
+        f"{loc.get_text('admin.db_cache_hit_rate', lang_code)} `{cache['hit_rate']}`",
+        "",
+        loc.get_text('admin.db_archive_header', lang_code),
+    ]
+    archive = db_manager.get_archive_stats()
+    if not archive['runs']:
+        lines.append(loc.get_text('admin.db_archive_no_runs', lang_code))
+    else:
+        last_run = archive['last_run_at'].strftime('%Y-%m-%d %H:%M UTC')
+        lines += [
+            f"{loc.get_text('admin.db_archive_moved', lang_code)} `{archive['moved_total']} / {archive['last_moved']}`",
+            f"{loc.get_text('admin.db_archive_last_run', lang_code)} `{last_run}`",
+        ]
+    retention = db_manager.get_retention_stats()
+    lines += ["", loc.get_text('admin.db_retention_header', lang_code)]
+    if not retention['runs']:
+        lines.append(loc.get_text('admin.db_retention_no_runs', lang_code))
+    else:
+        last_run = retention['last_run_at'].strftime('%Y-%m-%d %H:%M UTC')
+        lines += [
+            f"{loc.get_text('admin.db_retention_removed', lang_code)} "
+            f"`{retention['removed_total']} / {retention['last_removed']}`",
+            f"{loc.get_text('admin.db_retention_reclaimed', lang_code)} "
+            f"`{_format_bytes(retention['reclaimed_total'])} / {_format_bytes(retention['last_reclaimed'])}`",
+            f"{loc.get_text('admin.db_archive_last_run', lang_code)} `{last_run}`",
+        ]
+    reaper = db_manager.get_reaper_stats()
+    lines += [
+        "",
+        loc.get_text('admin.db_reaper_header', lang_code),
+        f"{loc.get_text('admin.db_reaper_pending', lang_code)} "
+        f"`{reaper['pending_dialogs']} / {reaper['pending_messages']}`",
+        f"{loc.get_text('admin.db_reaper_removed', lang_code)} "
+        f"`{reaper['dialogs_total']} / {reaper['removed_total']}`",
+    ]
+    checkpoints = db_manager.get_checkpoint_stats()
+    lines += ["", loc.get_text('admin.db_checkpoint_header', lang_code)]
+    if not checkpoints['last_run_at']:
+        lines.append(loc.get_text('admin.db_checkpoint_no_runs', lang_code))
+    else:
+        last_run = checkpoints['last_run_at'].strftime('%Y-%m-%d %H:%M UTC')
+        lines += [
+            f"{loc.get_text('admin.db_checkpoint_counts', lang_code)} "
+            f"`{checkpoints['passive']} / {checkpoints['truncate']} / {checkpoints['busy']}`",
+            f"{loc.get_text('admin.db_checkpoint_last', lang_code)} "
+            f"`{checkpoints['last_mode']}, {last_run}, {checkpoints['last_wal_pages']}`",
+            f"{loc.get_text('admin.db_checkpoint_optimize', lang_code)} `{checkpoints['optimize_runs']}`",
+        ]
+    lines += ["", loc.get_text('admin.db_backup_header', lang_code)]
+    if not backup_status:
+        lines.append(loc.get_text('admin.db_backup_none', lang_code))
+    else:
+        created_at = datetime.fromisoformat(backup_status['at']).strftime('%Y-%m-%d %H:%M UTC')
+        result_key = 'admin.db_backup_ok' if backup_status['ok'] else 'admin.db_backup_failed'
+        lines += [
+            f"{loc.get_text('admin.db_backup_last', lang_code)} `{created_at}` {loc.get_text(result_key, lang_code)}",
+        ]
+        if backup_status['ok']:
+            lines.append(f"{loc.get_text('admin.db_backup_size', lang_code)} "
+                         f"`{_format_bytes(backup_status['size'])} / {backup_status['duration_s']} s`")
+        else:
+            lines.append(f"{loc.get_text('admin.db_backup_error', lang_code)} `{backup_status['error']}`")
+    return "\n".join(lines)
+
+async def _require_sqlite(call: types.CallbackQuery, bot: AsyncTeleBot, lang_code: str) -> bool:
+    """
+    Проверяет, что бот работает на SQLite: разделы 'База данных' описывают его пулы, архив и резервные копии.
+    Иначе (кнопка осталась в старом сообщении) отвечает уведомлением и возвращает False.
+    """
+    if storage.is_sqlite():
+        return True
+    await bot.answer_callback_query(call.id, loc.get_text('admin.db_unavailable', lang_code), show_alert=True)
+    return False
+
+@admin_required
+async def handle_database_menu(call: types.CallbackQuery, bot: AsyncTeleBot):
+    """
+    Показывает раздел 'База данных' с метриками пула соединений и кэша профилей.
+
+    Args:
+        call: Объект CallbackQuery Telegram.
+        bot: Экземпляр AsyncTeleBot.
+    """
+    user_id = call.from_user.id
+    lang_code = await storage.get_user_language(user_id)
+    if not await _require_sqlite(call, bot, lang_code):
+        return
+    await tg_helpers.edit_message_text_safe(
+        bot,
+        chat_id=user_id,
+        message_id=call.message.message_id,
+        text=_build_database_report(lang_code, await db_manager.get_last_backup_status()),
+        reply_markup=mk.create_database_menu_keyboard(lang_code),
+        parse_mode="MarkdownV2"
+    )
+    await bot.answer_callback_query(call.id)
+
+@admin_required
+async def handle_backup_now(call: types.CallbackQuery, bot: AsyncTeleBot):
+    """
+    Создает резервную копию базы по кнопке из раздела 'База данных' и показывает раздел с ее итогом.
+
+    Args:
+        call: Объект CallbackQuery Telegram.
+        bot: Экземпляр AsyncTeleBot.
+    """
+    user_id = call.from_user.id
+    lang_code = await storage.get_user_language(user_id)
+    if not await _require_sqlite(call, bot, lang_code):
+        return
+    if db_manager.is_backup_running():
+        await bot.answer_callback_query(call.id, loc.get_text('admin.db_backup_in_progress', lang_code), show_alert=True)
+        return
+    await bot.answer_callback_query(call.id)
+    await tg_helpers.edit_message_text_safe(
+        bot,
+        chat_id=user_id,
+        message_id=call.message.message_id,
+        text=loc.get_text('admin.db_backup_started', lang_code)
+    )
+    await db_manager.create_backup()
+    await tg_helpers.edit_message_text_safe(
+        bot,
+        chat_id=user_id,
+        message_id=call.message.message_id,
+        text=_build_database_report(lang_code, await db_manager.get_last_backup_status()),
+        reply_markup=mk.create_database_menu_keyboard(lang_code),
+        parse_mode="MarkdownV2"
+    )
+
+def _build_query_stats_report(lang_code: str) -> str:
+    """
+    Формирует текст экрана времени SQL-запросов: сводка и запросы с наибольшим суммарным временем.
+
+    Args:
+        lang_code: Языковой код администратора.
+    """
+    stats = db_manager.get_query_stats()
+    summary = stats['summary']
+    lines = [loc.get_text('admin.db_queries_title', lang_code), ""]
+    if not summary['calls']:
+        lines.append(loc.get_text('admin.db_queries_empty', lang_code))
+        return "\n".join(lines)
+    lines += [
+        f"{loc.get_text('admin.db_queries_summary', lang_code)} "
+        f"`{summary['statements']} / {summary['calls']} / {summary['total_ms']}`",
+        f"{loc.get_text('admin.db_queries_slow', lang_code)} `{summary['slow']} ({stats['slow_ms']})`",
+        "",
+        loc.get_text('admin.db_queries_top', lang_code),
+    ]
+    for index, entry in enumerate(stats['top'], start=1):
+        # Обратные кавычки закрыли бы блок кода
+        sql = entry['sql'].replace('`', "'")
+        sql = sql if len(sql) <= 300 else sql[:300] + "…"
+        lines += [
+            f"{index}. {loc.get_text('admin.db_queries_entry', lang_code)} "
+            f"`{entry['calls']} / {entry['total_ms']} / {entry['avg_ms']} / {entry['p95_ms']} / {entry['max_ms']}`",
+            f"```sql\n{sql}\n```",
+        ]
+    return "\n".join(lines)
+
+@admin_required
+async def handle_query_stats(call: types.CallbackQuery, bot: AsyncTeleBot):
+    """
+    Показывает время SQL-запросов: какие запросы суммарно занимают больше всего времени.
+
+    Args:
+        call: Объект CallbackQuery Telegram.
+        bot: Экземпляр AsyncTeleBot.
+    """
+    user_id = call.from_user.id
+    lang_code = await storage.get_user_language(user_id)
+    if not await _require_sqlite(call, bot, lang_code):
+        return
+    await tg_helpers.edit_message_text_safe(
+        bot,
+        chat_id=user_id,
+        message_id=call.message.message_id,
+        text=_build_query_stats_report(lang_code),
+        reply_markup=mk.create_query_stats_keyboard(lang_code),
+        parse_mode="MarkdownV2"
+    )
+    await bot.answer_callback_query(call.id)
+
 # --- Блок управления пользователями ---
 
 @admin_required
@@ -334,7 +570,7 @@ async def handle_user_management_menu(call: types.CallbackQuery, bot: AsyncTeleB
         bot: Экземпляр AsyncTeleBot.
     """
     user_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     await bot.set_state(user_id, STATE_ADMIN_WAITING_FOR_USER_ID_TO_MANAGE, user_id)
     await tg_helpers.edit_message_text_safe(
         bot,
@@ -355,23 +591,23 @@ async def handle_toggle_block_user(call: types.CallbackQuery, bot: AsyncTeleBot)
         bot: Экземпляр AsyncTeleBot.
     """
     admin_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(admin_id)
+    lang_code = await storage.get_user_language(admin_id)
     user_id_to_toggle = int(call.data.split(':')[1])
 
-    user_info = await db_manager.get_user_info_for_admin(user_id_to_toggle)
+    user_info = await storage.get_user_info_for_admin(user_id_to_toggle)
     if not user_info:
         await bot.answer_callback_query(call.id, "Пользователь не найден.", show_alert=True)
         return
 
     if user_info['is_blocked']:
-        await db_manager.unblock_user(user_id_to_toggle)
+        await storage.unblock_user(user_id_to_toggle)
         alert_text = loc.get_text('admin.user_unblocked_success', lang_code).format(user_id=user_id_to_toggle)
     else:
-        await db_manager.block_user(user_id_to_toggle)
+        await storage.block_user(user_id_to_toggle)
         alert_text = loc.get_text('admin.user_blocked_success', lang_code).format(user_id=user_id_to_toggle)
 
     new_user_info_text = await tg_helpers.get_user_info_text(user_id_to_toggle, lang_code)
-    new_user_info = await db_manager.get_user_info_for_admin(user_id_to_toggle)
+    new_user_info = await storage.get_user_info_for_admin(user_id_to_toggle)
     new_keyboard = mk.create_user_management_keyboard(user_id_to_toggle, new_user_info['is_blocked'], lang_code)
 
     await tg_helpers.edit_message_text_safe(
@@ -394,10 +630,10 @@ async def handle_reset_api_key(call: types.CallbackQuery, bot: AsyncTeleBot):
         bot: Экземпляр AsyncTeleBot.
     """
     admin_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(admin_id)
+    lang_code = await storage.get_user_language(admin_id)
     user_id_to_reset = int(call.data.split(':')[1])
 
-    await db_manager.set_user_api_key(user_id_to_reset, None)
+    await storage.set_user_api_key(user_id_to_reset, None)
     alert_text = loc.get_text('admin.user_api_key_reset_success', lang_code).format(user_id=user_id_to_reset)
     await bot.answer_callback_query(call.id, alert_text, show_alert=True)
 
@@ -416,29 +652,33 @@ async def handle_export_users(call: types.CallbackQuery, bot: AsyncTeleBot):
     status_msg = await bot.send_message(admin_id, "⏳ Готовлю файл для выгрузки...")
 
     try:
-        users_data = await db_manager.get_all_users_for_export()
-        if not users_data:
-            await bot.edit_message_text("Нет пользователей для экспорта.", admin_id, status_msg.message_id)
-            return
-
-        output = io.StringIO()
+        # Пишем CSV построчно по мере чтения пользователей из БД, сразу в байтовый буфер
+        buffer = io.BytesIO()
+        output = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
         output.write('\ufeff')
         writer = csv.writer(output, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
         headers = ["user_id", "username", "first_name", "last_name", "language_code", "first_interaction_date", "is_blocked"]
         writer.writerow(headers)
 
-        for user in users_data:
+        exported = 0
+        async for user in storage.iterate_users_for_export():
             writer.writerow([
-                user.get("user_id"), user.get("username", ""), user.get("first_name", ""),
-                user.get("last_name", ""), user.get("language_code", ""),
-                user.get("first_interaction_date", ""), "Yes" if user.get("is_blocked") else "No"
+                user["user_id"], user["username"] or "", user["first_name"] or "",
+                user["last_name"] or "", user["language_code"] or "",
+                user["first_interaction_date"] or "", "Yes" if user["is_blocked"] else "No"
             ])
+            exported += 1
+        output.flush()
+        output.detach()
+
+        if not exported:
+            await bot.edit_message_text("Нет пользователей для экспорта.", admin_id, status_msg.message_id)
+            return
 
-        output.seek(0)
-        file_data = output.getvalue().encode('utf-8')
+        buffer.seek(0)
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M")
         file_name = f"users_export_{timestamp}.csv"
-        input_file = types.InputFile(io.BytesIO(file_data)) 
+        input_file = types.InputFile(buffer)
 
         await bot.send_document(
             admin_id,
@@ -459,7 +699,7 @@ async def handle_reply_to_user_start(call: types.CallbackQuery, bot: AsyncTeleBo
     Запрашивает у админа User ID.
     """
     admin_id = call.from_user.id
-    lang_code = await db_manager.get_user_language(admin_id)
+    lang_code = await storage.get_user_language(admin_id)
 
     await bot.set_state(admin_id, STATE_ADMIN_WAITING_FOR_USER_ID_TO_REPLY, admin_id)
     
@@ -495,6 +735,9 @@ def register_admin_handlers(bot: AsyncTeleBot):
     bot.register_callback_query_handler(handle_stats_menu, func=lambda call: call.data == CALLBACK_ADMIN_STATS_MENU, pass_bot=True)
     bot.register_callback_query_handler(handle_user_management_menu, func=lambda call: call.data == CALLBACK_ADMIN_USER_MANAGEMENT_MENU, pass_bot=True)
     bot.register_callback_query_handler(handle_export_users, func=lambda call: call.data == CALLBACK_ADMIN_EXPORT_USERS, pass_bot=True)
+    bot.register_callback_query_handler(handle_database_menu, func=lambda call: call.data == CALLBACK_ADMIN_DATABASE_MENU, pass_bot=True)
+    bot.register_callback_query_handler(handle_backup_now, func=lambda call: call.data == CALLBACK_ADMIN_BACKUP_NOW, pass_bot=True)
+    bot.register_callback_query_handler(handle_query_stats, func=lambda call: call.data == CALLBACK_ADMIN_QUERY_STATS, pass_bot=True)
 
     # Действия
     bot.register_callback_query_handler(handle_toggle_maintenance, func=lambda call: call.data.startswith(CALLBACK_ADMIN_TOGGLE_MAINTENANCE), pass_bot=True)
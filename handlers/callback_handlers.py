@@ -14,11 +14,13 @@ from config.settings import (
     # Импорты для диалогов
     CALLBACK_DIALOGS_MENU, CALLBACK_DIALOG_SWITCH_PREFIX, CALLBACK_DIALOG_RENAME_PREFIX,
     CALLBACK_DIALOG_DELETE_PREFIX, CALLBACK_DIALOG_CREATE, CALLBACK_DIALOG_CONFIRM_DELETE_PREFIX,
-    STATE_WAITING_FOR_NEW_DIALOG_NAME, STATE_WAITING_FOR_RENAME_DIALOG
+    STATE_WAITING_FOR_NEW_DIALOG_NAME, STATE_WAITING_FOR_RENAME_DIALOG,
+    CALLBACK_SEARCH_PAGE_PREFIX
 )
-from database import db_manager
+from database import storage
 from services import gemini_service
 from services.gemini_service import GeminiAPIError
+from features import search
 from utils import markup_helpers as mk
 from utils import localization as loc
 from utils import text_helpers as th
@@ -43,8 +45,8 @@ async def handle_callback_query(call: types.CallbackQuery, bot: AsyncTeleBot):
         return
 
     # Обновляем данные пользователя при каждом колбэке
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
 
     # Маршрутизатор колбэков
     try:
@@ -90,6 +92,8 @@ async def handle_callback_query(call: types.CallbackQuery, bot: AsyncTeleBot):
             await handle_calendar_date_selection(bot, call, lang_code)
         elif data.startswith(CALLBACK_CALENDAR_MONTH_PREFIX):
             await handle_calendar_month_navigation(bot, call)
+        elif data.startswith(CALLBACK_SEARCH_PAGE_PREFIX):
+            await handle_search_page(bot, call, lang_code)
         else:
             if not data.startswith('admin_'):
                 await tg_helpers.answer_callback_query(bot, call, text="Unknown action", show_alert=True)
@@ -139,9 +143,9 @@ async def handle_create_dialog_start(bot: AsyncTeleBot, call: types.CallbackQuer
 async def handle_switch_dialog(bot: AsyncTeleBot, call: types.CallbackQuery, lang_code: str):
     """Переключает активный диалог."""
     dialog_id_to_switch = int(call.data[len(CALLBACK_DIALOG_SWITCH_PREFIX):])
-    await db_manager.set_active_dialog(call.from_user.id, dialog_id_to_switch)
+    await storage.set_active_dialog(call.from_user.id, dialog_id_to_switch)
 
-    dialogs = await db_manager.get_user_dialogs(call.from_user.id)
+    dialogs = await storage.get_user_dialogs(call.from_user.id)
     switched_dialog_name = next((d['name'] for d in dialogs if d['dialog_id'] == dialog_id_to_switch), '???')
 
     await handle_dialogs_menu(bot, call, lang_code) # Обновляем меню
@@ -150,7 +154,7 @@ async def handle_switch_dialog(bot: AsyncTeleBot, call: types.CallbackQuery, lan
 async def handle_rename_dialog_start(bot: AsyncTeleBot, call: types.CallbackQuery, lang_code: str):
     """Начинает процесс переименования диалога."""
     dialog_id_to_rename = int(call.data[len(CALLBACK_DIALOG_RENAME_PREFIX):])
-    dialogs = await db_manager.get_user_dialogs(call.from_user.id)
+    dialogs = await storage.get_user_dialogs(call.from_user.id)
     dialog_name = next((d['name'] for d in dialogs if d['dialog_id'] == dialog_id_to_rename), '???')
 
     await bot.set_state(call.from_user.id, STATE_WAITING_FOR_RENAME_DIALOG, call.message.chat.id)
@@ -167,8 +171,8 @@ async def handle_delete_dialog_start(bot: AsyncTeleBot, call: types.CallbackQuer
     user_id = call.from_user.id
     dialog_id_to_delete = int(call.data[len(CALLBACK_DIALOG_DELETE_PREFIX):])
     
-    dialogs = await db_manager.get_user_dialogs(user_id)
-    active_dialog_id = await db_manager.get_active_dialog_id(user_id)
+    dialogs = await storage.get_user_dialogs(user_id)
+    active_dialog_id = await storage.get_active_dialog_id(user_id)
 
     if dialog_id_to_delete == active_dialog_id:
         await tg_helpers.answer_callback_query(bot, call, text=loc.get_text('dialog_error_delete_active', lang_code), show_alert=True)
@@ -192,15 +196,15 @@ async def handle_delete_dialog_confirm(bot: AsyncTeleBot, call: types.CallbackQu
     user_id = call.from_user.id
     dialog_id_to_delete = int(call.data[len(CALLBACK_DIALOG_CONFIRM_DELETE_PREFIX):])
 
-    deleted_dialog_name = await db_manager.delete_dialog(user_id, dialog_id_to_delete)
+    deleted_dialog_name = await storage.delete_dialog(user_id, dialog_id_to_delete)
     if not deleted_dialog_name:
         await tg_helpers.answer_callback_query(bot, call, text="Ошибка при удалении диалога.", show_alert=True)
         return
 
-    remaining_dialogs = await db_manager.get_user_dialogs(user_id)
+    remaining_dialogs = await storage.get_user_dialogs(user_id)
     if not remaining_dialogs:
         new_dialog_name = "Основной диалог" if lang_code == 'ru' else "General Chat"
-        await db_manager.create_dialog(user_id, new_dialog_name, set_active=True)
+        await storage.create_dialog(user_id, new_dialog_name, set_active=True)
         await tg_helpers.answer_callback_query(bot, call, text=loc.get_text('dialog_deleted_last_success', lang_code).format(name=deleted_dialog_name))
     else:
          await tg_helpers.answer_callback_query(bot, call, text=loc.get_text('dialog_deleted_success', lang_code).format(name=deleted_dialog_name))
@@ -232,7 +236,7 @@ async def handle_set_api_key_from_settings(bot: AsyncTeleBot, call: types.Callba
 async def handle_language_setting(bot: AsyncTeleBot, call: types.CallbackQuery):
     user_id = call.from_user.id
     new_lang_code = call.data[len(CALLBACK_SETTINGS_LANG_PREFIX):]
-    await db_manager.set_user_language(user_id, new_lang_code)
+    await storage.set_user_language(user_id, new_lang_code)
     await handle_back_to_main_settings(bot, call, new_lang_code)
     await tg_helpers.answer_callback_query(bot, call, text=f"Language set to {'English' if new_lang_code == 'en' else 'Русский'}")
 
@@ -240,8 +244,8 @@ async def handle_style_setting(bot: AsyncTeleBot, call: types.CallbackQuery, lan
     user_id = call.from_user.id
     style_code = call.data[len(CALLBACK_SETTINGS_STYLE_PREFIX):]
     if style_code in BOT_STYLES:
-        await db_manager.set_user_bot_style(user_id, style_code)
-        active_dialog_id = await db_manager.get_active_dialog_id(user_id)
+        await storage.set_user_bot_style(user_id, style_code)
+        active_dialog_id = await storage.get_active_dialog_id(user_id)
         if active_dialog_id:
             gemini_service.reset_dialog_chat(active_dialog_id)
         await handle_back_to_main_settings(bot, call, lang_code)
@@ -262,8 +266,8 @@ async def handle_persona_selection(bot: AsyncTeleBot, call: types.CallbackQuery,
     user_id = call.from_user.id
     persona_id = call.data[len(CALLBACK_SETTINGS_PERSONA_PREFIX):]
     if persona_id in BOT_PERSONAS:
-        await db_manager.set_user_persona(user_id, persona_id)
-        active_dialog_id = await db_manager.get_active_dialog_id(user_id)
+        await storage.set_user_persona(user_id, persona_id)
+        active_dialog_id = await storage.get_active_dialog_id(user_id)
         if active_dialog_id:
             gemini_service.reset_dialog_chat(active_dialog_id)
 
@@ -277,7 +281,7 @@ async def handle_persona_selection(bot: AsyncTeleBot, call: types.CallbackQuery,
 
 async def handle_choose_model_menu(bot: AsyncTeleBot, call: types.CallbackQuery, lang_code: str):
     user_id = call.from_user.id
-    api_key = await db_manager.get_user_api_key(user_id)
+    api_key = await storage.get_user_api_key(user_id)
     if not api_key:
         await tg_helpers.answer_callback_query(bot, call, text=loc.get_text('api_key_needed_for_feature', lang_code), show_alert=True)
         return
@@ -293,7 +297,7 @@ async def handle_choose_model_menu(bot: AsyncTeleBot, call: types.CallbackQuery,
         )
         await handle_back_to_main_settings(bot, call, lang_code)
         return
-    current_model = await db_manager.get_user_gemini_model(user_id)
+    current_model = await storage.get_user_gemini_model(user_id)
     keyboard = mk.create_model_selection_keyboard(models, current_model, lang_code)
     await tg_helpers.edit_message_text_safe(
         bot, call.message.chat.id, call.message.message_id,
@@ -303,8 +307,8 @@ async def handle_choose_model_menu(bot: AsyncTeleBot, call: types.CallbackQuery,
 async def handle_model_selection(bot: AsyncTeleBot, call: types.CallbackQuery, lang_code: str):
     user_id = call.from_user.id
     model_name = call.data[len(CALLBACK_SETTINGS_MODEL_PREFIX):]
-    await db_manager.set_user_gemini_model(user_id, model_name)
-    active_dialog_id = await db_manager.get_active_dialog_id(user_id)
+    await storage.set_user_gemini_model(user_id, model_name)
+    active_dialog_id = await storage.get_active_dialog_id(user_id)
     if active_dialog_id:
         gemini_service.reset_dialog_chat(active_dialog_id)
     await handle_back_to_main_settings(bot, call, lang_code)
@@ -336,9 +340,9 @@ async def handle_calendar_date_selection(bot: AsyncTeleBot, call: types.Callback
         )
         try:
             selected_date = datetime.datetime.strptime(selected_date_str, '%Y-%m-%d').date()
-            active_dialog_id = await db_manager.get_active_dialog_id(user_id)
+            active_dialog_id = await storage.get_active_dialog_id(user_id)
             if active_dialog_id:
-                history = await db_manager.get_conversation_history_by_date(active_dialog_id, selected_date)
+                history = await storage.get_conversation_history_by_date(user_id, active_dialog_id, selected_date)
                 if history:
                     history_text = f"📜 {loc.get_text('history_for_date', lang_code)} {selected_date.strftime('%d.%m.%Y')}:\n\n"
                     for item in history:
@@ -365,6 +369,20 @@ async def handle_calendar_month_navigation(bot: AsyncTeleBot, call: types.Callba
     finally:
         await tg_helpers.answer_callback_query(bot, call)
 
+async def handle_search_page(bot: AsyncTeleBot, call: types.CallbackQuery, lang_code: str):
+    """Листает результаты последнего поиска пользователя."""
+    user_id = call.from_user.id
+    query = search.get_last_query(user_id)
+    if not query:
+        await tg_helpers.answer_callback_query(bot, call, text=loc.get_text('search_expired', lang_code), show_alert=True)
+        return
+    offset = max(0, int(call.data[len(CALLBACK_SEARCH_PAGE_PREFIX):]))
+    text, markup = await search.build_results_page(user_id, query, offset, lang_code)
+    await tg_helpers.edit_message_text_safe(
+        bot, call.message.chat.id, call.message.message_id, text, reply_markup=markup
+    )
+    await tg_helpers.answer_callback_query(bot, call)
+
 def register_callback_handlers(bot: AsyncTeleBot):
     """Регистрирует основной обработчик callback запросов."""
     bot.register_callback_query_handler(handle_callback_query, func=lambda call: True, pass_bot=True)
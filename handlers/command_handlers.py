@@ -17,9 +17,10 @@ from config.settings import (
     STATE_WAITING_FOR_NEW_DIALOG_NAME, 
     STATE_WAITING_FOR_RENAME_DIALOG
 )
-from database import db_manager
+from database import storage
 from services import gemini_service
 from features import personal_account
+from features import search
 from logger_config import get_logger
 
 logger = get_logger(__name__)
@@ -31,12 +32,12 @@ async def handle_start(message: types.Message, bot: AsyncTeleBot):
     user_id = user.id
     logger.info(f"Команда /start от user_id: {user_id}", extra={'user_id': str(user_id)})
 
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
 
     await bot.delete_state(user_id, message.chat.id)
     
-    active_dialog_id = await db_manager.get_active_dialog_id(user_id)
+    active_dialog_id = await storage.get_active_dialog_id(user_id)
     if active_dialog_id:
         gemini_service.reset_dialog_chat(active_dialog_id)
 
@@ -51,8 +52,8 @@ async def handle_help(message: types.Message, bot: AsyncTeleBot):
     """Обработчик команды /help."""
     user = message.from_user
     user_id = user.id
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
     
     help_text = loc.get_text('cmd_help_text', lang_code)
     await tg_helpers.send_long_message(
@@ -70,12 +71,12 @@ async def handle_reset(message: types.Message, bot: AsyncTeleBot):
     """Обработчик команды /reset."""
     user = message.from_user
     user_id = user.id
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
 
     await bot.delete_state(user_id, message.chat.id)
     
-    active_dialog_id = await db_manager.get_active_dialog_id(user_id)
+    active_dialog_id = await storage.get_active_dialog_id(user_id)
     if active_dialog_id:
         gemini_service.reset_dialog_chat(active_dialog_id)
 
@@ -88,8 +89,8 @@ async def handle_set_api_key(message: types.Message, bot: AsyncTeleBot):
     """Обработчик команды /set_api_key."""
     user = message.from_user
     user_id = user.id
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
 
     text = loc.get_text('set_api_key_prompt', lang_code)
     await bot.set_state(user_id, STATE_WAITING_FOR_API_KEY, message.chat.id)
@@ -100,8 +101,8 @@ async def handle_history(message: types.Message, bot: AsyncTeleBot):
     """Обработчик команды /history."""
     user = message.from_user
     user_id = user.id
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
 
     calendar_markup = mk.create_calendar_keyboard()
     text = loc.get_text('history_prompt', lang_code)
@@ -109,12 +110,30 @@ async def handle_history(message: types.Message, bot: AsyncTeleBot):
     await bot.set_state(user_id, STATE_WAITING_FOR_HISTORY_DATE, message.chat.id)
 
 
+async def handle_search(message: types.Message, bot: AsyncTeleBot):
+    """Обработчик команды /search <запрос>: полнотекстовый поиск по истории всех диалогов."""
+    user = message.from_user
+    user_id = user.id
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
+
+    parts = (message.text or "").split(maxsplit=1)
+    query = parts[1].strip() if len(parts) > 1 else ""
+    if not query:
+        await bot.reply_to(message, loc.get_text('search_usage', lang_code))
+        return
+
+    search.remember_query(user_id, query)
+    text, markup = await search.build_results_page(user_id, query, 0, lang_code)
+    await tg_helpers.send_long_message(bot, user_id, text, reply_markup=markup)
+
+
 async def handle_settings(message: types.Message, bot: AsyncTeleBot):
     """Обработчик команды /settings."""
     user = message.from_user
     user_id = user.id
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
     
     settings_markup = await mk.create_settings_keyboard(user_id)
     await bot.send_message(
@@ -127,8 +146,8 @@ async def handle_dialogs(message: types.Message, bot: AsyncTeleBot):
     """Обработчик команды /dialogs."""
     user = message.from_user
     user_id = user.id
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
 
     text = f"{loc.get_text('dialogs_menu_title', lang_code)}\n\n" \
            f"{loc.get_text('dialogs_menu_desc', lang_code)}"
@@ -144,8 +163,8 @@ async def handle_translate(message: types.Message, bot: AsyncTeleBot):
     """Обработчик команды /translate."""
     user = message.from_user
     user_id = user.id
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
 
     lang_markup = mk.create_language_selection_keyboard()
     text = loc.get_text('translate_prompt', lang_code)
@@ -156,12 +175,12 @@ async def handle_personal_account_button(message: types.Message, bot: AsyncTeleB
     """Обработчик нажатия на кнопку 'Личный кабинет'."""
     user = message.from_user
     user_id = user.id
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
     
     await tg_helpers.send_typing_action(bot, user_id)
     info_text = await personal_account.get_personal_account_info(user_id)
     
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     main_keyboard = mk.create_main_keyboard(lang_code, user_id)
     await tg_helpers.send_long_message(
         bot, user_id, info_text,
@@ -173,18 +192,18 @@ async def handle_usage(message: types.Message, bot: AsyncTeleBot):
     """Обработчик команды /usage для отображения статистики расходов."""
     user = message.from_user
     user_id = user.id
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
 
-    api_key_exists = await db_manager.get_user_api_key(user_id)
+    api_key_exists = await storage.get_user_api_key(user_id)
     if not api_key_exists:
         await bot.reply_to(message, loc.get_text('api_key_needed_for_feature', lang_code))
         return
 
-    usage_today = await db_manager.get_token_usage_by_period(user_id, 'today')
-    usage_month = await db_manager.get_token_usage_by_period(user_id, 'month')
+    usage_today = await storage.get_token_usage_by_period(user_id, 'today')
+    usage_month = await storage.get_token_usage_by_period(user_id, 'month')
 
-    user_model = await db_manager.get_user_gemini_model(user_id) or DEFAULT_MODEL_ID
+    user_model = await storage.get_user_gemini_model(user_id) or DEFAULT_MODEL_ID
     pricing = TOKEN_PRICING.get(user_model, TOKEN_PRICING['default'])
 
     def calculate_cost(usage_data):
@@ -226,8 +245,8 @@ async def handle_full_guide(message: types.Message, bot: AsyncTeleBot):
     """Обработчик команды /help_guide, отправляет полную справку."""
     user = message.from_user
     user_id = user.id
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
     
     await tg_helpers.send_typing_action(bot, user_id)
     
@@ -239,8 +258,8 @@ async def handle_api_key_info(message: types.Message, bot: AsyncTeleBot):
     """Обработчик команды /apikey_info, отправляет секцию про API ключ."""
     user = message.from_user
     user_id = user.id
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
-    lang_code = await db_manager.get_user_language(user_id)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    lang_code = await storage.get_user_language(user_id)
 
     await tg_helpers.send_typing_action(bot, user_id)
     
@@ -259,6 +278,7 @@ def register_command_handlers(bot: AsyncTeleBot):
     bot.register_message_handler(handle_set_api_key, commands=['set_api_key', 'setapikey'], pass_bot=True)
     bot.register_message_handler(handle_settings, commands=['settings'], pass_bot=True)
     bot.register_message_handler(handle_history, commands=['history'], pass_bot=True)
+    bot.register_message_handler(handle_search, commands=['search'], pass_bot=True)
     bot.register_message_handler(handle_translate, commands=['translate'], pass_bot=True)
     bot.register_message_handler(handle_usage, commands=['usage'], pass_bot=True)
     bot.register_message_handler(handle_dialogs, commands=['dialogs'], pass_bot=True)
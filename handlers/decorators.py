@@ -7,7 +7,7 @@ from telebot.async_telebot import AsyncTeleBot
 from telebot import types
 
 from config.settings import ADMIN_USER_ID
-from database import db_manager
+from database import storage
 from utils import localization as loc
 from logger_config import get_logger
 
@@ -22,7 +22,7 @@ def admin_required(func):
     async def wrapper(message_or_call: types.Message | types.CallbackQuery, *args, **kwargs):
         user_id = message_or_call.from_user.id
         if user_id != ADMIN_USER_ID:
-            lang_code = await db_manager.get_user_language(user_id)
+            lang_code = await storage.get_user_language(user_id)
             error_text = loc.get_text('admin.not_admin', lang_code)
             
             # Нам нужен экземпляр бота для ответа
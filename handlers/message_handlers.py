@@ -5,7 +5,7 @@
 """
 import PIL.Image
 from io import BytesIO
-from typing import List, Union
+from typing import Dict, List, Union
 from telebot.async_telebot import AsyncTeleBot
 from telebot import types
 import telegramify_markdown
@@ -19,9 +19,10 @@ from config.settings import (
     STATE_WAITING_FOR_NEW_DIALOG_NAME, STATE_WAITING_FOR_RENAME_DIALOG,
     STATE_WAITING_FOR_FEEDBACK, DEFAULT_MODEL_ID, BOT_PERSONAS, ADMIN_USER_ID,
     STATE_ADMIN_WAITING_FOR_BROADCAST_MSG, STATE_ADMIN_WAITING_FOR_USER_ID_TO_MANAGE,
-    STATE_ADMIN_WAITING_FOR_USER_ID_TO_REPLY, STATE_ADMIN_WAITING_FOR_REPLY_MESSAGE
+    STATE_ADMIN_WAITING_FOR_USER_ID_TO_REPLY, STATE_ADMIN_WAITING_FOR_REPLY_MESSAGE,
+    GEMINI_STREAMING
 )
-from database import db_manager
+from database import storage
 from services import gemini_service
 from services.gemini_service import GeminiAPIError
 from .decorators import admin_required
@@ -40,11 +41,11 @@ async def _check_access(bot: AsyncTeleBot, user_id: int, lang_code: str) -> bool
     """
     Проверяет, имеет ли пользователь доступ к боту (не заблокирован ли, не включен ли режим обслуживания).
     """
-    if await db_manager.is_user_blocked(user_id):
+    if await storage.is_user_blocked(user_id):
         await bot.send_message(user_id, loc.get_text('user_is_blocked', lang_code))
         return False
 
-    maintenance_mode_str = await db_manager.get_app_setting('maintenance_mode')
+    maintenance_mode_str = await storage.get_app_setting('maintenance_mode')
     if maintenance_mode_str == 'true' and user_id != ADMIN_USER_ID:
         await bot.send_message(user_id, loc.get_text('maintenance_mode_on', lang_code))
         return False
@@ -61,7 +62,7 @@ async def _create_context_header(user_id: int, lang_code: str) -> str:
         str: Отформатированная строка с текущим диалогом, персоной и моделью.
              Возвращает пустую строку, если не удалось получить информацию о контексте.
     """
-    context_info = await db_manager.get_user_context_info(user_id)
+    context_info = await storage.get_user_context_info(user_id)
     if not context_info:
         return ""
     dialog_name = context_info.get('dialog_name', '..._')
@@ -87,10 +88,9 @@ async def _create_context_header(user_id: int, lang_code: str) -> str:
 async def _handle_state_admin_broadcast(message: types.Message, bot: AsyncTeleBot):
     """Логика для состояния STATE_ADMIN_WAITING_FOR_BROADCAST_MSG."""
     user_id = message.from_user.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     await bot.add_data(user_id, user_id, broadcast_message=message.text)
-    all_users = await db_manager.get_all_user_ids()
-    count = len(all_users)
+    count = await storage.get_total_users_count()
     confirmation_text = loc.get_text('admin.broadcast_confirm_prompt', lang_code).format(
         count=count, message_text=message.text
     )
@@ -101,7 +101,7 @@ async def _handle_state_admin_broadcast(message: types.Message, bot: AsyncTeleBo
 async def _handle_state_admin_user_id_manage(message: types.Message, bot: AsyncTeleBot):
     """Логика для состояния STATE_ADMIN_WAITING_FOR_USER_ID_TO_MANAGE."""
     admin_id = message.from_user.id
-    lang_code = await db_manager.get_user_language(admin_id)
+    lang_code = await storage.get_user_language(admin_id)
 
     if not message.text.isdigit():
         await bot.reply_to(message, "Ошибка: User ID должен быть числом.")
@@ -112,7 +112,7 @@ async def _handle_state_admin_user_id_manage(message: types.Message, bot: AsyncT
 
     user_info_text = await tg_helpers.get_user_info_text(user_id_to_manage, lang_code)
 
-    user_info = await db_manager.get_user_info_for_admin(user_id_to_manage)
+    user_info = await storage.get_user_info_for_admin(user_id_to_manage)
     if user_info:
         keyboard = mk.create_user_management_keyboard(user_id_to_manage, user_info['is_blocked'], lang_code)
     else:
@@ -130,7 +130,7 @@ async def _handle_state_user_id_for_reply(message: types.Message, bot: AsyncTele
     Проверяет ID и запрашивает сообщение для отправки.
     """
     admin_id = message.from_user.id
-    lang_code = await db_manager.get_user_language(admin_id)
+    lang_code = await storage.get_user_language(admin_id)
 
     if not message.text.isdigit():
         await bot.reply_to(message, "Ошибка: User ID должен быть числом. Попробуйте еще раз или введите /cancel для отмены.")
@@ -139,7 +139,7 @@ async def _handle_state_user_id_for_reply(message: types.Message, bot: AsyncTele
     target_user_id = int(message.text)
     
     # Проверяем, существует ли такой пользователь в базе
-    user_info = await db_manager.get_user_info_for_admin(target_user_id)
+    user_info = await storage.get_user_info_for_admin(target_user_id)
     if not user_info:
         await bot.reply_to(message, loc.get_text('admin.user_not_found', lang_code).format(user_id=target_user_id))
         await bot.delete_state(admin_id, admin_id)
@@ -161,7 +161,7 @@ async def _handle_state_message_to_user(message: types.Message, bot: AsyncTeleBo
     Отправляет полученное сообщение целевому пользователю.
     """
     admin_id = message.from_user.id
-    lang_code = await db_manager.get_user_language(admin_id)
+    lang_code = await storage.get_user_language(admin_id)
     text_to_send = message.text
 
     async with bot.retrieve_data(admin_id, admin_id) as data:
@@ -174,7 +174,7 @@ async def _handle_state_message_to_user(message: types.Message, bot: AsyncTeleBo
         return
 
     # Получаем язык целевого пользователя для корректной локализации уведомления
-    target_lang_code = await db_manager.get_user_language(target_user_id)
+    target_lang_code = await storage.get_user_language(target_user_id)
     notification_text = loc.get_text('admin.reply_admin_notification', target_lang_code).format(text=text_to_send)
 
     try:
@@ -194,7 +194,7 @@ async def _handle_state_api_key(message: types.Message, bot: AsyncTeleBot):
     """Логика для состояния STATE_WAITING_FOR_API_KEY."""
     user_id = message.chat.id
     api_key = message.text.strip()
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     try:
         await bot.delete_message(message.chat.id, message.message_id)
     except Exception: pass
@@ -204,9 +204,9 @@ async def _handle_state_api_key(message: types.Message, bot: AsyncTeleBot):
         await bot.delete_message(user_id, status_msg.message_id)
     except Exception: pass
     if is_valid:
-        await db_manager.set_user_api_key(user_id, api_key)
+        await storage.set_user_api_key(user_id, api_key)
 
-        active_dialog_id = await db_manager.get_active_dialog_id(user_id)
+        active_dialog_id = await storage.get_active_dialog_id(user_id)
         if active_dialog_id:
             gemini_service.reset_dialog_chat(active_dialog_id)
 
@@ -221,8 +221,8 @@ async def _handle_state_translate(message: types.Message, bot: AsyncTeleBot):
     """Логика для состояния STATE_WAITING_FOR_TRANSLATE_TEXT."""
     user_id = message.chat.id
     text_to_translate = message.text
-    lang_code = await db_manager.get_user_language(user_id)
-    api_key = await db_manager.get_user_api_key(user_id)
+    lang_code = await storage.get_user_language(user_id)
+    api_key = await storage.get_user_api_key(user_id)
     async with bot.retrieve_data(user_id, message.chat.id) as data:
         target_lang_code = data.get('target_lang')
     if not api_key:
@@ -247,7 +247,7 @@ async def _handle_state_translate(message: types.Message, bot: AsyncTeleBot):
 async def _handle_state_new_dialog_name(message: types.Message, bot: AsyncTeleBot):
     """Логика для состояния STATE_WAITING_FOR_NEW_DIALOG_NAME."""
     user_id = message.chat.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     dialog_name = message.text.strip()
 
     if not dialog_name:
@@ -257,7 +257,7 @@ async def _handle_state_new_dialog_name(message: types.Message, bot: AsyncTeleBo
         await bot.reply_to(message, loc.get_text('dialog_name_too_long', lang_code))
         return
 
-    await db_manager.create_dialog(user_id, dialog_name, set_active=True)
+    await storage.create_dialog(user_id, dialog_name, set_active=True)
     await bot.delete_state(user_id, message.chat.id)
     await bot.send_message(user_id, loc.get_text('dialog_created_success', lang_code).format(name=dialog_name))
 
@@ -271,7 +271,7 @@ async def _handle_state_new_dialog_name(message: types.Message, bot: AsyncTeleBo
 async def _handle_state_rename_dialog(message: types.Message, bot: AsyncTeleBot):
     """Логика для состояния STATE_WAITING_FOR_RENAME_DIALOG."""
     user_id = message.chat.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     new_name = message.text.strip()
 
     if not new_name:
@@ -285,7 +285,7 @@ async def _handle_state_rename_dialog(message: types.Message, bot: AsyncTeleBot)
         dialog_id_to_rename = data.get('dialog_id_to_rename')
 
     if dialog_id_to_rename:
-        await db_manager.rename_dialog(dialog_id_to_rename, new_name)
+        await storage.rename_dialog(user_id, dialog_id_to_rename, new_name)
         await bot.delete_state(user_id, message.chat.id)
         await bot.send_message(user_id, loc.get_text('dialog_renamed_success', lang_code).format(new_name=new_name))
 
@@ -301,7 +301,7 @@ async def _handle_state_rename_dialog(message: types.Message, bot: AsyncTeleBot)
 async def _handle_state_feedback(message: types.Message, bot: AsyncTeleBot):
     """Логика для состояния STATE_WAITING_FOR_FEEDBACK."""
     user_id = message.chat.id
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
 
     await bot.delete_state(user_id, message.chat.id)
     await bot.send_message(user_id, loc.get_text('feedback_sent', lang_code))
@@ -326,15 +326,54 @@ async def _handle_state_feedback(message: types.Message, bot: AsyncTeleBot):
 # --- ОБЩИЙ ОБРАБОТЧИК ДЛЯ СООБЩЕНИЙ БЕЗ СОСТОЯНИЯ ---
 # ===================================================================================
 
+def _format_sources(sources: List[Dict[str, str]]) -> str:
+    """Формирует блок источников (grounding) для конца ответа; пустая строка, если источников нет."""
+    if not sources:
+        return ""
+    sources_text = "\n\n---\n*Источники:*\n"
+    for i, source in enumerate(sources, 1):
+        title = source['title']
+        url = source['uri']
+        sources_text += f"{i}. [{title}]({url})\n"
+    return sources_text
+
+async def _gemini_error_text(user_id: int, lang_code: str, error: GeminiAPIError) -> str:
+    """Понятное пользователю описание ошибки Gemini API (с названием его модели)."""
+    user_model = await storage.get_user_gemini_model(user_id) or DEFAULT_MODEL_ID
+    return loc.get_text(error.error_key, lang_code).format(model_name=user_model)
+
+async def _reply_streaming(bot: AsyncTeleBot, user_id: int, lang_code: str, prompt: Union[str, List[Union[str, PIL.Image.Image]]]):
+    """
+    Отвечает потоково: после заголовка с контекстом сразу отправляет заглушку и заполняет ее
+    текстом по мере генерации (см. tg_helpers.StreamingReply). При ошибке API (в том числе блокировке
+    фильтрами безопасности или обрыве потока) недописанный ответ заменяется сообщением об ошибке;
+    прочие исключения удаляют его и пробрасываются вызывающему.
+    """
+    header = await _create_context_header(user_id, lang_code)
+    if header:
+        await bot.send_message(user_id, telegramify_markdown.markdownify(header), parse_mode='MarkdownV2')
+
+    reply = tg_helpers.StreamingReply(bot, user_id, loc.get_text('stream_placeholder', lang_code))
+    await reply.start()
+    try:
+        response_text, sources = await gemini_service.generate_response_stream(user_id, prompt, reply.update)
+    except GeminiAPIError as e:
+        await reply.fail(await _gemini_error_text(user_id, lang_code, e), reply_markup=mk.create_error_report_button())
+        return
+    except Exception:
+        await reply.abort()
+        raise
+    await reply.finish(response_text + _format_sources(sources), disable_web_page_preview=True)
+
 async def _handle_no_state_message(message: types.Message, bot: AsyncTeleBot):
     """Обрабатывает текстовые сообщения и фото, когда пользователь не находится ни в каком состоянии."""
     user_id = message.from_user.id
     content_type = message.content_type
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     
     try:
         # --- Общая логика для текста и фото ---
-        api_key_exists = await db_manager.get_user_api_key(user_id)
+        api_key_exists = await storage.get_user_api_key(user_id)
         if not api_key_exists:
             error_text_key = 'api_key_needed_for_chat' if content_type == 'text' else 'api_key_needed_for_vision'
             await bot.reply_to(message, loc.get_text(error_text_key, lang_code))
@@ -360,6 +399,10 @@ async def _handle_no_state_message(message: types.Message, bot: AsyncTeleBot):
             await bot.reply_to(message, loc.get_text('unsupported_content', lang_code))
             return
             
+        if GEMINI_STREAMING:
+            await _reply_streaming(bot, user_id, lang_code, prompt)
+            return
+
         response_text, sources = await gemini_service.generate_response(user_id, prompt)
         
         # --- ОТПРАВКА ОТВЕТА ---
@@ -369,21 +412,13 @@ async def _handle_no_state_message(message: types.Message, bot: AsyncTeleBot):
             await bot.send_message(user_id, telegramify_markdown.markdownify(header), parse_mode='MarkdownV2')
 
         # 2. Формируем основной текст ответа
-        final_message_body = response_text
-        if sources:
-            sources_text = "\n\n---\n*Источники:*\n"
-            for i, source in enumerate(sources, 1):
-                title = source['title']
-                url = source['uri']
-                sources_text += f"{i}. [{title}]({url})\n"
-            final_message_body += sources_text
+        final_message_body = response_text + _format_sources(sources)
 
         # 3. Отправляем основной текст через функцию для длинных сообщений
         await tg_helpers.send_long_message(bot, user_id, final_message_body, disable_web_page_preview=True)
 
     except GeminiAPIError as e:
-        user_model = await db_manager.get_user_gemini_model(user_id) or DEFAULT_MODEL_ID
-        user_friendly_error = loc.get_text(e.error_key, lang_code).format(model_name=user_model)
+        user_friendly_error = await _gemini_error_text(user_id, lang_code, e)
         error_markup = mk.create_error_report_button()
         await tg_helpers.send_long_message(bot, user_id, user_friendly_error, reply_markup=error_markup)
         
@@ -403,9 +438,9 @@ async def universal_message_router(message: types.Message, bot: AsyncTeleBot):
     user_id = user.id
 
     user_logger.info(f"Получено сообщение ({message.content_type}) от user ID: {user_id}", extra={'user_id': str(user_id)})
-    await db_manager.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+    await storage.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
     
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     if not await _check_access(bot, user_id, lang_code):
         return
 
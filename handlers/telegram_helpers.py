@@ -6,7 +6,8 @@
 """
 import asyncio
 import re
-from typing import Optional
+import time
+from typing import List, Optional, Tuple
 
 from telebot.async_telebot import AsyncTeleBot
 from telebot import types
@@ -15,12 +16,12 @@ from telebot import apihelper
 from langchain.text_splitter import MarkdownTextSplitter
 import telegramify_markdown
 
-from config.settings import ADMIN_USER_ID
+from config.settings import ADMIN_USER_ID, STREAM_EDIT_INTERVAL_SECONDS, STREAM_MESSAGE_LIMIT
 from logger_config import get_logger
 from utils import text_helpers as th
 from utils import markup_helpers as mk
 from utils import localization as loc
-from database import db_manager
+from database import storage
 
 logger = get_logger(__name__)
 
@@ -281,7 +282,7 @@ async def get_user_info_text(user_id_to_check: int, lang_code: str) -> str:
     Returns:
         Отформатированная строка с информацией о пользователе или сообщение об ошибке.
     """
-    user_info = await db_manager.get_user_info_for_admin(user_id_to_check)
+    user_info = await storage.get_user_info_for_admin(user_id_to_check)
     if not user_info:
         return loc.get_text('admin.user_not_found', lang_code).format(user_id=user_id_to_check)
 
@@ -330,4 +331,185 @@ async def notify_admin_of_new_user(user_id: int, username: Optional[str], first_
         logger.info(f"Администратор уведомлен о новом пользователе {user_id}", extra={'user_id': 'System'})
 
     except Exception as e:
-        logger.error(f"Не удалось отправить уведомление администратору о новом пользователе {user_id}: {e}", extra={'user_id': 'System'})
\ No newline at end of file
+        logger.error(f"Не удалось отправить уведомление администратору о новом пользователе {user_id}: {e}", extra={'user_id': 'System'})
+
+# --- Потоковый ответ ---
+
+# Строка, открывающая или закрывающая блок кода (```python, ```)
+_FENCE_LINE = re.compile(r'^```(\w*).*$', re.MULTILINE)
+
+
+def _code_spans(text: str) -> List[Tuple[int, int, str]]:
+    """Блоки кода текста: (начало, конец, язык); незакрытый блок (ответ еще пишется) тянется до конца текста."""
+    spans, opening = [], None
+    for fence in _FENCE_LINE.finditer(text):
+        if opening is None:
+            opening = fence
+        else:
+            spans.append((opening.start(), fence.end(), opening.group(1)))
+            opening = None
+    if opening is not None:
+        spans.append((opening.start(), len(text), opening.group(1)))
+    return spans
+
+
+def _stream_split(text: str, chunk_size: int) -> Tuple[int, str]:
+    """
+    Где разорвать текст, чтобы первая часть не превышала `chunk_size`: место выбирает MarkdownTextSplitter,
+    а блоки кода, как в send_long_message, не разрываются — блок переносится в следующее сообщение целиком.
+    Только блок длиннее сообщения делится по строке и открывается заново в продолжении.
+
+    Returns:
+        (позиция разрыва, строка, открывающая блок кода в продолжении, или "").
+    """
+    first = MarkdownTextSplitter(chunk_size=chunk_size, chunk_overlap=0).split_text(text)[0]
+    cut = text.find(first) + len(first)
+    for start, end, lang in _code_spans(text):
+        if not start < cut < end:
+            continue
+        if end <= chunk_size:
+            return end, ""
+        if text[:start].strip():
+            return start, ""
+        line_end = text.rfind('\n', start, cut)
+        return (line_end + 1 if line_end > start else cut), f"```{lang}\n"
+    return cut, ""
+
+
+class StreamingReply:
+    """
+    Ответ, который показывается по мере генерации.
+
+    `start` отправляет сообщение-заглушку, `update` редактирует его накопленным текстом не чаще раза
+    в `STREAM_EDIT_INTERVAL_SECONDS` (промежуточные правки — простым текстом: незакрытая разметка
+    недописанного ответа не ломает редактирование). Когда текст текущего сообщения превышает
+    `STREAM_MESSAGE_LIMIT` (с учетом экранирования MarkdownV2), готовая часть оформляется через
+    telegramify_markdown, а продолжение уходит в новое сообщение; место разрыва выбирается как в
+    send_long_message, не посередине блока кода. `finish` оформляет последнее сообщение итоговым текстом.
+    """
+
+    def __init__(self, bot: AsyncTeleBot, chat_id: int, placeholder: str):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.placeholder = placeholder
+        self._message_id: Optional[int] = None
+        self._done_ids: List[int] = []   # уже заполненные сообщения ответа (до текущего)
+        self._offset = 0      # начало текста текущего сообщения в полном тексте ответа
+        self._reopen = ""     # строка, заново открывающая блок кода, разорванный между сообщениями
+        self._shown = ""      # что сейчас показано в текущем сообщении
+        self._next_edit = 0.0
+
+    def _segment(self, text: str) -> str:
+        """Текст текущего сообщения."""
+        return self._reopen + text[self._offset:]
+
+    async def start(self):
+        """Отправляет сообщение-заглушку, которое затем заполняется текстом ответа."""
+        sent = await self.bot.send_message(self.chat_id, self.placeholder, parse_mode=None)
+        self._message_id = sent.message_id
+
+    async def update(self, text: str):
+        """Показывает накопленный текст ответа (с учетом интервала между правками)."""
+        await self._roll_over(text)
+        if time.monotonic() >= self._next_edit:
+            await self._edit_plain(self._segment(text))
+
+    async def finish(self, text: str, **kwargs):
+        """
+        Показывает итоговый текст ответа с форматированием.
+
+        Args:
+            text: Полный текст ответа (может содержать Markdown).
+            **kwargs: Дополнительные аргументы для `bot.edit_message_text` последнего сообщения.
+        """
+        await self._roll_over(text)
+        segment = text[self._offset:]
+        if segment.strip():
+            await edit_message_text_safe(self.bot, self.chat_id, self._message_id, self._segment(text), **kwargs)
+        elif self._offset == 0:
+            await self.abort()
+
+    async def abort(self):
+        """Удаляет все сообщения ответа — заглушку и недописанный текст (например, при ошибке)."""
+        for message_id in self._done_ids + [self._message_id]:
+            await self._delete(message_id)
+        self._done_ids, self._message_id = [], None
+
+    async def fail(self, text: str, **kwargs):
+        """
+        Заменяет недописанный ответ сообщением об ошибке: прежние части удаляются, текущее сообщение
+        получает текст ошибки (если его нет — ошибка отправляется новым сообщением).
+
+        Args:
+            text: Текст ошибки (может содержать Markdown).
+            **kwargs: Дополнительные аргументы для `bot.edit_message_text` (например, reply_markup).
+        """
+        for message_id in self._done_ids:
+            await self._delete(message_id)
+        self._done_ids = []
+        if self._message_id is None:
+            await send_long_message(self.bot, self.chat_id, text, **kwargs)
+            return
+        await edit_message_text_safe(self.bot, self.chat_id, self._message_id, text, **kwargs)
+        self._shown = text
+
+    async def _delete(self, message_id: Optional[int]):
+        if message_id is None:
+            return
+        try:
+            await self.bot.delete_message(self.chat_id, message_id)
+        except apihelper.ApiException as e:
+            logger.debug(f"Не удалось удалить сообщение потокового ответа: {e}", extra={'user_id': str(self.chat_id)})
+
+    @staticmethod
+    def _fits(segment: str) -> bool:
+        # Экранирование MarkdownV2 добавляет не больше одного символа на символ текста
+        if len(segment) > STREAM_MESSAGE_LIMIT:
+            return False
+        return len(segment) * 2 <= STREAM_MESSAGE_LIMIT or \
+            len(telegramify_markdown.markdownify(segment)) <= STREAM_MESSAGE_LIMIT
+
+    async def _roll_over(self, text: str):
+        """
+        Пока текст текущего сообщения (после оформления через telegramify_markdown) длиннее лимита,
+        оформляет готовую часть и начинает новое сообщение.
+        """
+        while True:
+            segment = self._segment(text)
+            if self._fits(segment):
+                return
+            chunk_size = STREAM_MESSAGE_LIMIT
+            while True:
+                cut, reopen = _stream_split(segment, chunk_size)
+                # Разрыв должен продвинуться за строку, открывающую блок кода в этом сообщении
+                cut = max(cut, len(self._reopen) + 1)
+                done = segment[:cut].strip() + ("\n```" if reopen else "")
+                formatted = len(telegramify_markdown.markdownify(done))
+                if formatted <= STREAM_MESSAGE_LIMIT or chunk_size <= len(self._reopen) + 1:
+                    break
+                chunk_size = max(chunk_size * STREAM_MESSAGE_LIMIT // formatted - 1, len(self._reopen) + 1)
+            await edit_message_text_safe(self.bot, self.chat_id, self._message_id, done,
+                                         disable_web_page_preview=True)
+            self._done_ids.append(self._message_id)
+            self._offset += cut - len(self._reopen)
+            self._reopen = reopen
+            continuation = self._segment(text)[:STREAM_MESSAGE_LIMIT].strip() or self.placeholder
+            sent = await self.bot.send_message(self.chat_id, continuation, parse_mode=None)
+            self._message_id = sent.message_id
+            self._shown = continuation
+            self._next_edit = time.monotonic() + STREAM_EDIT_INTERVAL_SECONDS
+
+    async def _edit_plain(self, segment: str):
+        segment = segment.strip()
+        if not segment or segment == self._shown:
+            return
+        self._next_edit = time.monotonic() + STREAM_EDIT_INTERVAL_SECONDS
+        try:
+            await self.bot.edit_message_text(segment, self.chat_id, self._message_id, parse_mode=None)
+            self._shown = segment
+        except apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                # Ограничение частоты: откладываем следующую правку на время, указанное Telegram
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', STREAM_EDIT_INTERVAL_SECONDS)
+                self._next_edit = time.monotonic() + retry_after
+            logger.debug(f"Промежуточная правка потокового ответа не удалась: {e}", extra={'user_id': str(self.chat_id)})
@@ -15,10 +15,10 @@ guide_manager.load_guides()
 
 try:
     from config import settings
-    from database import db_manager
+    from database import storage
     # Импортируем новый модуль admin_handlers
     from handlers import command_handlers, callback_handlers, message_handlers, admin_handlers, telegram_helpers
-    from services import gemini_service
+    from services import gemini_service, http_session
 except ImportError as e:
     main_logger.exception(f"Критическая ошибка: Не удалось импортировать необходимые модули: {e}", extra={'user_id': 'System'})
     sys.exit(1)
@@ -40,7 +40,7 @@ async def setup_db():
     """Асинхронная функция для настройки базы данных."""
     try:
         main_logger.info("Настройка базы данных...", extra={'user_id': 'System'})
-        await db_manager.setup_database()
+        await storage.setup_database()
         main_logger.info("База данных успешно настроена.", extra={'user_id': 'System'})
     except Exception as e:
         main_logger.exception("Критическая ошибка: Не удалось настроить базу данных.", extra={'user_id': 'System'})
@@ -79,6 +79,8 @@ async def main():
     main_logger.info("Запуск основной асинхронной функции main().", extra={'user_id': 'System'})
 
     await setup_db()
+    # Одна HTTP-сессия с пулом соединений на все запросы к Gemini API
+    await http_session.start()
 
     polling_task = asyncio.create_task(run_bot_polling(bot))
     await shutdown_event.wait()
@@ -95,6 +97,12 @@ async def main():
     except Exception as e:
          main_logger.exception("Ошибка при ожидании завершения задачи поллинга.", extra={'user_id': 'System'})
 
+    main_logger.info("Закрытие HTTP-сессии Gemini API...", extra={'user_id': 'System'})
+    await http_session.close()
+
+    main_logger.info("Закрытие соединений с базой данных...", extra={'user_id': 'System'})
+    await storage.close_database()
+
     main_logger.info("Graceful shutdown завершен.", extra={'user_id': 'System'})
 
 
@@ -0,0 +1,152 @@
+# File: services/circuit_breaker.py
+"""
+Автоматический выключатель (circuit breaker) для запросов к Gemini API.
+
+Состояние ведется отдельно для каждой пары (хэш API-ключа, модель). Ошибки
+классифицируются через `error_parser`: неверный ключ или отказ в доступе, исчерпанная
+квота и перегрузка сервиса (недоступность, тайм-ауты) считаются признаками того, что
+ключ или модель сейчас неработоспособны. Текст ошибки дополняется классом HTTP-статуса
+(`retry_policy.classify_status`): любой ответ 5xx считается недоступностью, 429 — квотой,
+даже если сообщение сервера не распознано. Остальные ошибки (безопасность, неверные
+аргументы) относятся к конкретному запросу и на состояние не влияют: они не считаются
+ни ошибкой, ни успехом.
+
+- closed: запросы проходят; после `threshold` таких ошибок подряд цепь размыкается.
+- open: запросы сразу завершаются последней ошибкой (без сети и повторов) до истечения
+  времени размыкания — для ключевых ошибок дольше, для квоты не меньше задержки,
+  названной сервером.
+- half-open: по истечении времени пропускается один пробный запрос; успех замыкает цепь,
+  ошибка снова размыкает ее на вдвое больший срок (не больше `GEMINI_CIRCUIT_MAX_OPEN_SECONDS`).
+
+Сам ключ не хранится — только префикс его SHA-256. Состояние используется только из потока
+event loop, поэтому блокировок нет.
+"""
+import hashlib
+import time
+from typing import Any, Dict, Optional
+
+from cachetools import LRUCache
+
+from config.settings import (
+    GEMINI_CIRCUIT_FAILURE_THRESHOLD, GEMINI_CIRCUIT_OPEN_SECONDS, GEMINI_CIRCUIT_KEY_OPEN_SECONDS,
+    GEMINI_CIRCUIT_MAX_OPEN_SECONDS
+)
+from logger_config import get_logger
+from . import retry_policy
+from .error_parser import get_user_friendly_error_key
+
+breaker_logger = get_logger('gemini_api', user_id='System')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Ключ ошибки (error_parser) -> (сколько таких ошибок подряд размыкают цепь, на сколько секунд)
+TRIP_RULES = {
+    'gemini_error_api_key_invalid': (1, GEMINI_CIRCUIT_KEY_OPEN_SECONDS),
+    'gemini_error_permission_denied': (1, GEMINI_CIRCUIT_KEY_OPEN_SECONDS),
+    'gemini_error_quota_exceeded': (GEMINI_CIRCUIT_FAILURE_THRESHOLD, GEMINI_CIRCUIT_OPEN_SECONDS),
+    'gemini_error_unavailable': (GEMINI_CIRCUIT_FAILURE_THRESHOLD, GEMINI_CIRCUIT_OPEN_SECONDS),
+    'gemini_error_timeout': (GEMINI_CIRCUIT_FAILURE_THRESHOLD, GEMINI_CIRCUIT_OPEN_SECONDS),
+}
+
+# Класс HTTP-статуса (retry_policy) -> ключ ошибки, правило которого применяется, если текст не распознан
+STATUS_RULES = {
+    retry_policy.SERVER: 'gemini_error_unavailable',
+    retry_policy.RATE_LIMIT: 'gemini_error_quota_exceeded',
+}
+
+
+class Circuit:
+    """Состояние выключателя для одной пары (ключ, модель)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.open_seconds = 0.0
+        self.opened_until = 0.0
+        self.last_error: Dict[str, Any] = {}
+        self._probing = False
+
+    def acquire(self) -> Optional[bool]:
+        """
+        Разрешение на запрос. None — цепь разомкнута, запрос нужно сразу завершить ошибкой `last_error`;
+        True — это пробный запрос half-open (после него обязательно вызвать `release_probe`); False — обычный.
+        """
+        if self.state == OPEN:
+            if time.monotonic() < self.opened_until:
+                return None
+            self.state = HALF_OPEN
+            self._probing = False
+        if self.state == HALF_OPEN:
+            if self._probing:
+                return None
+            self._probing = True
+            return True
+        return False
+
+    def release_probe(self):
+        """Снимает отметку о пробном запросе, если он завершился без результата (например, отменен)."""
+        self._probing = False
+
+    def record_success(self):
+        """Ключ и модель отвечают: цепь замыкается."""
+        if self.state != CLOSED:
+            breaker_logger.info(f"Цепь {self.name} снова замкнута.")
+        self.state = CLOSED
+        self.failures = 0
+        self.open_seconds = 0.0
+        self._probing = False
+
+    def record_failure(self, error_details: Dict[str, Any], retry_after: Optional[float] = None,
+                       error_class: Optional[str] = None):
+        """
+        Учитывает ошибку запроса. `error_class` — класс HTTP-статуса ответа (retry_policy.classify_status).
+        Ошибки, не относящиеся к состоянию ключа или модели, не учитываются: счетчик подряд идущих ошибок
+        и состояние цепи не меняются, только снимается отметка о пробном запросе.
+        """
+        rule = TRIP_RULES.get(get_user_friendly_error_key(error_details)) or \
+            TRIP_RULES.get(STATUS_RULES.get(error_class))
+        if rule is None:
+            self._probing = False
+            return
+        threshold, open_seconds = rule
+        self.failures += 1
+        self.last_error = error_details
+        self._probing = False
+        if self.state == HALF_OPEN:
+            # Пробный запрос не прошел: размыкаем на вдвое больший срок
+            self._open(min(max(self.open_seconds * 2, open_seconds), GEMINI_CIRCUIT_MAX_OPEN_SECONDS), retry_after)
+        elif self.failures >= threshold:
+            self._open(open_seconds, retry_after)
+
+    def _open(self, open_seconds: float, retry_after: Optional[float]):
+        self.state = OPEN
+        self.open_seconds = max(open_seconds, retry_after or 0.0)
+        self.opened_until = time.monotonic() + self.open_seconds
+        breaker_logger.warning(f"Цепь {self.name} разомкнута на {self.open_seconds:.0f} сек. "
+                               f"после {self.failures} ошибок подряд: {get_user_friendly_error_key(self.last_error)}.")
+
+
+# Состояния по парам (хэш ключа, модель); давно не использованные вытесняются
+_circuits: LRUCache = LRUCache(maxsize=10000)
+
+
+def get_circuit(api_key: str, model: str) -> Circuit:
+    """Возвращает (создает при необходимости) выключатель для пары (ключ, модель)."""
+    key = (hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16], model)
+    circuit = _circuits.get(key)
+    if circuit is None:
+        circuit = _circuits[key] = Circuit(f"{key[0]}/{model}")
+    return circuit
+
+
+def get_stats() -> Dict[str, int]:
+    """Число известных выключателей и сколько из них сейчас разомкнуто."""
+    circuits = list(_circuits.values())
+    return {
+        'circuits': len(circuits),
+        'open': sum(1 for circuit in circuits if circuit.state == OPEN),
+        'half_open': sum(1 for circuit in circuits if circuit.state == HALF_OPEN),
+    }
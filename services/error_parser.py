@@ -11,6 +11,9 @@ ERROR_MAP = {
     # --- Специфичная ошибка для поиска ---
     "tool is not supported for this model": "gemini_error_search_not_supported",
 
+    # --- Клиентское ограничение частоты запросов ---
+    "client_rate_limited": "gemini_error_rate_limited",
+
     # --- Ошибка таймаута ---
     "service_timeout": "gemini_error_timeout",
 
@@ -2,18 +2,23 @@
 import asyncio
 import aiohttp
 import PIL.Image
-from typing import List, Union, Dict, Optional, Any, Tuple
+from typing import List, Union, Dict, Optional, Any, Tuple, Callable, Awaitable, AsyncIterator
 from io import BytesIO
 import base64
 import json
 import re
 from cachetools import LRUCache
 
-from config.settings import DEFAULT_MODEL_ID, GENERATION_CONFIG, MODELS_METADATA, SAFETY_SETTINGS, BOT_PERSONAS, BOT_STYLES
+from config.settings import (
+    DEFAULT_MODEL_ID, GENERATION_CONFIG, MODELS_METADATA, SAFETY_SETTINGS, BOT_PERSONAS, BOT_STYLES,
+    GEMINI_HTTP_TIMEOUT_SECONDS
+)
 from utils import guide_manager
 from logger_config import get_logger
-from database import db_manager
+from database import storage
 from .error_parser import get_user_friendly_error_key
+from . import http_session, retry_policy, circuit_breaker, rate_limiter
+from .retry_policy import DEFAULT_POLICY as DEFAULT_RETRY_POLICY
 
 gemini_logger = get_logger('gemini_api')
 
@@ -29,6 +34,15 @@ GOOGLE_SEARCH_TOOL = {
 }
 
 
+_MODEL_IN_URL = re.compile(r'/models/([^/:?]+)')
+
+
+def _model_from_url(url: str) -> str:
+    """Модель из URL запроса (для выключателя); '*' — запрос не к конкретной модели (например, список моделей)."""
+    match = _MODEL_IN_URL.search(url)
+    return match.group(1) if match else '*'
+
+
 class GeminiAPIError(Exception):
     """Кастомное исключение для ошибок Gemini API."""
     def __init__(self, message: str, details: Optional[Dict] = None):
@@ -36,87 +50,223 @@ class GeminiAPIError(Exception):
         self.details = details or {}
         self.error_key = get_user_friendly_error_key(self.details)
 
+async def _admit(limiter: rate_limiter.Limiter, estimated_tokens: int, model: str, retry: bool = False) -> bool:
+    """
+    Ждет места в клиентском лимите пары (ключ, модель); если оно не освободилось вовремя, выбрасывает GeminiAPIError.
+    Для повторной попытки (`retry`) списывается только расход ведер: место одновременного запроса уже занято.
+    """
+    admitted = await (limiter.recharge(estimated_tokens) if retry else limiter.acquire(estimated_tokens))
+    if not admitted:
+        gemini_logger.warning(f"Клиентский лимит запросов к модели {model} исчерпан: запрос отклонен.", extra={'user_id': 'System'})
+        raise GeminiAPIError("Слишком много запросов подряд.", details={"error": {"message": "client_rate_limited"}})
+    return True
+
 async def _make_gemini_request_async(api_key: str, url: str, payload: Optional[Dict] = None,
-                                     method: str = 'POST') -> Dict[str, Any]:
+                                     method: str = 'POST',
+                                     policy: Optional[retry_policy.RetryPolicy] = None) -> Dict[str, Any]:
     """
     Выполняет универсальный асинхронный HTTP-запрос к Gemini API.
     В случае ошибки выбрасывает GeminiAPIError.
-    Реализует механизм повторных попыток для временных ошибок.
+    Временные ошибки повторяются по политике `policy` (по умолчанию — retry_policy.DEFAULT_POLICY).
+    Пока выключатель пары (ключ, модель) разомкнут, запрос сразу завершается последней ошибкой (см. circuit_breaker).
+    Перед отправкой и перед каждым повтором запрос ждет места в клиентском лимите пары (см. rate_limiter).
+    Запросы идут через общую HTTP-сессию процесса (см. http_session).
     """
     headers = {'Content-Type': 'application/json'}
     params = {'key': api_key}
-
-    # --- НОВЫЙ БЛОК: Настройки для повторных попыток ---
-    max_retries = 3
-    retry_delay = 2  # задержка в секундах
-
-    for attempt in range(max_retries):
-        try:
-            async with aiohttp.ClientSession() as session:
-                request_args = {'params': params, 'headers': headers, 'timeout': aiohttp.ClientTimeout(total=60)}
+    retry = (policy or DEFAULT_RETRY_POLICY).begin()
+
+    model = _model_from_url(url)
+    circuit = circuit_breaker.get_circuit(api_key, model)
+    probe = circuit.acquire()
+    if probe is None:
+        gemini_logger.info(f"Цепь {circuit.name} разомкнута: запрос завершен без обращения к API.", extra={'user_id': 'System'})
+        raise GeminiAPIError("Запросы с этим ключом к модели временно приостановлены.", details=circuit.last_error)
+
+    limiter = rate_limiter.get_limiter(api_key, model)
+    estimated_tokens = rate_limiter.estimate_tokens(payload)
+    admitted = False
+    try:
+        admitted = await _admit(limiter, estimated_tokens, model)
+        while True:
+            try:
+                session = http_session.get_session()
+                # Тайм-аут запроса задан в общей сессии (GEMINI_HTTP_TIMEOUT_SECONDS)
+                request_args = {'params': params, 'headers': headers}
                 if payload:
                     request_args['json'] = payload
 
                 async with session.request(method, url, **request_args) as response:
                     response_json = await response.json()
-                    if response.status != 200:
-                        error_details = response_json.get('error', {})
-                        error_message = error_details.get('message', 'Неизвестная ошибка API')
-
-                        # --- НОВЫЙ БЛОК: Логика повторных попыток ---
-                        # Повторяем только для ошибок 5xx (проблемы на сервере) и 429 (превышение квот)
-                        if response.status >= 500 or response.status == 429:
-                            if attempt < max_retries - 1:
-                                gemini_logger.warning(
-                                    f"Попытка {attempt + 1}/{max_retries}: "
-                                    f"Получена временная ошибка (HTTP {response.status}). "
-                                    f"Повтор через {retry_delay} сек. Ошибка: {error_message}",
-                                    extra={'user_id': 'System'}
-                                )
-                                await asyncio.sleep(retry_delay)
-                                continue # Переходим к следующей попытке
-
-                        # Если ошибка не временная или попытки закончились, выбрасываем исключение
+                    if response.status == 200:
+                        circuit.record_success()
+                        limiter.settle(estimated_tokens, response_json.get('usageMetadata', {}).get('totalTokenCount'))
+                        return response_json # Успешный ответ
+
+                    error_details = response_json.get('error', {})
+                    error_message = error_details.get('message', 'Неизвестная ошибка API')
+                    # Повторяем только временные ошибки: 5xx (проблемы на сервере) и 429 (превышение квот)
+                    retry_after = retry_policy.parse_retry_after(response.headers, error_details)
+                    error_class = retry_policy.classify_status(response.status)
+                    circuit.record_failure(error_details, retry_after, error_class)
+                    # Если цепь разомкнулась, повторять бессмысленно: ошибка возвращается сразу
+                    delay = None if circuit.state == circuit_breaker.OPEN else retry.next_delay(error_class, retry_after)
+                    if delay is None:
                         gemini_logger.error(f"Ошибка API Gemini (HTTP {response.status}): {response_json}", extra={'user_id': 'System'})
                         raise GeminiAPIError(error_message, details=error_details)
-
-                    return response_json # Успешный ответ
-
-        except (asyncio.TimeoutError, aiohttp.ServerTimeoutError):
-            gemini_logger.error(f"Тайм-аут при запросе к Gemini API после {attempt + 1} попыток.", extra={'user_id': 'System'})
-            if attempt < max_retries - 1:
-                await asyncio.sleep(retry_delay)
-                continue
-            # Если все попытки провалились по таймауту
-            raise GeminiAPIError("Сервер не ответил вовремя.", details={"error": {"message": "service_timeout"}})
-        except aiohttp.ClientError as e:
-            gemini_logger.exception(f"Сетевая ошибка при запросе к Gemini API: {e}", extra={'user_id': 'System'})
-            # Для сетевых ошибок тоже можно попробовать повторить
-            if attempt < max_retries - 1:
-                await asyncio.sleep(retry_delay)
-                continue
-            raise GeminiAPIError("Сетевая ошибка при подключении к сервису.", details={"error": {"message": "service_unavailable"}})
-        except GeminiAPIError:
-            # Пробрасываем "фатальные" ошибки API без повторных попыток
-            raise
-        except Exception as e:
-            gemini_logger.exception(f"Неожиданная ошибка при выполнении запроса к Gemini API: {e}", extra={'user_id': 'System'})
-            if attempt < max_retries - 1:
-                await asyncio.sleep(retry_delay)
-                continue
-            raise GeminiAPIError(f"Неожиданная ошибка: {e}", details={"error": {"message": "unknown_error"}})
-
-    # Этот код выполнится, только если все попытки провалились
-    raise GeminiAPIError("Не удалось получить ответ от API после нескольких попыток.", details={"error": {"message": "service_unavailable"}})
-
-
-async def _get_dialog_chat_history(dialog_id: int) -> List[Dict[str, Any]]:
+                    gemini_logger.warning(
+                        f"Попытка {retry.attempt - 1}: "
+                        f"Получена временная ошибка (HTTP {response.status}). "
+                        f"Повтор через {delay:.1f} сек. Ошибка: {error_message}",
+                        extra={'user_id': 'System'}
+                    )
+
+            except (asyncio.TimeoutError, aiohttp.ServerTimeoutError):
+                gemini_logger.error(f"Тайм-аут при запросе к Gemini API (попытка {retry.attempt}).", extra={'user_id': 'System'})
+                error_details = {"error": {"message": "service_timeout"}}
+                circuit.record_failure(error_details)
+                delay = None if circuit.state == circuit_breaker.OPEN else retry.next_delay(retry_policy.TIMEOUT)
+                if delay is None:
+                    raise GeminiAPIError("Сервер не ответил вовремя.", details=error_details)
+            except aiohttp.ClientError as e:
+                gemini_logger.exception(f"Сетевая ошибка при запросе к Gemini API: {e}", extra={'user_id': 'System'})
+                error_details = {"error": {"message": "service_unavailable"}}
+                circuit.record_failure(error_details)
+                delay = None if circuit.state == circuit_breaker.OPEN else retry.next_delay(retry_policy.NETWORK)
+                if delay is None:
+                    raise GeminiAPIError("Сетевая ошибка при подключении к сервису.", details=error_details)
+            except GeminiAPIError:
+                # Пробрасываем "фатальные" ошибки API без повторных попыток
+                raise
+            except Exception as e:
+                gemini_logger.exception(f"Неожиданная ошибка при выполнении запроса к Gemini API: {e}", extra={'user_id': 'System'})
+                delay = retry.next_delay(retry_policy.UNEXPECTED)
+                if delay is None:
+                    raise GeminiAPIError(f"Неожиданная ошибка: {e}", details={"error": {"message": "unknown_error"}})
+
+            # Ждем вне `async with`, чтобы соединение вернулось в пул на время задержки
+            await asyncio.sleep(delay)
+            await _admit(limiter, estimated_tokens, model, retry=True)
+    finally:
+        if admitted:
+            limiter.release()
+        if probe:
+            circuit.release_probe()
+
+
+async def _stream_gemini_request_async(api_key: str, url: str, payload: Dict,
+                                       policy: Optional[retry_policy.RetryPolicy] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Выполняет потоковый запрос к Gemini API (Server-Sent Events, alt=sse) и отдает
+    разобранные JSON-фрагменты ответа по мере поступления. В случае ошибки выбрасывает GeminiAPIError.
+    Повторные попытки — как в _make_gemini_request_async, но только до первого фрагмента:
+    после него пользователь уже видит часть ответа, и повтор продублировал бы текст.
+    """
+    headers = {'Content-Type': 'application/json'}
+    params = {'key': api_key, 'alt': 'sse'}
+    # Общий тайм-аут сессии ограничил бы длительность всего ответа; для потока ограничиваем
+    # установку соединения и паузу между фрагментами
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=GEMINI_HTTP_TIMEOUT_SECONDS,
+                                    sock_read=GEMINI_HTTP_TIMEOUT_SECONDS)
+    retry = (policy or DEFAULT_RETRY_POLICY).begin()
+
+    model = _model_from_url(url)
+    circuit = circuit_breaker.get_circuit(api_key, model)
+    probe = circuit.acquire()
+    if probe is None:
+        gemini_logger.info(f"Цепь {circuit.name} разомкнута: запрос завершен без обращения к API.", extra={'user_id': 'System'})
+        raise GeminiAPIError("Запросы с этим ключом к модели временно приостановлены.", details=circuit.last_error)
+
+    limiter = rate_limiter.get_limiter(api_key, model)
+    estimated_tokens = rate_limiter.estimate_tokens(payload)
+    admitted = False
+    try:
+        admitted = await _admit(limiter, estimated_tokens, model)
+        while True:
+            streamed = False
+            try:
+                session = http_session.get_session()
+                async with session.post(url, params=params, headers=headers, json=payload, timeout=timeout) as response:
+                    if response.status == 200:
+                        circuit.record_success()
+                        # События SSE разделены пустой строкой; каждое событие Gemini — одна строка "data: {...}"
+                        buffer = b""
+                        usage_metadata = {}
+                        async for data in response.content.iter_any():
+                            buffer += data
+                            *lines, buffer = buffer.split(b"\n")
+                            for line in lines:
+                                line = line.strip()
+                                if not line.startswith(b"data:"):
+                                    continue
+                                chunk = json.loads(line[5:])
+                                if 'error' in chunk:
+                                    gemini_logger.error(f"Ошибка API Gemini в потоке: {chunk}", extra={'user_id': 'System'})
+                                    error_code = chunk['error'].get('code')
+                                    circuit.record_failure(chunk['error'], error_class=retry_policy.classify_status(
+                                        error_code if isinstance(error_code, int) else 0))
+                                    raise GeminiAPIError(chunk['error'].get('message', 'Неизвестная ошибка API'),
+                                                         details=chunk['error'])
+                                streamed = True
+                                usage_metadata = chunk.get('usageMetadata') or usage_metadata
+                                yield chunk
+                        limiter.settle(estimated_tokens, usage_metadata.get('totalTokenCount'))
+                        return
+
+                    response_json = await response.json(content_type=None) or {}
+                    error_details = response_json.get('error', {})
+                    error_message = error_details.get('message', 'Неизвестная ошибка API')
+                    retry_after = retry_policy.parse_retry_after(response.headers, error_details)
+                    error_class = retry_policy.classify_status(response.status)
+                    circuit.record_failure(error_details, retry_after, error_class)
+                    # Если цепь разомкнулась, повторять бессмысленно: ошибка возвращается сразу
+                    delay = None if circuit.state == circuit_breaker.OPEN else retry.next_delay(error_class, retry_after)
+                    if delay is None:
+                        gemini_logger.error(f"Ошибка API Gemini (HTTP {response.status}): {response_json}", extra={'user_id': 'System'})
+                        raise GeminiAPIError(error_message, details=error_details)
+                    gemini_logger.warning(
+                        f"Попытка {retry.attempt - 1}: "
+                        f"Получена временная ошибка (HTTP {response.status}). "
+                        f"Повтор через {delay:.1f} сек. Ошибка: {error_message}",
+                        extra={'user_id': 'System'}
+                    )
+
+            except (asyncio.TimeoutError, aiohttp.ServerTimeoutError):
+                gemini_logger.error("Тайм-аут потокового запроса к Gemini API.", extra={'user_id': 'System'})
+                error_details = {"error": {"message": "service_timeout"}}
+                circuit.record_failure(error_details)
+                delay = None if streamed or circuit.state == circuit_breaker.OPEN else retry.next_delay(retry_policy.TIMEOUT)
+                if delay is None:
+                    raise GeminiAPIError("Сервер не ответил вовремя.", details=error_details)
+            except aiohttp.ClientError as e:
+                gemini_logger.exception(f"Сетевая ошибка при потоковом запросе к Gemini API: {e}", extra={'user_id': 'System'})
+                error_details = {"error": {"message": "service_unavailable"}}
+                circuit.record_failure(error_details)
+                delay = None if streamed or circuit.state == circuit_breaker.OPEN else retry.next_delay(retry_policy.NETWORK)
+                if delay is None:
+                    raise GeminiAPIError("Сетевая ошибка при подключении к сервису.", details=error_details)
+            except GeminiAPIError:
+                raise
+            except Exception as e:
+                gemini_logger.exception(f"Неожиданная ошибка при потоковом запросе к Gemini API: {e}", extra={'user_id': 'System'})
+                raise GeminiAPIError(f"Неожиданная ошибка: {e}", details={"error": {"message": "unknown_error"}})
+
+            await asyncio.sleep(delay)
+            await _admit(limiter, estimated_tokens, model, retry=True)
+    finally:
+        if admitted:
+            limiter.release()
+        if probe:
+            circuit.release_probe()
+
+
+async def _get_dialog_chat_history(user_id: int, dialog_id: int) -> List[Dict[str, Any]]:
     """
     Возвращает или создает историю чата для диалога из кэша или БД.
     """
     if dialog_id not in dialog_chats_cache:
         gemini_logger.debug(f"Кэш истории для dialog_id: {dialog_id} не найден. Загрузка из БД.")
-        history_from_db = await db_manager.get_conversation_history(dialog_id, limit=20)
+        history_from_db = await storage.get_conversation_history(user_id, dialog_id, limit=20)
         gemini_history = []
         for item in history_from_db:
             role = 'user' if item.get('role') == 'user' else 'model'
@@ -136,11 +286,11 @@ async def _get_system_instruction_text(user_id: int) -> Optional[str]:
     Формирует текст системной инструкции, включая персону или стиль.
     Полное руководство по боту было убрано, чтобы не превышать лимит токенов.
     """
-    lang_code = await db_manager.get_user_language(user_id)
+    lang_code = await storage.get_user_language(user_id)
     
     # --- Инструкция по поведению (персона или стиль) ---
     persona_prompt = ""
-    persona_id = await db_manager.get_user_persona(user_id)
+    persona_id = await storage.get_user_persona(user_id)
 
     if persona_id != 'default':
         persona_info = BOT_PERSONAS.get(persona_id, BOT_PERSONAS['default'])
@@ -148,7 +298,7 @@ async def _get_system_instruction_text(user_id: int) -> Optional[str]:
         # Фоллбэк на русский, если для выбранного языка нет промпта
         persona_prompt = persona_info.get(prompt_key, persona_info.get('prompt_ru', ''))
     else:
-        style_id = await db_manager.get_user_bot_style(user_id)
+        style_id = await storage.get_user_bot_style(user_id)
         if style_id != 'default':
             # Стили не локализованы, они всегда на английском
             style_prompts = {
@@ -161,21 +311,22 @@ async def _get_system_instruction_text(user_id: int) -> Optional[str]:
 
     return persona_prompt.strip() if persona_prompt else None
 
-async def generate_response(user_id: int, prompt: Union[str, List[Union[str, PIL.Image.Image, bytes]]]) -> Tuple[str, List[Dict[str, str]]]:
+async def _prepare_generation(user_id: int, prompt: Union[str, List[Union[str, PIL.Image.Image, bytes]]]) -> Dict[str, Any]:
     """
-    Генерирует ответ от Gemini, динамически включая функции.
+    Общая подготовка запроса генерации: проверяет ключ и активный диалог, собирает payload
+    и сохраняет сообщение пользователя в БД.
     Для моделей Gemma история диалога игнорируется для совместимости.
     """
-    api_key = await db_manager.get_user_api_key(user_id)
+    api_key = await storage.get_user_api_key(user_id)
     if not api_key:
         raise GeminiAPIError("API-ключ пользователя не найден.", details={"error": {"message": "API_KEY_NOT_FOUND"}})
 
-    active_dialog_id = await db_manager.get_active_dialog_id(user_id)
+    active_dialog_id = await storage.get_active_dialog_id(user_id)
     if not active_dialog_id:
         gemini_logger.error(f"У пользователя {user_id} нет активного диалога для генерации ответа.")
         raise GeminiAPIError("Не найден активный диалог. Пожалуйста, перезапустите бота командой /start.", details={})
 
-    model_name = await db_manager.get_user_gemini_model(user_id) or DEFAULT_MODEL_ID
+    model_name = await storage.get_user_gemini_model(user_id) or DEFAULT_MODEL_ID
     
     # Проверяем, является ли модель Gemma для специальной обработки
     is_gemma_model = model_name.startswith('gemma')
@@ -183,7 +334,7 @@ async def generate_response(user_id: int, prompt: Union[str, List[Union[str, PIL
     # Загружаем историю только для моделей, не являющихся Gemma
     history = []
     if not is_gemma_model:
-        history = await _get_dialog_chat_history(active_dialog_id)
+        history = await _get_dialog_chat_history(user_id, active_dialog_id)
     
     # Получаем метаданные модели из нашего словаря-справочника
     model_meta = MODELS_METADATA.get(model_name, {})
@@ -236,9 +387,7 @@ async def generate_response(user_id: int, prompt: Union[str, List[Union[str, PIL
 
     # Добавляем сообщение пользователя в историю запроса и сохраняем в БД
     request_contents.append({"role": "user", "parts": user_parts})
-    await db_manager.store_message(user_id, active_dialog_id, 'user', user_message_for_db)
-
-    url = f"{GEMINI_API_BASE_URL}/models/{model_name}:generateContent"
+    await storage.store_message(user_id, active_dialog_id, 'user', user_message_for_db)
 
     # Собираем payload, базовую часть
     payload = {
@@ -256,66 +405,126 @@ async def generate_response(user_id: int, prompt: Union[str, List[Union[str, PIL
         if system_instruction_text:
             payload["system_instruction"] = { "parts": [{"text": system_instruction_text}] }
 
-    try:
-        response_json = await _make_gemini_request_async(api_key, url, payload)
-
-        # --- НОВЫЙ БЛОК ЛОГИРОВАНИЯ ---
-        # Логируем полный, необработанный ответ от API для диагностики.
-        gemini_logger.debug(
-            f"Сырой ответ от Gemini API для user_id {user_id}:\n"
-            f"{json.dumps(response_json, indent=2, ensure_ascii=False)}"
-        )
-        # --- КОНЕЦ БЛОКА ЛОГИРОВАНИЯ ---
-
-        if not response_json or "candidates" not in response_json:
-            raise GeminiAPIError("Ответ API не содержит 'candidates'.", details=response_json)
-
-        first_candidate = response_json["candidates"][0]
-
-        if first_candidate.get("finishReason") == "SAFETY":
-             raise GeminiAPIError("Ответ заблокирован настройками безопасности.", details={"finish_reason": "SAFETY"})
-
-        response_text = "".join(part.get("text", "") for part in first_candidate["content"]["parts"]).strip()  
-              
-        # Извлекаем источники из метаданных
-        sources = []
-        metadata = first_candidate.get('groundingMetadata', {})
-        if 'groundingAttributions' in metadata:
-            for attr in metadata['groundingAttributions']:
-                if 'web' in attr and attr['web'].get('uri') and attr['web'].get('title'):
-                    sources.append({"uri": attr['web']['uri'], "title": attr['web']['title']})
-        elif 'groundingChunks' in metadata:
-            for chunk in metadata['groundingChunks']:
-                if 'web' in chunk and chunk['web'].get('uri') and chunk['web'].get('title'):
-                    source_item = {"uri": chunk['web']['uri'], "title": chunk['web']['title']}
-                    if source_item not in sources:
-                        sources.append(source_item)
-        
-        # Обновляем кеш истории только для моделей, поддерживающих контекст
-        if not is_gemma_model:
-            history.append({"role": "user", "parts": user_parts})
-            history.append({"role": "model", "parts": [{"text": response_text}]})
-
-        # Сохраняем информацию о токенах
-        usage_metadata = response_json.get('usageMetadata', {})
-        prompt_tokens = usage_metadata.get('promptTokenCount', 0)
-        completion_tokens = usage_metadata.get('candidatesTokenCount', 0)
-        total_tokens = usage_metadata.get('totalTokenCount', 0)
-
-        await db_manager.store_message(
-            user_id=user_id, dialog_id=active_dialog_id, role='bot',
-            message_text=response_text, prompt_tokens=prompt_tokens,
-            completion_tokens=completion_tokens, total_tokens=total_tokens
-        )
-        
-        return response_text, sources
+    return {
+        'api_key': api_key,
+        'dialog_id': active_dialog_id,
+        'model_name': model_name,
+        'is_gemma_model': is_gemma_model,
+        'history': history,
+        'user_parts': user_parts,
+        'payload': payload,
+    }
 
-    except GeminiAPIError:
-        # При любой ошибке удаляем последний (неудачный) запрос пользователя из кеша,
-        # если этот кеш вообще использовался (т.е. не для Gemma)
-        if history: 
-            history.pop()
-        raise
+def _extract_sources(metadata: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Извлекает источники (uri, title) из groundingMetadata кандидата."""
+    sources = []
+    if 'groundingAttributions' in metadata:
+        for attr in metadata['groundingAttributions']:
+            if 'web' in attr and attr['web'].get('uri') and attr['web'].get('title'):
+                sources.append({"uri": attr['web']['uri'], "title": attr['web']['title']})
+    elif 'groundingChunks' in metadata:
+        for chunk in metadata['groundingChunks']:
+            if 'web' in chunk and chunk['web'].get('uri') and chunk['web'].get('title'):
+                source_item = {"uri": chunk['web']['uri'], "title": chunk['web']['title']}
+                if source_item not in sources:
+                    sources.append(source_item)
+    return sources
+
+async def _finish_generation(user_id: int, generation: Dict[str, Any], response_text: str,
+                             usage_metadata: Dict[str, Any]):
+    """Обновляет кэш истории диалога и сохраняет ответ модели вместе с расходом токенов."""
+    # Обновляем кеш истории только для моделей, поддерживающих контекст. Запрос и ответ добавляются
+    # только здесь, после успешного ответа, поэтому при ошибке откатывать в кеше нечего
+    if not generation['is_gemma_model']:
+        generation['history'].append({"role": "user", "parts": generation['user_parts']})
+        generation['history'].append({"role": "model", "parts": [{"text": response_text}]})
+
+    # Сохраняем информацию о токенах
+    prompt_tokens = usage_metadata.get('promptTokenCount', 0)
+    completion_tokens = usage_metadata.get('candidatesTokenCount', 0)
+    total_tokens = usage_metadata.get('totalTokenCount', 0)
+
+    await storage.store_message(
+        user_id=user_id, dialog_id=generation['dialog_id'], role='bot',
+        message_text=response_text, prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens, total_tokens=total_tokens,
+        model=generation['model_name']
+    )
+
+async def generate_response(user_id: int, prompt: Union[str, List[Union[str, PIL.Image.Image, bytes]]]) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Генерирует ответ от Gemini, динамически включая функции.
+    Для моделей Gemma история диалога игнорируется для совместимости.
+    """
+    generation = await _prepare_generation(user_id, prompt)
+    url = f"{GEMINI_API_BASE_URL}/models/{generation['model_name']}:generateContent"
+
+    response_json = await _make_gemini_request_async(generation['api_key'], url, generation['payload'])
+
+    # --- НОВЫЙ БЛОК ЛОГИРОВАНИЯ ---
+    # Логируем полный, необработанный ответ от API для диагностики.
+    gemini_logger.debug(
+        f"Сырой ответ от Gemini API для user_id {user_id}:\n"
+        f"{json.dumps(response_json, indent=2, ensure_ascii=False)}"
+    )
+    # --- КОНЕЦ БЛОКА ЛОГИРОВАНИЯ ---
+
+    if not response_json or "candidates" not in response_json:
+        raise GeminiAPIError("Ответ API не содержит 'candidates'.", details=response_json)
+
+    first_candidate = response_json["candidates"][0]
+
+    if first_candidate.get("finishReason") == "SAFETY":
+         raise GeminiAPIError("Ответ заблокирован настройками безопасности.", details={"finish_reason": "SAFETY"})
+
+    response_text = "".join(part.get("text", "") for part in first_candidate["content"]["parts"]).strip()  
+          
+    # Извлекаем источники из метаданных
+    sources = _extract_sources(first_candidate.get('groundingMetadata', {}))
+
+    await _finish_generation(user_id, generation, response_text, response_json.get('usageMetadata', {}))
+    
+    return response_text, sources
+
+async def generate_response_stream(user_id: int, prompt: Union[str, List[Union[str, PIL.Image.Image, bytes]]],
+                                   on_text: Callable[[str], Awaitable[None]]) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Потоковый вариант generate_response (streamGenerateContent): по мере поступления фрагментов
+    вызывает `on_text` с накопленным текстом ответа. Возвращает то же, что generate_response.
+    Расход токенов берется из последнего фрагмента (usageMetadata в нем итоговый), источники —
+    из последнего фрагмента, в котором есть groundingMetadata.
+    """
+    generation = await _prepare_generation(user_id, prompt)
+    url = f"{GEMINI_API_BASE_URL}/models/{generation['model_name']}:streamGenerateContent"
+
+    text_parts: List[str] = []
+    usage_metadata: Dict[str, Any] = {}
+    grounding_metadata: Dict[str, Any] = {}
+    finish_reason = None
+    last_chunk: Dict[str, Any] = {}
+    async for chunk in _stream_gemini_request_async(generation['api_key'], url, generation['payload']):
+        gemini_logger.debug(f"Фрагмент потока Gemini API для user_id {user_id}: {json.dumps(chunk, ensure_ascii=False)}")
+        last_chunk = chunk
+        usage_metadata = chunk.get('usageMetadata') or usage_metadata
+        if not chunk.get('candidates'):
+            continue
+        candidate = chunk['candidates'][0]
+        finish_reason = candidate.get('finishReason') or finish_reason
+        grounding_metadata = candidate.get('groundingMetadata') or grounding_metadata
+        delta = "".join(part.get("text", "") for part in candidate.get('content', {}).get('parts', []))
+        if delta:
+            text_parts.append(delta)
+            await on_text("".join(text_parts))
+
+    if finish_reason == "SAFETY":
+        raise GeminiAPIError("Ответ заблокирован настройками безопасности.", details={"finish_reason": "SAFETY"})
+    if not text_parts and finish_reason is None:
+        raise GeminiAPIError("Ответ API не содержит 'candidates'.", details=last_chunk)
+
+    response_text = "".join(text_parts).strip()
+    await _finish_generation(user_id, generation, response_text, usage_metadata)
+
+    return response_text, _extract_sources(grounding_metadata)
 
 async def generate_content_simple(api_key: str, prompt: str) -> str:
     """Генерирует ответ от Gemini без истории. Выбрасывает GeminiAPIError."""
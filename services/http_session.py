@@ -0,0 +1,151 @@
+# File: services/http_session.py
+"""
+Общая HTTP-сессия для запросов к Gemini API.
+
+Одна `aiohttp.ClientSession` на процесс: соединения с generativelanguage.googleapis.com
+переиспользуются (keep-alive), а адрес хоста берется из кэша DNS, поэтому
+рукопожатие TCP/TLS оплачивается один раз на соединение, а не на каждый запрос.
+Сессия создается при запуске бота (`start`) и закрывается при graceful shutdown
+(`close`); если к ней обращаются раньше (служебные скрипты), она создается при первом
+обращении.
+
+Использование пула собирается через трассировку aiohttp (`TraceConfig`): новые и
+переиспользованные соединения, время их установки, ожидание свободного соединения,
+попадания в кэш DNS. Сессия используется только из потока event loop.
+"""
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+from config.settings import (
+    GEMINI_HTTP_LIMIT, GEMINI_HTTP_LIMIT_PER_HOST, GEMINI_HTTP_KEEPALIVE_SECONDS, GEMINI_HTTP_DNS_TTL_SECONDS,
+    GEMINI_HTTP_TIMEOUT_SECONDS
+)
+from logger_config import get_logger
+
+http_logger = get_logger('gemini_api', user_id='System')
+
+_session: Optional[aiohttp.ClientSession] = None
+_stats: Dict[str, Any] = {'requests': 0, 'in_flight': 0, 'connections_created': 0, 'connections_reused': 0,
+                          'connect_ms_total': 0.0, 'queued': 0, 'queued_ms_total': 0.0,
+                          'dns_cache_hits': 0, 'dns_cache_misses': 0}
+
+
+async def _on_request_start(session, ctx: SimpleNamespace, params):
+    _stats['requests'] += 1
+    _stats['in_flight'] += 1
+
+
+async def _on_request_done(session, ctx: SimpleNamespace, params):
+    _stats['in_flight'] -= 1
+
+
+async def _on_connection_create_start(session, ctx: SimpleNamespace, params):
+    ctx.connect_started = time.perf_counter()
+
+
+async def _on_connection_create_end(session, ctx: SimpleNamespace, params):
+    _stats['connections_created'] += 1
+    _stats['connect_ms_total'] += (time.perf_counter() - ctx.connect_started) * 1000
+
+
+async def _on_connection_reuse(session, ctx: SimpleNamespace, params):
+    _stats['connections_reused'] += 1
+
+
+async def _on_connection_queued_start(session, ctx: SimpleNamespace, params):
+    ctx.queued_started = time.perf_counter()
+
+
+async def _on_connection_queued_end(session, ctx: SimpleNamespace, params):
+    _stats['queued'] += 1
+    _stats['queued_ms_total'] += (time.perf_counter() - ctx.queued_started) * 1000
+
+
+async def _on_dns_cache_hit(session, ctx: SimpleNamespace, params):
+    _stats['dns_cache_hits'] += 1
+
+
+async def _on_dns_cache_miss(session, ctx: SimpleNamespace, params):
+    _stats['dns_cache_misses'] += 1
+
+
+def _trace_config() -> aiohttp.TraceConfig:
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(_on_request_start)
+    trace.on_request_end.append(_on_request_done)
+    trace.on_request_exception.append(_on_request_done)
+    trace.on_connection_create_start.append(_on_connection_create_start)
+    trace.on_connection_create_end.append(_on_connection_create_end)
+    trace.on_connection_reuseconn.append(_on_connection_reuse)
+    trace.on_connection_queued_start.append(_on_connection_queued_start)
+    trace.on_connection_queued_end.append(_on_connection_queued_end)
+    trace.on_dns_cache_hit.append(_on_dns_cache_hit)
+    trace.on_dns_cache_miss.append(_on_dns_cache_miss)
+    return trace
+
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=GEMINI_HTTP_LIMIT,
+        limit_per_host=GEMINI_HTTP_LIMIT_PER_HOST,
+        keepalive_timeout=GEMINI_HTTP_KEEPALIVE_SECONDS,
+        ttl_dns_cache=GEMINI_HTTP_DNS_TTL_SECONDS,
+        use_dns_cache=True,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=GEMINI_HTTP_TIMEOUT_SECONDS),
+        trace_configs=[_trace_config()],
+    )
+
+
+async def start():
+    """Создает общую сессию. Вызывается при запуске бота."""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+        http_logger.info(f"HTTP-сессия Gemini API создана (соединений: {GEMINI_HTTP_LIMIT}, "
+                         f"к одному хосту: {GEMINI_HTTP_LIMIT_PER_HOST}, keep-alive: {GEMINI_HTTP_KEEPALIVE_SECONDS} с).")
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Возвращает общую сессию (создает ее, если `start` еще не вызывался)."""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+    return _session
+
+
+async def close():
+    """Закрывает общую сессию и все ее соединения. Вызывается при graceful shutdown."""
+    global _session
+    session, _session = _session, None
+    if session is not None and not session.closed:
+        await session.close()
+        http_logger.info(f"HTTP-сессия Gemini API закрыта. Запросов: {_stats['requests']}, "
+                         f"соединений создано: {_stats['connections_created']}, "
+                         f"переиспользовано: {_stats['connections_reused']}.")
+
+
+def get_stats() -> Dict[str, Any]:
+    """Возвращает метрики пула соединений с момента запуска: запросы, новые и переиспользованные соединения."""
+    created = _stats['connections_created']
+    acquired = created + _stats['connections_reused']
+    return {
+        'started': _session is not None and not _session.closed,
+        'limit': GEMINI_HTTP_LIMIT,
+        'limit_per_host': GEMINI_HTTP_LIMIT_PER_HOST,
+        'requests': _stats['requests'],
+        'in_flight': _stats['in_flight'],
+        'connections_created': created,
+        'connections_reused': _stats['connections_reused'],
+        'reuse_rate': round(_stats['connections_reused'] / acquired * 100, 1) if acquired else 0.0,
+        'connect_avg_ms': round(_stats['connect_ms_total'] / created, 1) if created else 0.0,
+        'queued': _stats['queued'],
+        'queued_avg_ms': round(_stats['queued_ms_total'] / _stats['queued'], 1) if _stats['queued'] else 0.0,
+        'dns_cache_hits': _stats['dns_cache_hits'],
+        'dns_cache_misses': _stats['dns_cache_misses'],
+    }
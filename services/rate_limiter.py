@@ -0,0 +1,171 @@
+# File: services/rate_limiter.py
+"""
+Клиентское ограничение частоты запросов к Gemini API.
+
+Для каждой пары (хэш API-ключа, модель) ведутся два «ведра токенов» — запросов в
+минуту и токенов в минуту — и семафор одновременных запросов. Лимиты берутся из
+`GEMINI_RATE_LIMITS` по самому длинному совпавшему префиксу имени модели (семейству).
+Запрос сверх лимита не отправляется сразу (Google ответил бы 429, а за ним пошли бы
+повторы), а ждет свободного места в очереди, но не дольше `GEMINI_RATE_WAIT_SECONDS`;
+если за это время место не освобождается, запрос отклоняется.
+
+Каждая повторная попытка тоже списывает из ведер запрос и оценку токенов (`recharge`),
+а место одновременного запроса занято на все время попыток.
+
+Расход токенов до ответа неизвестен, поэтому списывается оценка входа запроса, а после
+ответа — разница с фактическим totalTokenCount (ведро может уйти в минус, и следующие
+запросы подождут). Состояние используется только из потока event loop.
+"""
+import asyncio
+import hashlib
+import time
+from typing import Any, Dict, Optional
+
+from cachetools import LRUCache
+
+from config.settings import GEMINI_RATE_LIMITS, GEMINI_RATE_WAIT_SECONDS
+from logger_config import get_logger
+
+limiter_logger = get_logger('gemini_api', user_id='System')
+
+# Примерно столько символов текста приходится на один токен
+CHARS_PER_TOKEN = 4
+# Оценка стоимости одного изображения или аудиофрагмента во входе запроса, токенов
+MEDIA_TOKENS = 258
+
+_stats = {'acquired': 0, 'waited': 0, 'wait_ms_total': 0.0, 'rejected': 0}
+
+
+def limits_for_model(model: str) -> Dict[str, int]:
+    """Лимиты семейства модели: самый длинный совпавший префикс из GEMINI_RATE_LIMITS, иначе 'default'."""
+    families = [family for family in GEMINI_RATE_LIMITS if family != 'default' and model.startswith(family)]
+    return GEMINI_RATE_LIMITS[max(families, key=len)] if families else GEMINI_RATE_LIMITS['default']
+
+
+def estimate_tokens(payload: Optional[Dict[str, Any]]) -> int:
+    """Грубая оценка входных токенов запроса: текст всех частей и системной инструкции плюс медиа."""
+    if not payload:
+        return 0
+    chars, media = 0, 0
+    contents = list(payload.get('contents', []))
+    if payload.get('system_instruction'):
+        contents.append(payload['system_instruction'])
+    for content in contents:
+        for part in content.get('parts', []):
+            if 'text' in part:
+                chars += len(part['text'])
+            elif 'inline_data' in part:
+                media += 1
+    return chars // CHARS_PER_TOKEN + media * MEDIA_TOKENS
+
+
+class _Bucket:
+    """Ведро токенов: емкость `per_minute`, пополняется равномерно в течение минуты (0 — без ограничения)."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Через сколько секунд в ведре наберется `amount` (больше емкости не требуется)."""
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(missing, 0.0) * 60 / self.capacity
+
+    def take(self, amount: float):
+        if self.capacity:
+            self._refill()
+            self.level -= amount
+
+
+class Limiter:
+    """Ограничитель для одной пары (ключ, модель)."""
+
+    def __init__(self, limits: Dict[str, int]):
+        self.requests = _Bucket(limits.get('rpm', 0))
+        self.tokens = _Bucket(limits.get('tpm', 0))
+        self._slots = asyncio.Semaphore(limits.get('concurrency', 0)) if limits.get('concurrency') else None
+
+    async def acquire(self, estimated_tokens: int, wait_budget: float = GEMINI_RATE_WAIT_SECONDS) -> bool:
+        """
+        Ждет места для запроса не дольше `wait_budget` секунд. True — запрос можно выполнять
+        (после него обязательно вызвать `release`), False — лимит не освободился вовремя.
+        """
+        deadline = time.monotonic() + wait_budget
+        if self._slots is not None:
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=max(wait_budget, 0.0))
+            except asyncio.TimeoutError:
+                _stats['rejected'] += 1
+                return False
+        if not await self.recharge(estimated_tokens, deadline - time.monotonic()):
+            self.release()
+            return False
+        return True
+
+    async def recharge(self, estimated_tokens: int, wait_budget: float = GEMINI_RATE_WAIT_SECONDS) -> bool:
+        """
+        Списывает из ведер еще один запрос (повторную попытку), не трогая место одновременного
+        запроса, которое остается занятым. Ждет не дольше `wait_budget` секунд; False — не дождался.
+        """
+        started = time.monotonic()
+        deadline = started + wait_budget
+        while True:
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+            if wait <= 0:
+                break
+            # Не ждем впустую, если место заведомо не освободится до конца бюджета ожидания
+            if time.monotonic() + wait > deadline:
+                _stats['rejected'] += 1
+                return False
+            await asyncio.sleep(wait)
+
+        self.requests.take(1)
+        self.tokens.take(estimated_tokens)
+        waited_ms = (time.monotonic() - started) * 1000
+        _stats['acquired'] += 1
+        if waited_ms >= 1:
+            _stats['waited'] += 1
+            _stats['wait_ms_total'] += waited_ms
+        return True
+
+    def release(self):
+        """Освобождает место одновременного запроса."""
+        if self._slots is not None:
+            self._slots.release()
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """Списывает разницу между фактическим расходом токенов (из usageMetadata) и оценкой."""
+        if actual_tokens:
+            self.tokens.take(actual_tokens - estimated_tokens)
+
+
+# Ограничители по парам (хэш ключа, модель); давно не использованные вытесняются
+_limiters: LRUCache = LRUCache(maxsize=10000)
+
+
+def get_limiter(api_key: str, model: str) -> Limiter:
+    """Возвращает (создает при необходимости) ограничитель для пары (ключ, модель)."""
+    key = (hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16], model)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limiter = _limiters[key] = Limiter(limits_for_model(model))
+    return limiter
+
+
+def get_stats() -> Dict[str, Any]:
+    """Сколько запросов пропущено, сколько из них ждали очереди (и среднее ожидание) и сколько отклонено."""
+    return {
+        'acquired': _stats['acquired'],
+        'waited': _stats['waited'],
+        'wait_avg_ms': round(_stats['wait_ms_total'] / _stats['waited'], 1) if _stats['waited'] else 0.0,
+        'rejected': _stats['rejected'],
+    }
@@ -0,0 +1,150 @@
+# File: services/retry_policy.py
+"""
+Политика повторных попыток для запросов к Gemini API.
+
+Ошибки делятся на классы (превышение квот, ошибки сервера, тайм-ауты, сетевые и
+прочие), и у каждого класса свой бюджет повторов. Задержка растет экспоненциально
+с «полным джиттером» (случайная величина от 0 до base * 2^n, но не больше max_delay):
+повторы множества пользователей, упершихся в квоту одновременно, расходятся во времени,
+а не бьют в API синхронной волной. Если сервер сам назвал задержку (заголовок
+Retry-After или RetryInfo в деталях ошибки), ждем не меньше нее. Все повторы одного
+запроса укладываются в общий срок `deadline`: если следующая попытка за него выходит,
+ошибка возвращается сразу.
+
+Политика задается объектом `RetryPolicy`; состояние одного запроса (сколько повторов
+уже сделано, когда истекает срок) — `RetryState`, создаваемый через `RetryPolicy.begin()`.
+"""
+import random
+import re
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Mapping, Optional
+
+from config.settings import (
+    GEMINI_RETRY_RATE_LIMIT, GEMINI_RETRY_SERVER, GEMINI_RETRY_TIMEOUT, GEMINI_RETRY_NETWORK,
+    GEMINI_RETRY_UNEXPECTED, GEMINI_RETRY_BASE_DELAY_SECONDS, GEMINI_RETRY_MAX_DELAY_SECONDS,
+    GEMINI_RETRY_DEADLINE_SECONDS
+)
+
+# Классы ошибок
+RATE_LIMIT = 'rate_limit'    # HTTP 429
+SERVER = 'server'            # HTTP 5xx
+TIMEOUT = 'timeout'          # тайм-аут соединения или ответа
+NETWORK = 'network'          # прочие ошибки aiohttp.ClientError
+UNEXPECTED = 'unexpected'    # любые другие исключения
+
+_RETRY_INFO_TYPE = 'type.googleapis.com/google.rpc.RetryInfo'
+_DURATION = re.compile(r'^\s*(\d+(?:\.\d+)?)s\s*$')
+
+
+def classify_status(status: int) -> Optional[str]:
+    """Класс ошибки для HTTP-статуса ответа; None — ошибка не временная, повторять бессмысленно."""
+    if status == 429:
+        return RATE_LIMIT
+    if status >= 500:
+        return SERVER
+    return None
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]], error_details: Optional[Dict[str, Any]] = None) -> Optional[float]:
+    """
+    Задержка (сек), которую назвал сервер: RetryInfo.retryDelay из деталей ошибки Gemini
+    (например, "37s") или заголовок Retry-After (секунды либо HTTP-дата). None, если не названа.
+    """
+    for detail in (error_details or {}).get('details', []) or []:
+        if isinstance(detail, dict) and detail.get('@type') == _RETRY_INFO_TYPE:
+            match = _DURATION.match(str(detail.get('retryDelay', '')))
+            if match:
+                return float(match.group(1))
+
+    value = (headers or {}).get('Retry-After')
+    if not value:
+        return None
+    value = value.strip()
+    if value.replace('.', '', 1).isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RetryPolicy:
+    """
+    Параметры повторных попыток.
+
+    Args:
+        budgets: Максимум повторов для каждого класса ошибок (класса нет в словаре — не повторяем).
+        base_delay: Базовая задержка экспоненциального роста, сек.
+        max_delay: Верхняя граница случайной задержки, сек (задержку сервера не ограничивает).
+        deadline: Общий срок на запрос со всеми повторами, сек.
+        rng: Источник случайных чисел в [0, 1) (подменяется для детерминированных проверок).
+    """
+
+    def __init__(self, budgets: Dict[str, int], base_delay: float, max_delay: float, deadline: float,
+                 rng: Callable[[], float] = random.random):
+        self.budgets = dict(budgets)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.rng = rng
+
+    def begin(self) -> 'RetryState':
+        """Начинает отсчет повторов и срока для одного запроса."""
+        return RetryState(self)
+
+
+class RetryState:
+    """Повторы одного запроса: сколько уже сделано по каждому классу и сколько осталось до срока."""
+
+    def __init__(self, policy: RetryPolicy):
+        self.policy = policy
+        self.attempt = 1
+        self.retries: Dict[str, int] = {}
+        self._deadline_at = time.monotonic() + policy.deadline
+
+    def remaining(self) -> float:
+        """Сколько секунд осталось до общего срока запроса."""
+        return self._deadline_at - time.monotonic()
+
+    def next_delay(self, error_class: Optional[str], retry_after: Optional[float] = None) -> Optional[float]:
+        """
+        Задержка перед следующей попыткой или None, если повторять не нужно: класс ошибки не временный,
+        бюджет класса исчерпан или попытка не успеет до общего срока.
+        """
+        if error_class is None:
+            return None
+        used = self.retries.get(error_class, 0)
+        if used >= self.policy.budgets.get(error_class, 0):
+            return None
+
+        # Полный джиттер: равномерно от 0 до экспоненциально растущей границы
+        delay = self.policy.rng() * min(self.policy.max_delay, self.policy.base_delay * (2 ** used))
+        if retry_after is not None:
+            # Ждем не меньше названного сервером, джиттер разносит клиентов, получивших одну и ту же задержку
+            delay = retry_after + self.policy.rng() * self.policy.base_delay
+        if delay >= self.remaining():
+            return None
+
+        self.retries[error_class] = used + 1
+        self.attempt += 1
+        return delay
+
+
+# Политика по умолчанию для запросов к Gemini API (настраивается переменными окружения)
+DEFAULT_POLICY = RetryPolicy(
+    budgets={
+        RATE_LIMIT: GEMINI_RETRY_RATE_LIMIT,
+        SERVER: GEMINI_RETRY_SERVER,
+        TIMEOUT: GEMINI_RETRY_TIMEOUT,
+        NETWORK: GEMINI_RETRY_NETWORK,
+        UNEXPECTED: GEMINI_RETRY_UNEXPECTED,
+    },
+    base_delay=GEMINI_RETRY_BASE_DELAY_SECONDS,
+    max_delay=GEMINI_RETRY_MAX_DELAY_SECONDS,
+    deadline=GEMINI_RETRY_DEADLINE_SECONDS,
+)
@@ -17,6 +17,7 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
                  "*/settings* - Открыть меню настроек.\n"
                  "*/dialogs* - Управление диалогами.\n"
                  "*/history* - Посмотреть историю сообщений.\n"
+                 "*/search* - Поиск по истории сообщений.\n"
                  "*/usage* - Статистика расходов токенов.\n\n"
                  "➡️ Используй /help_guide для получения **полного руководства** по всем функциям.\n"
                  "🔑 Используй /apikey_info для получения инструкции по **созданию API ключа**.",
@@ -82,6 +83,12 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
         'history_role_bot': "Бот",
         'history_no_messages': "В этот день в данном диалоге сообщений не найдено.",
         'history_date_error': "Произошла ошибка при обработке даты. Попробуйте еще раз.",
+        # --- Поиск ---
+        'search_usage': "🔎 Укажите, что искать: /search <слова>\nНапример: /search рецепт пиццы",
+        'search_results_title': "🔎 Результаты поиска по запросу «{query}»:",
+        'search_no_results': "По запросу «{query}» ничего не найдено.",
+        'search_no_more_results': "Больше результатов по запросу «{query}» нет.",
+        'search_expired': "Поиск устарел. Повторите команду /search.",
         # --- Статистика расходов ---
         'usage_title': "📊 *Статистика расходов токенов*",
         'usage_today_header': "*За сегодня:*",
@@ -102,6 +109,7 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
         'support_prompt': "Если вам нравится бот и вы хотите поддержать его развитие, вы можете сделать небольшой донат:",
         # --- Ошибки ---
         'unsupported_content': "Я пока не умею обрабатывать такой тип контента.",
+        'stream_placeholder': "⏳ Генерирую ответ...",
         'state_wrong_content_type': "Пожалуйста, отправьте текст для завершения текущего действия или нажмите /reset.",
         'translation_error_generic': "Не удалось выполнить перевод. Попробуйте еще раз.",
         # --- Ошибки Gemini API (понятные пользователю) ---
@@ -110,6 +118,7 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
         'gemini_error_api_key_invalid': "🚫 *Ошибка: Неверный API-ключ.*\nПожалуйста, проверьте правильность вашего ключа и установите его заново с помощью /set_api_key.",
         'gemini_error_permission_denied': "🚫 *Ошибка: Доступ запрещен.*\nУбедитесь, что ваш API-ключ активирован и имеет необходимые разрешения в Google AI Studio.",
         'gemini_error_quota_exceeded': "⏳ *Ошибка: Превышена квота.*\nВы исчерпали лимит запросов к API. Попробуйте позже или проверьте лимиты в вашей учетной записи Google.",
+        'gemini_error_rate_limited': "⏳ *Слишком много запросов подряд.*\nПодождите немного и отправьте сообщение еще раз.",
         'gemini_error_safety': "censored:censored_black_rectangle: *Ответ заблокирован.*\nСгенерированный ответ был заблокирован настройками безопасности Google. Попробуйте переформулировать запрос.",
         'gemini_error_unavailable': "🛠️ *Сервис временно недоступен.*\nСерверы Google могут быть перегружены. Пожалуйста, повторите попытку через несколько минут.",
         'gemini_error_invalid_argument': "🤔 *Ошибка: Некорректный запрос.*\nВозможно, вы пытаетесь отправить контент, который не поддерживается выбранной моделью (например, видео).",
@@ -137,6 +146,11 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
             'btn_user_management': "👤 Управление пользователями",
             'btn_maintenance': "🛠️ Режим обслуживания",
             'btn_export_users': "📥 Выгрузить пользователей",
+            'btn_database': "🗄️ База данных",
+            'btn_refresh': "🔄 Обновить",
+            'btn_backup_now': "💾 Создать резервную копию",
+            'btn_query_stats': "🐢 Время запросов",
+            'btn_back_to_database': "⬅️ Назад к базе данных",
             'btn_back_to_admin_menu': "⬅️ Назад в админ-панель",
             # Режим обслуживания
             'maintenance_menu_title': "🛠️ *Режим обслуживания*",
@@ -152,6 +166,58 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
             'stats_active_users': "🏃 Активных за 7 дней:",
             'stats_new_users': "🌱 Новых за 7 дней:",
             'stats_blocked_users': "🚫 Заблокированных:",
+            'stats_http_header': "*Соединения с Gemini API*",
+            'stats_http_requests': "Запросов (всего / выполняется):",
+            'stats_http_connections': "Соединений (новых / переиспользовано / доля, %):",
+            'stats_http_connect': "Установка соединения, мс (ср.):",
+            'stats_http_queued': "Ожиданий свободного соединения (число / ср. мс, лимит на хост):",
+            'stats_http_dns': "Кэш DNS (попаданий / промахов):",
+            # База данных
+            'db_title': "🗄️ *База данных*",
+            'db_pool_header': "*Пул соединений*",
+            'db_pool_size': "Читателей / писателей:",
+            'db_pool_checkouts': "Выдач соединений (чтение / запись):",
+            'db_pool_wait_read': "Ожидание чтения, мс (ср. / макс.):",
+            'db_pool_wait_write': "Ожидание записи, мс (ср. / макс.):",
+            'db_pool_queued': "В очереди (чтение / запись):",
+            'db_pool_write_batches': "Пачек записи (всего / ср. размер / ср. фиксация, мс):",
+            'db_pool_not_started': "Пул соединений еще не запущен.",
+            'db_cache_header': "*Кэш профилей*",
+            'db_cache_size': "Записей (сейчас / максимум):",
+            'db_cache_hits': "Попаданий / промахов:",
+            'db_cache_hit_rate': "Доля попаданий, %:",
+            'db_archive_header': "*Архив истории*",
+            'db_archive_moved': "Перенесено сообщений (всего / в последнем проходе):",
+            'db_archive_last_run': "Последний проход:",
+            'db_archive_no_runs': "Архиватор еще не запускался.",
+            'db_retention_header': "*Политика хранения*",
+            'db_retention_removed': "Удалено сообщений (всего / в последнем проходе):",
+            'db_retention_reclaimed': "Возвращено места (всего / в последнем проходе):",
+            'db_retention_no_runs': "Политика хранения еще не применялась.",
+            'db_reaper_header': "*Удаление диалогов*",
+            'db_reaper_pending': "Ожидают удаления (диалогов / сообщений):",
+            'db_reaper_removed': "Удалено с запуска (диалогов / сообщений):",
+            'db_checkpoint_header': "*Контрольные точки WAL*",
+            'db_checkpoint_counts': "PASSIVE / TRUNCATE / незавершенных:",
+            'db_checkpoint_last': "Последняя (режим, время, страниц в WAL):",
+            'db_checkpoint_optimize': "Запусков PRAGMA optimize:",
+            'db_checkpoint_no_runs': "Контрольные точки еще не выполнялись.",
+            'db_backup_header': "*Резервные копии*",
+            'db_backup_last': "Последняя:",
+            'db_backup_ok': "✅",
+            'db_backup_failed': "❌",
+            'db_backup_size': "Размер / длительность:",
+            'db_backup_error': "Ошибка:",
+            'db_backup_none': "Резервные копии еще не создавались.",
+            'db_backup_started': "⏳ Создаю резервную копию базы данных...",
+            'db_backup_in_progress': "Резервное копирование уже выполняется.",
+            'db_unavailable': "Раздел недоступен: бот работает на хранилище в памяти.",
+            'db_queries_title': "🐢 *Время SQL-запросов*",
+            'db_queries_summary': "Различных запросов / выполнений / всего, мс:",
+            'db_queries_slow': "Медленных (порог, мс):",
+            'db_queries_top': "*Больше всего времени*",
+            'db_queries_entry': "Выполнений / всего / ср. / p95 / макс., мс:",
+            'db_queries_empty': "Запросы еще не выполнялись.",
             # Управление пользователями
             'user_management_title': "👤 *Управление пользователями*",
             'user_management_prompt': "Введите User ID для получения информации:",
@@ -203,6 +269,7 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
                  "*/settings* - Open the settings menu.\n"
                  "*/dialogs* - Manage your dialogs.\n"
                  "*/history* - View message history.\n"
+                 "*/search* - Search your message history.\n"
                  "*/usage* - Token usage statistics.\n\n"
                  "➡️ Use /help_guide for the **full user manual**.\n"
                  "🔑 Use /apikey_info for instructions on **creating an API key**.",
@@ -268,6 +335,12 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
         'history_role_bot': "Bot",
         'history_no_messages': "No messages found on this day in this dialog.",
         'history_date_error': "An error occurred while processing the date. Please try again.",
+        # --- Search ---
+        'search_usage': "🔎 Tell me what to look for: /search <words>\nFor example: /search pizza recipe",
+        'search_results_title': "🔎 Search results for \"{query}\":",
+        'search_no_results': "Nothing found for \"{query}\".",
+        'search_no_more_results': "No more results for \"{query}\".",
+        'search_expired': "This search has expired. Please run /search again.",
         # --- Usage Statistics ---
         'usage_title': "📊 *Token Usage Statistics*",
         'usage_today_header': "*For Today:*",
@@ -288,6 +361,7 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
         'support_prompt': "If you like the bot and wish to support its development, you can make a small donation:",
         # --- Errors ---
         'unsupported_content': "I don't know how to handle this type of content yet.",
+        'stream_placeholder': "⏳ Generating a response...",
         'state_wrong_content_type': "Please send text to complete the current action, or press /reset.",
         'translation_error_generic': "Failed to perform translation. Please try again.",
         # --- Gemini API Errors (User-Friendly) ---
@@ -296,6 +370,7 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
         'gemini_error_api_key_invalid': "🚫 *Error: Invalid API Key.*\nPlease check your key and set it again using /set_api_key.",
         'gemini_error_permission_denied': "🚫 *Error: Permission Denied.*\nEnsure your API key is activated and has permissions in Google AI Studio.",
         'gemini_error_quota_exceeded': "⏳ *Error: Quota Exceeded.*\nYou have exhausted your API request limit. Try again later or check your Google account limits.",
+        'gemini_error_rate_limited': "⏳ *Too Many Requests in a Row.*\nPlease wait a moment and send your message again.",
         'gemini_error_safety': "censored:censored_black_rectangle: *Response Blocked.*\nThe generated response was blocked by Google's safety settings. Try rephrasing your request.",
         'gemini_error_unavailable': "🛠️ *Service Temporarily Unavailable.*\nGoogle's servers might be overloaded. Please try again in a few minutes.",
         'gemini_error_invalid_argument': "🤔 *Error: Invalid Request.*\nYou might be trying to send content not supported by the model (e.g., a video).",
@@ -323,6 +398,11 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
             'btn_user_management': "👤 User Management",
             'btn_maintenance': "🛠️ Maintenance Mode",
             'btn_export_users': "📥 Export Users",
+            'btn_database': "🗄️ Database",
+            'btn_refresh': "🔄 Refresh",
+            'btn_backup_now': "💾 Back Up Now",
+            'btn_query_stats': "🐢 Query Timings",
+            'btn_back_to_database': "⬅️ Back to Database",
             'btn_back_to_admin_menu': "⬅️ Back to Admin Panel",
             # Maintenance Mode
             'maintenance_menu_title': "🛠️ *Maintenance Mode*",
@@ -338,6 +418,58 @@ LOCALIZATION: Dict[str, Dict[str, str]] = {
             'stats_active_users': "🏃 Active in last 7 days:",
             'stats_new_users': "🌱 New in last 7 days:",
             'stats_blocked_users': "🚫 Blocked users:",
+            'stats_http_header': "*Gemini API Connections*",
+            'stats_http_requests': "Requests (total / in flight):",
+            'stats_http_connections': "Connections (new / reused / reuse rate, %):",
+            'stats_http_connect': "Connection setup, ms (avg):",
+            'stats_http_queued': "Waits for a free connection (count / avg ms, per-host limit):",
+            'stats_http_dns': "DNS cache (hits / misses):",
+            # Database
+            'db_title': "🗄️ *Database*",
+            'db_pool_header': "*Connection Pool*",
+            'db_pool_size': "Readers / writers:",
+            'db_pool_checkouts': "Checkouts (read / write):",
+            'db_pool_wait_read': "Read wait, ms (avg / max):",
+            'db_pool_wait_write': "Write wait, ms (avg / max):",
+            'db_pool_queued': "Queued (read / write):",
+            'db_pool_write_batches': "Write batches (total / avg size / avg commit, ms):",
+            'db_pool_not_started': "The connection pool has not been started yet.",
+            'db_cache_header': "*Profile Cache*",
+            'db_cache_size': "Entries (current / max):",
+            'db_cache_hits': "Hits / misses:",
+            'db_cache_hit_rate': "Hit rate, %:",
+            'db_archive_header': "*History Archive*",
+            'db_archive_moved': "Messages moved (total / last run):",
+            'db_archive_last_run': "Last run:",
+            'db_archive_no_runs': "The archiver has not run yet.",
+            'db_retention_header': "*Retention Policy*",
+            'db_retention_removed': "Messages removed (total / last run):",
+            'db_retention_reclaimed': "Space reclaimed (total / last run):",
+            'db_retention_no_runs': "The retention policy has not run yet.",
+            'db_reaper_header': "*Dialog Deletion*",
+            'db_reaper_pending': "Pending deletion (dialogs / messages):",
+            'db_reaper_removed': "Deleted since start (dialogs / messages):",
+            'db_checkpoint_header': "*WAL Checkpoints*",
+            'db_checkpoint_counts': "PASSIVE / TRUNCATE / incomplete:",
+            'db_checkpoint_last': "Last (mode, time, WAL pages):",
+            'db_checkpoint_optimize': "PRAGMA optimize runs:",
+            'db_checkpoint_no_runs': "No checkpoints have run yet.",
+            'db_backup_header': "*Backups*",
+            'db_backup_last': "Last:",
+            'db_backup_ok': "✅",
+            'db_backup_failed': "❌",
+            'db_backup_size': "Size / duration:",
+            'db_backup_error': "Error:",
+            'db_backup_none': "No backups have been made yet.",
+            'db_backup_started': "⏳ Backing up the database...",
+            'db_backup_in_progress': "A backup is already running.",
+            'db_unavailable': "Not available: the bot is running on the in-memory storage.",
+            'db_queries_title': "🐢 *SQL Query Timings*",
+            'db_queries_summary': "Distinct statements / executions / total, ms:",
+            'db_queries_slow': "Slow (threshold, ms):",
+            'db_queries_top': "*Most time spent*",
+            'db_queries_entry': "Executions / total / avg / p95 / max, ms:",
+            'db_queries_empty': "No queries have run yet.",
             # User Management
             'user_management_title': "👤 *User Management*",
             'user_management_prompt': "Enter User ID for details:",
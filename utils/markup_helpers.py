@@ -14,13 +14,17 @@ from config.settings import (
     # Dialogs
     CALLBACK_DIALOGS_MENU, CALLBACK_DIALOG_SWITCH_PREFIX, CALLBACK_DIALOG_RENAME_PREFIX,
     CALLBACK_DIALOG_DELETE_PREFIX, CALLBACK_DIALOG_CREATE, CALLBACK_DIALOG_CONFIRM_DELETE_PREFIX,
+    # Search
+    CALLBACK_SEARCH_PAGE_PREFIX,
     # Admin Panel
     CALLBACK_ADMIN_MAIN_MENU, CALLBACK_ADMIN_STATS_MENU, CALLBACK_ADMIN_COMMUNICATION_MENU,
     CALLBACK_ADMIN_USER_MANAGEMENT_MENU, CALLBACK_ADMIN_MAINTENANCE_MENU, CALLBACK_ADMIN_TOGGLE_MAINTENANCE,
     CALLBACK_ADMIN_BROADCAST, CALLBACK_ADMIN_CONFIRM_BROADCAST, CALLBACK_ADMIN_CANCEL_BROADCAST,
-    CALLBACK_ADMIN_TOGGLE_BLOCK_PREFIX, CALLBACK_ADMIN_RESET_API_KEY_PREFIX # <-- НОВЫЕ ИМПОРТЫ
+    CALLBACK_ADMIN_TOGGLE_BLOCK_PREFIX, CALLBACK_ADMIN_RESET_API_KEY_PREFIX, # <-- НОВЫЕ ИМПОРТЫ
+    CALLBACK_ADMIN_DATABASE_MENU, CALLBACK_ADMIN_BACKUP_NOW,
+    CALLBACK_ADMIN_QUERY_STATS
 )
-from database import db_manager
+from database import storage
 from logger_config import get_logger
 from . import localization as loc
 
@@ -53,9 +57,9 @@ def create_main_keyboard(lang_code: str, user_id: int) -> types.ReplyKeyboardMar
 async def create_dialogs_menu_keyboard(user_id: int) -> types.InlineKeyboardMarkup:
     """Создает клавиатуру для управления диалогами."""
     markup = types.InlineKeyboardMarkup(row_width=3)
-    lang_code = await db_manager.get_user_language(user_id)
-    dialogs = await db_manager.get_user_dialogs(user_id)
-    active_dialog_id = await db_manager.get_active_dialog_id(user_id)
+    lang_code = await storage.get_user_language(user_id)
+    dialogs = await storage.get_user_dialogs(user_id)
+    active_dialog_id = await storage.get_active_dialog_id(user_id)
 
     for dialog in dialogs:
         is_active = dialog['dialog_id'] == active_dialog_id
@@ -107,8 +111,8 @@ def create_language_selection_keyboard() -> types.InlineKeyboardMarkup:
 async def create_settings_keyboard(user_id: int) -> types.InlineKeyboardMarkup:
     """Создает inline-клавиатуру настроек, включая стиль, язык и API ключ."""
     markup = types.InlineKeyboardMarkup(row_width=1)
-    current_style = await db_manager.get_user_bot_style(user_id)
-    current_lang = await db_manager.get_user_language(user_id)
+    current_style = await storage.get_user_bot_style(user_id)
+    current_lang = await storage.get_user_language(user_id)
 
     markup.add(types.InlineKeyboardButton(loc.get_text('settings_api_key_section', current_lang), callback_data=CALLBACK_IGNORE))
     markup.add(types.InlineKeyboardButton(
@@ -152,8 +156,8 @@ async def create_settings_keyboard(user_id: int) -> types.InlineKeyboardMarkup:
 async def create_persona_selection_keyboard(user_id: int) -> types.InlineKeyboardMarkup:
     """Создает клавиатуру для выбора персоны."""
     markup = types.InlineKeyboardMarkup(row_width=2)
-    lang_code = await db_manager.get_user_language(user_id)
-    current_persona_id = await db_manager.get_user_persona(user_id)
+    lang_code = await storage.get_user_language(user_id)
+    current_persona_id = await storage.get_user_persona(user_id)
     buttons = []
     for persona_id, persona_data in BOT_PERSONAS.items():
         persona_name = persona_data.get(f"name_{lang_code}", persona_data["name_ru"])
@@ -238,6 +242,22 @@ def create_calendar_keyboard(year: Optional[int] = None, month: Optional[int] =
     return markup
 
 
+def create_search_pagination_keyboard(offset: int, page_size: int, has_more: bool) -> Optional[types.InlineKeyboardMarkup]:
+    """Создает кнопки листания результатов поиска (None, если страница единственная)."""
+    if offset <= 0 and not has_more:
+        return None
+    page_number = offset // page_size + 1
+    prev_button = types.InlineKeyboardButton(
+        "⬅️", callback_data=f"{CALLBACK_SEARCH_PAGE_PREFIX}{max(0, offset - page_size)}"
+    ) if offset > 0 else types.InlineKeyboardButton(" ", callback_data=CALLBACK_IGNORE)
+    next_button = types.InlineKeyboardButton(
+        "➡️", callback_data=f"{CALLBACK_SEARCH_PAGE_PREFIX}{offset + page_size}"
+    ) if has_more else types.InlineKeyboardButton(" ", callback_data=CALLBACK_IGNORE)
+    markup = types.InlineKeyboardMarkup()
+    markup.row(prev_button, types.InlineKeyboardButton(str(page_number), callback_data=CALLBACK_IGNORE), next_button)
+    return markup
+
+
 def create_error_report_button() -> types.InlineKeyboardMarkup:
     """Создает inline-клавиатуру с кнопкой 'Сообщить об ошибке'."""
     markup = types.InlineKeyboardMarkup()
@@ -284,16 +304,60 @@ async def create_admin_main_menu_keyboard(lang_code: str) -> types.InlineKeyboar
         loc.get_text('admin.btn_export_users', lang_code),
         callback_data=CALLBACK_ADMIN_EXPORT_USERS # Используем новую константу
     )
+    database_btn = types.InlineKeyboardButton(
+        loc.get_text('admin.btn_database', lang_code),
+        callback_data=CALLBACK_ADMIN_DATABASE_MENU
+    )
     markup.add(stats_btn, comm_btn)
     markup.add(user_mgmt_btn, maintenance_btn)
-    markup.add(export_btn)
+    # Раздел 'База данных' описывает SQLite и для хранилища в памяти не показывается
+    if storage.is_sqlite():
+        markup.add(export_btn, database_btn)
+    else:
+        markup.add(export_btn)
+    return markup
+
+
+def create_database_menu_keyboard(lang_code: str) -> types.InlineKeyboardMarkup:
+    """Создает клавиатуру раздела 'База данных'."""
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(types.InlineKeyboardButton(
+        loc.get_text('admin.btn_refresh', lang_code),
+        callback_data=CALLBACK_ADMIN_DATABASE_MENU
+    ))
+    markup.add(types.InlineKeyboardButton(
+        loc.get_text('admin.btn_backup_now', lang_code),
+        callback_data=CALLBACK_ADMIN_BACKUP_NOW
+    ))
+    markup.add(types.InlineKeyboardButton(
+        loc.get_text('admin.btn_query_stats', lang_code),
+        callback_data=CALLBACK_ADMIN_QUERY_STATS
+    ))
+    markup.add(types.InlineKeyboardButton(
+        loc.get_text('admin.btn_back_to_admin_menu', lang_code),
+        callback_data=CALLBACK_ADMIN_MAIN_MENU
+    ))
+    return markup
+
+
+def create_query_stats_keyboard(lang_code: str) -> types.InlineKeyboardMarkup:
+    """Создает клавиатуру экрана времени SQL-запросов."""
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(types.InlineKeyboardButton(
+        loc.get_text('admin.btn_refresh', lang_code),
+        callback_data=CALLBACK_ADMIN_QUERY_STATS
+    ))
+    markup.add(types.InlineKeyboardButton(
+        loc.get_text('admin.btn_back_to_database', lang_code),
+        callback_data=CALLBACK_ADMIN_DATABASE_MENU
+    ))
     return markup
 
 
 async def create_maintenance_menu_keyboard(lang_code: str) -> types.InlineKeyboardMarkup:
     """Создает клавиатуру для управления режимом обслуживания."""
     markup = types.InlineKeyboardMarkup(row_width=1)
-    maintenance_mode_str = await db_manager.get_app_setting('maintenance_mode')
+    maintenance_mode_str = await storage.get_app_setting('maintenance_mode')
     is_on = maintenance_mode_str == 'true'
 
     status_text = loc.get_text('admin.maintenance_status_on', lang_code) if is_on else loc.get_text('admin.maintenance_status_off', lang_code)